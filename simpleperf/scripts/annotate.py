@@ -26,7 +26,8 @@ import shutil
 
 from simpleperf_report_lib import ReportLib
 from utils import log_info, log_warning, log_exit
-from utils import Addr2Nearestline, extant_dir, flatten_arg_list, is_windows, SourceFileSearcher
+from utils import Addr2Nearestline, extant_dir, flatten_arg_list, get_default_jobs, is_windows
+from utils import map_in_process_pool, SourceFileSearcher
 
 class SourceLine(object):
     def __init__(self, file_id, function, line):
@@ -50,15 +51,17 @@ class SourceLine(object):
 class Addr2Line(object):
     """collect information of how to map [dso_name, vaddr] to [source_file:line].
     """
-    def __init__(self, ndk_path, binary_cache_path, source_dirs):
+    def __init__(self, ndk_path, binary_cache_path, source_dirs, source_index=None):
         self.addr2line = Addr2Nearestline(ndk_path, binary_cache_path, True)
-        self.source_searcher = SourceFileSearcher(source_dirs)
+        self.source_searcher = SourceFileSearcher(source_dirs, source_index)
+        # Map from source file path reported by addr2line to real path.
+        self.real_paths = {}
 
     def add_addr(self, dso_path, func_addr, addr):
         self.addr2line.add_addr(dso_path, func_addr, addr)
 
-    def convert_addrs_to_lines(self):
-        self.addr2line.convert_addrs_to_lines()
+    def convert_addrs_to_lines(self, jobs=1):
+        self.addr2line.convert_addrs_to_lines(jobs)
 
     def get_sources(self, dso_path, addr):
         dso = self.addr2line.get_dso(dso_path)
@@ -69,9 +72,12 @@ class Addr2Line(object):
             return []
         result = []
         for (source_file, source_line, function_name) in source:
-            source_file_path = self.source_searcher.get_real_path(source_file)
-            if not source_file_path:
-                source_file_path = source_file
+            source_file_path = self.real_paths.get(source_file)
+            if source_file_path is None:
+                source_file_path = self.source_searcher.get_real_path(source_file)
+                if not source_file_path:
+                    source_file_path = source_file
+                self.real_paths[source_file] = source_file_path
             result.append(SourceLine(source_file_path, function_name, source_line))
         return result
 
@@ -138,6 +144,74 @@ class FilePeriod(object):
         a[1] += period
 
 
+def get_percentage_str(period, total_period, short=False):
+    s = 'acc_p: %f%%, p: %f%%' if short else 'accumulated_period: %f%%, period: %f%%'
+    if total_period == 0:
+        return s % (0, 0)
+    return s % (100.0 * period.acc_period / total_period, 100.0 * period.period / total_period)
+
+
+class SourceFileWriter(object):
+    """Write annotated source files. It only keeps the total period, so it is cheap to
+       send to worker processes.
+    """
+    def __init__(self, total_period):
+        self.total_period = total_period
+
+
+    def annotate_file(self, from_path, to_path, file_period, is_java):
+        """Annotate a source file.
+
+        Annotate a source file in three steps:
+          1. In the first line, show periods of this file.
+          2. For each function, show periods of this function.
+          3. For each line not hitting the same line as functions, show
+             line periods.
+        """
+        log_info('annotate file %s' % from_path)
+        annotates = {}
+        for line in file_period.line_dict.keys():
+            annotates[line] = get_percentage_str(file_period.line_dict[line], self.total_period,
+                                                 True)
+        for func_name in file_period.function_dict.keys():
+            func_start_line, period = file_period.function_dict[func_name]
+            if func_start_line == -1:
+                continue
+            line = func_start_line - 1 if is_java else func_start_line
+            annotates[line] = '[func] ' + get_percentage_str(period, self.total_period, True)
+        annotates[1] = '[file] ' + get_percentage_str(file_period.period, self.total_period,
+                                                      True)
+
+        max_annotate_cols = 0
+        for key in annotates:
+            max_annotate_cols = max(max_annotate_cols, len(annotates[key]))
+
+        empty_annotate = ' ' * (max_annotate_cols + 6)
+
+        dirname = os.path.dirname(to_path)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # Created by another worker process.
+                if not os.path.isdir(dirname):
+                    raise
+        # Lines are read and written one by one, instead of reading the whole file.
+        with open(from_path, 'r') as rf, open(to_path, 'w') as wf:
+            for line, content in enumerate(rf, 1):
+                annotate = annotates.get(line)
+                if annotate is None:
+                    if not content.strip():
+                        annotate = ''
+                    else:
+                        annotate = empty_annotate
+                else:
+                    annotate = '/* ' + annotate + (
+                        ' ' * (max_annotate_cols - len(annotate))) + ' */'
+                wf.write(annotate)
+                wf.write(content)
+
+
 class SourceFileAnnotator(object):
     """group code for annotating source files"""
     def __init__(self, config):
@@ -176,49 +250,68 @@ class SourceFileAnnotator(object):
         os.makedirs(output_dir)
 
 
-        self.addr2line = Addr2Line(self.config['ndk_path'], symfs_dir, config.get('source_dirs'))
+        self.addr2line = Addr2Line(self.config['ndk_path'], symfs_dir, config.get('source_dirs'),
+                                   config.get('source_index'))
         self.period = 0
         self.dso_periods = {}
         self.file_periods = {}
+        # Map from (is_first_frame_used, frames) to the accumulated period of samples having
+        # that callchain. frames contains (dso_name, symbol_addr, vaddr_in_file) of frames not
+        # filtered out.
+        self.callchain_periods = {}
 
 
     def annotate(self):
-        self._collect_addrs()
+        self._collect_samples()
         self._convert_addrs_to_lines()
         self._generate_periods()
         self._write_summary()
         self._annotate_files()
 
 
-    def _collect_addrs(self):
+    def _collect_samples(self):
         """Read perf.data, collect all addresses we need to convert to
-           source file:line.
+           source file:line, and periods of callchains. So perf.data is
+           only read once.
         """
-        for perf_data in self.config['perf_data_list']:
-            lib = ReportLib()
-            lib.SetRecordFile(perf_data)
+        with ReportLib() as lib:
             if self.symfs_dir:
                 lib.SetSymfs(self.symfs_dir)
             if self.kallsyms:
                 lib.SetKallsymsFile(self.kallsyms)
-            while True:
-                sample = lib.GetNextSample()
-                if sample is None:
-                    lib.Close()
-                    break
-                if not self._filter_sample(sample):
-                    continue
-                symbols = []
-                symbols.append(lib.GetSymbolOfCurrentSample())
-                callchain = lib.GetCallChainOfCurrentSample()
-                for i in range(callchain.nr):
-                    symbols.append(callchain.entries[i].symbol)
-                for symbol in symbols:
-                    if self._filter_symbol(symbol):
-                        self.addr2line.add_addr(symbol.dso_name, symbol.symbol_addr,
-                                                symbol.vaddr_in_file)
-                        self.addr2line.add_addr(symbol.dso_name, symbol.symbol_addr,
-                                                symbol.symbol_addr)
+            for perf_data in self.config['perf_data_list']:
+                lib.SetRecordFile(perf_data)
+                while True:
+                    sample = lib.GetNextSample()
+                    if sample is None:
+                        break
+                    if not self._filter_sample(sample):
+                        continue
+                    symbols = []
+                    symbols.append(lib.GetSymbolOfCurrentSample())
+                    callchain = lib.GetCallChainOfCurrentSample()
+                    for i in range(callchain.nr):
+                        symbols.append(callchain.entries[i].symbol)
+                    self._add_callchain(symbols, sample.period)
+
+
+    def _add_callchain(self, symbols, period):
+        """Collect addresses of a sample, and add its period to callchain_periods.
+           symbols contains the symbol of the sample, followed by symbols in its callchain.
+        """
+        frames = []
+        is_first_frame_used = False
+        for j, symbol in enumerate(symbols):
+            if self._filter_symbol(symbol):
+                if j == 0:
+                    is_first_frame_used = True
+                frame = (symbol.dso_name, symbol.symbol_addr, symbol.vaddr_in_file)
+                frames.append(frame)
+                self.addr2line.add_addr(frame[0], frame[1], frame[2])
+                self.addr2line.add_addr(frame[0], frame[1], frame[1])
+        if frames:
+            key = (is_first_frame_used, tuple(frames))
+            self.callchain_periods[key] = self.callchain_periods.get(key, 0) + period
 
 
     def _filter_sample(self, sample):
@@ -242,57 +335,38 @@ class SourceFileAnnotator(object):
 
 
     def _convert_addrs_to_lines(self):
-        self.addr2line.convert_addrs_to_lines()
+        self.addr2line.convert_addrs_to_lines(self.config.get('jobs', 1))
 
 
     def _generate_periods(self):
-        """read perf.data, collect Period for all types:
+        """collect Period for all types:
             binaries, source files, functions, lines.
         """
-        for perf_data in self.config['perf_data_list']:
-            lib = ReportLib()
-            lib.SetRecordFile(perf_data)
-            if self.symfs_dir:
-                lib.SetSymfs(self.symfs_dir)
-            if self.kallsyms:
-                lib.SetKallsymsFile(self.kallsyms)
-            while True:
-                sample = lib.GetNextSample()
-                if sample is None:
-                    lib.Close()
-                    break
-                if not self._filter_sample(sample):
-                    continue
-                self._generate_periods_for_sample(lib, sample)
-
-
-    def _generate_periods_for_sample(self, lib, sample):
-        symbols = []
-        symbols.append(lib.GetSymbolOfCurrentSample())
-        callchain = lib.GetCallChainOfCurrentSample()
-        for i in range(callchain.nr):
-            symbols.append(callchain.entries[i].symbol)
+        for key, period in self.callchain_periods.items():
+            self._generate_periods_for_callchain(key[0], key[1], period)
+        self.callchain_periods = {}
+
+
+    def _generate_periods_for_callchain(self, is_first_frame_used, frames, sample_period):
         # Each sample has a callchain, but its period is only used once
         # to add period for each function/source_line/source_file/binary.
         # For example, if more than one entry in the callchain hits a
         # function, the event count of that function is only increased once.
         # Otherwise, we may get periods > 100%.
-        is_sample_used = False
+        # Samples with the same callchain are handled together, with the sum of their periods.
         used_dso_dict = {}
         used_file_dict = {}
         used_function_dict = {}
         used_line_dict = {}
-        period = Period(sample.period, sample.period)
-        for j, symbol in enumerate(symbols):
-            if j == 1:
-                period = Period(0, sample.period)
-            if not self._filter_symbol(symbol):
-                continue
-            is_sample_used = True
+        for j, (dso_name, symbol_addr, vaddr_in_file) in enumerate(frames):
+            if j == 0 and is_first_frame_used:
+                period = Period(sample_period, sample_period)
+            else:
+                period = Period(0, sample_period)
             # Add period to dso.
-            self._add_dso_period(symbol.dso_name, period, used_dso_dict)
+            self._add_dso_period(dso_name, period, used_dso_dict)
             # Add period to source file.
-            sources = self.addr2line.get_sources(symbol.dso_name, symbol.vaddr_in_file)
+            sources = self.addr2line.get_sources(dso_name, vaddr_in_file)
             for source in sources:
                 if source.file:
                     self._add_file_period(source, period, used_file_dict)
@@ -300,15 +374,14 @@ class SourceFileAnnotator(object):
                     if source.line:
                         self._add_line_period(source, period, used_line_dict)
             # Add period to function.
-            sources = self.addr2line.get_sources(symbol.dso_name, symbol.symbol_addr)
+            sources = self.addr2line.get_sources(dso_name, symbol_addr)
             for source in sources:
                 if source.file:
                     self._add_file_period(source, period, used_file_dict)
                     if source.function:
                         self._add_function_period(source, period, used_function_dict)
 
-        if is_sample_used:
-            self.period += sample.period
+        self.period += sample_period
 
 
     def _add_dso_period(self, dso_name, period, used_dso_dict):
@@ -377,24 +450,17 @@ class SourceFileAnnotator(object):
 
 
     def _get_percentage_str(self, period, short=False):
-        s = 'acc_p: %f%%, p: %f%%' if short else 'accumulated_period: %f%%, period: %f%%'
-        return s % self._get_percentage(period)
-
-
-    def _get_percentage(self, period):
-        if self.period == 0:
-            return (0, 0)
-        acc_p = 100.0 * period.acc_period / self.period
-        p = 100.0 * period.period / self.period
-        return (acc_p, p)
+        return get_percentage_str(period, self.period, short)
 
 
     def _annotate_files(self):
         """Annotate Source files: add acc_period/period for each source file.
            1. Annotate java source files, which have $JAVA_SRC_ROOT prefix.
            2. Annotate c++ source files.
+           Files are annotated in up to config['jobs'] worker processes.
         """
         dest_dir = self.config['annotate_dest_dir']
+        tasks = []
         for key in self.file_periods:
             from_path = key
             if not os.path.isfile(from_path):
@@ -407,55 +473,10 @@ class SourceFileAnnotator(object):
             else:
                 to_path = os.path.join(dest_dir, from_path)
             is_java = from_path.endswith('.java')
-            self._annotate_file(from_path, to_path, self.file_periods[key], is_java)
-
-
-    def _annotate_file(self, from_path, to_path, file_period, is_java):
-        """Annotate a source file.
-
-        Annotate a source file in three steps:
-          1. In the first line, show periods of this file.
-          2. For each function, show periods of this function.
-          3. For each line not hitting the same line as functions, show
-             line periods.
-        """
-        log_info('annotate file %s' % from_path)
-        with open(from_path, 'r') as rf:
-            lines = rf.readlines()
-
-        annotates = {}
-        for line in file_period.line_dict.keys():
-            annotates[line] = self._get_percentage_str(file_period.line_dict[line], True)
-        for func_name in file_period.function_dict.keys():
-            func_start_line, period = file_period.function_dict[func_name]
-            if func_start_line == -1:
-                continue
-            line = func_start_line - 1 if is_java else func_start_line
-            annotates[line] = '[func] ' + self._get_percentage_str(period, True)
-        annotates[1] = '[file] ' + self._get_percentage_str(file_period.period, True)
-
-        max_annotate_cols = 0
-        for key in annotates:
-            max_annotate_cols = max(max_annotate_cols, len(annotates[key]))
-
-        empty_annotate = ' ' * (max_annotate_cols + 6)
-
-        dirname = os.path.dirname(to_path)
-        if not os.path.isdir(dirname):
-            os.makedirs(dirname)
-        with open(to_path, 'w') as wf:
-            for line in range(1, len(lines) + 1):
-                annotate = annotates.get(line)
-                if annotate is None:
-                    if not lines[line-1].strip():
-                        annotate = ''
-                    else:
-                        annotate = empty_annotate
-                else:
-                    annotate = '/* ' + annotate + (
-                        ' ' * (max_annotate_cols - len(annotate))) + ' */'
-                wf.write(annotate)
-                wf.write(lines[line-1])
+            tasks.append((from_path, to_path, self.file_periods[key], is_java))
+        writer = SourceFileWriter(self.period)
+        for _ in map_in_process_pool(writer, 'annotate_file', tasks, self.config.get('jobs', 1)):
+            pass
 
 def main():
     parser = argparse.ArgumentParser(description="""
@@ -466,6 +487,9 @@ def main():
         The paths of profiling data. Default is perf.data.""")
     parser.add_argument('-s', '--source_dirs', type=extant_dir, nargs='+', action='append', help="""
         Directories to find source files.""")
+    parser.add_argument('--source_index', help="""
+        Save paths of source files found in source_dirs in this file, and reuse them in the next
+        run. Only directories modified since then are listed again.""")
     parser.add_argument('--comm', nargs='+', action='append', help="""
         Use samples only in threads with selected names.""")
     parser.add_argument('--pid', nargs='+', action='append', help="""
@@ -475,6 +499,8 @@ def main():
     parser.add_argument('--dso', nargs='+', action='append', help="""
         Use samples only in selected binaries.""")
     parser.add_argument('--ndk_path', type=extant_dir, help='Set the path of a ndk release.')
+    parser.add_argument('-j', '--jobs', type=int, default=get_default_jobs(), help="""
+        Convert addresses and write annotated files in up to N worker processes.""")
 
     args = parser.parse_args()
     config = {}
@@ -482,11 +508,13 @@ def main():
     if not config['perf_data_list']:
         config['perf_data_list'].append('perf.data')
     config['source_dirs'] = flatten_arg_list(args.source_dirs)
+    config['source_index'] = args.source_index
     config['comm_filters'] = flatten_arg_list(args.comm)
     config['pid_filters'] = flatten_arg_list(args.pid)
     config['tid_filters'] = flatten_arg_list(args.tid)
     config['dso_filters'] = flatten_arg_list(args.dso)
     config['ndk_path'] = args.ndk_path
+    config['jobs'] = args.jobs
 
     annotator = SourceFileAnnotator(config)
     annotator.annotate()
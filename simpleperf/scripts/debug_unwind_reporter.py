@@ -40,7 +40,8 @@ from __future__ import print_function
 import argparse
 import bisect
 import collections
-import copy
+import json
+import math
 import re
 import subprocess
 
@@ -54,70 +55,159 @@ class MapEntry(object):
         self.end = end
         self.filename = filename
 
-    def __lt__(self, other):
-        return self.start < other.start
+class MapList(object):
+    """ A sorted list of non-overlapping MapEntry, which can be shared by forked processes.
+        MapEntry objects in it are never modified, so a shared list is only copied when a
+        process sharing it adds a map.
+    """
+
+    def __init__(self, starts=None, entries=None):
+        self.starts = starts or []  # start addresses of entries, used for binary search.
+        self.entries = entries or []
+        self.ref_count = 1
+
 
 class ProcessMaps(object):
 
     def __init__(self):
-        self.process_maps = {}  # map from pid to a sorted list of MapEntry.
+        self.process_maps = {}  # map from pid to a MapList.
+
+    def _get_writable_list(self, pid):
+        map_list = self.process_maps.get(pid)
+        if map_list is None:
+            map_list = self.process_maps[pid] = MapList()
+        elif map_list.ref_count > 1:
+            # Copy on write.
+            map_list.ref_count -= 1
+            map_list = self.process_maps[pid] = MapList(map_list.starts[:],
+                                                        map_list.entries[:])
+        return map_list
 
     def add(self, pid, map_entry):
-        old_list = self.process_maps.get(pid, [])
-        new_list = []
-        map_entry_used = False
-        for entry in old_list:
-            if entry.end <= map_entry.start:
-                new_list.append(entry)
-            elif entry.start < map_entry.start:
-                entry.end = map_entry.start
-                new_list.append(entry)
-            else:
-                if not map_entry_used:
-                    new_list.append(map_entry)
-                    map_entry_used = True
-                if entry.start >= map_entry.end:
-                    new_list.append(entry)
-                elif entry.end > map_entry.end:
-                    entry.start = map_entry.end
-                    new_list.append(entry)
-        if not map_entry_used:
-            new_list.append(map_entry)
-        self.process_maps[pid] = new_list
+        map_list = self._get_writable_list(pid)
+        starts = map_list.starts
+        entries = map_list.entries
+        # Find entries overlapping with map_entry, which are entries[low:high].
+        low = bisect.bisect_right(starts, map_entry.start)
+        if low > 0 and entries[low - 1].end > map_entry.start:
+            low -= 1
+        high = max(low, bisect.bisect_left(starts, map_entry.end))
+        new_entries = [map_entry]
+        if low < high:
+            # Keep parts of overlapped entries not covered by map_entry.
+            first = entries[low]
+            if first.start < map_entry.start:
+                new_entries.insert(0, MapEntry(first.start, map_entry.start, first.filename))
+            last = entries[high - 1]
+            if last.end > map_entry.end:
+                new_entries.append(MapEntry(map_entry.end, last.end, last.filename))
+        entries[low:high] = new_entries
+        starts[low:high] = [entry.start for entry in new_entries]
 
     def fork_pid(self, pid, ppid):
         if pid == ppid:
             return
-        entry_list = self.process_maps.get(ppid, [])
-        self.process_maps[pid] = copy.deepcopy(entry_list)
+        old_list = self.process_maps.get(pid)
+        if old_list:
+            old_list.ref_count -= 1
+        map_list = self.process_maps.get(ppid)
+        if map_list is None:
+            self.process_maps[pid] = MapList()
+        else:
+            map_list.ref_count += 1
+            self.process_maps[pid] = map_list
 
     def find(self, pid, addr):
-        key = MapEntry(addr, addr, '')
-        entry_list = self.process_maps.get(pid, [])
-        pos = bisect.bisect_right(entry_list, key)
-        if pos > 0 and entry_list[pos - 1].end > addr:
-            return entry_list[pos - 1]
+        map_list = self.process_maps.get(pid)
+        if map_list:
+            pos = bisect.bisect_right(map_list.starts, addr)
+            if pos > 0 and map_list.entries[pos - 1].end > addr:
+                return map_list.entries[pos - 1]
         return None
 
     def show(self):
         for pid in sorted(self.process_maps):
             print('  pid %d' % pid)
-            for entry in self.process_maps[pid]:
+            for entry in self.process_maps[pid].entries:
                 print('    map [%x-%x] %s' %
                       (entry.start, entry.end, entry.filename))
 
 
+class LatencyHistogram(object):
+    """ A log-bucketed histogram of times, like HdrHistogram. Values below 2 * SUB_BUCKETS are
+        counted exactly. Above that, each power of 2 range is split into SUB_BUCKETS linear
+        buckets, so a value is reported with a relative error below 1 / SUB_BUCKETS.
+    """
+
+    SUB_BUCKET_BITS = 5
+    SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+
+    def __init__(self):
+        self.buckets = {}  # map from bucket index to count.
+
+    def add(self, value):
+        shift = max(0, value.bit_length() - self.SUB_BUCKET_BITS - 1)
+        index = shift * self.SUB_BUCKETS + (value >> shift)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    def get_bucket_range(self, index):
+        """ Return [low, high) of values in a bucket. """
+        if index < 2 * self.SUB_BUCKETS:
+            return index, index + 1
+        shift = index // self.SUB_BUCKETS - 1
+        top = index - shift * self.SUB_BUCKETS
+        return top << shift, (top + 1) << shift
+
+    def get_percentile(self, percentile, count):
+        """ Return the highest value in the bucket containing the percentile. """
+        target = max(1, int(math.ceil(count * percentile / 100.0)))
+        accumulated = 0
+        for index in sorted(self.buckets):
+            accumulated += self.buckets[index]
+            if accumulated >= target:
+                return self.get_bucket_range(index)[1] - 1
+        return 0
+
+    def to_json(self):
+        result = []
+        for index in sorted(self.buckets):
+            low, high = self.get_bucket_range(index)
+            result.append([low, high, self.buckets[index]])
+        return result
+
+
 class UnwindingTimes(object):
 
+    PERCENTILES = [50, 90, 99, 99.9]
+
     def __init__(self):
         self.total_time = 0
         self.count = 0
         self.max_time = 0
+        self.histogram = LatencyHistogram()
 
     def add_time(self, used_time):
         self.total_time += used_time
         self.count += 1
         self.max_time = max(self.max_time, used_time)
+        self.histogram.add(used_time)
+
+    def get_percentile(self, percentile):
+        return min(self.histogram.get_percentile(percentile, self.count), self.max_time)
+
+    def get_percentiles_str(self):
+        return ', '.join('p%s %f us' % (p, self.get_percentile(p) / 1e3)
+                         for p in self.PERCENTILES)
+
+    def to_json(self):
+        return {
+            'count': self.count,
+            'total_time': self.total_time,
+            'max_time': self.max_time,
+            'percentiles': collections.OrderedDict(
+                ('p%s' % p, self.get_percentile(p)) for p in self.PERCENTILES),
+            'histogram': self.histogram.to_json(),
+        }
 
 
 class UnwindingMemConsumption(object):
@@ -225,11 +315,18 @@ class UnwindingResultErrorReport(object):
         self.omit_callchains_fixed_by_joiner = omit_callchains_fixed_by_joiner
         self.process_maps = ProcessMaps()
         self.unwinding_times = UnwindingTimes()
+        # Unwinding times grouped by dso of the leaf frame, and by stop reason.
+        self.unwinding_times_per_dso = collections.defaultdict(UnwindingTimes)
+        self.unwinding_times_per_stop_reason = collections.defaultdict(UnwindingTimes)
         self.mem_stat = UnwindingMemConsumption()
         self.file_results = {}  # map from filename to FileResult.
 
     def add_sample_result(self, sample_result, joined_record):
-        self.unwinding_times.add_time(int(sample_result.unwinding_result['used_time']))
+        used_time = int(sample_result.unwinding_result['used_time'])
+        self.unwinding_times.add_time(used_time)
+        self.unwinding_times_per_dso[sample_result.callchain[0].filename].add_time(used_time)
+        self.unwinding_times_per_stop_reason[
+            sample_result.unwinding_result['stop_reason']].add_time(used_time)
         if self.should_omit(sample_result, joined_record):
             return
         filename = sample_result.callchain[-1].filename
@@ -277,6 +374,14 @@ class UnwindingResultErrorReport(object):
             print('  average time: %f us' % (
                 self.unwinding_times.total_time / 1e3 / self.unwinding_times.count))
         print('  max time: %f us' % (self.unwinding_times.max_time / 1e3))
+        if self.unwinding_times.count > 0:
+            print('  percentiles: %s' % self.unwinding_times.get_percentiles_str())
+        for name, times_dict in [('stop reason', self.unwinding_times_per_stop_reason),
+                                 ('leaf dso', self.unwinding_times_per_dso)]:
+            for key, times in sorted(times_dict.items(), key=lambda x: x[1].total_time,
+                                     reverse=True):
+                print('  %s %s: count %d, total time %f ms, %s' % (
+                    name, key, times.count, times.total_time / 1e6, times.get_percentiles_str()))
         print('Unwinding mem info:')
         for items in zip(self.mem_stat.before_unwinding, self.mem_stat.after_unwinding):
             assert items[0][0] == items[1][0]
@@ -288,6 +393,19 @@ class UnwindingResultErrorReport(object):
             self.file_results[filename].show()
             print('\n')
 
+    def write_unwinding_times_json(self, path):
+        """ Write unwinding times, with histograms and percentiles, in json format. Times
+            are in ns.
+        """
+        data = collections.OrderedDict()
+        data['all'] = self.unwinding_times.to_json()
+        data['per_stop_reason'] = {key: times.to_json() for key, times in
+                                   self.unwinding_times_per_stop_reason.items()}
+        data['per_leaf_dso'] = {key: times.to_json() for key, times in
+                                self.unwinding_times_per_dso.items()}
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=2)
+
 
 class CallChainRecord(object):
     """ Store data of a callchain record. """
@@ -297,21 +415,36 @@ class CallChainRecord(object):
         self.tid = None
         self.callchain = []
 
-def parse_sample_record(lines, i):
+def iter_dump_records(lines):
+    """ Split lines of the dump output into records, and yield (line number, lines) of each
+        record. A record starts with a line that is not indented, followed by indented or
+        empty lines. Only lines of one record are kept in memory.
+    """
+    record_lines = None
+    start_line = 0
+    for line_number, line in enumerate(lines, 1):
+        line = bytes_to_str(line).rstrip('\r\n')
+        if line and not line.startswith(' '):
+            if record_lines:
+                yield start_line, record_lines
+            record_lines = [line]
+            start_line = line_number
+        elif record_lines is not None:
+            record_lines.append(line)
+    if record_lines:
+        yield start_line, record_lines
+
+def parse_sample_record(record):
     """ Read the lines belong to a SampleRecord."""
-    if i == len(lines) or not lines[i].startswith('record sample:'):
-        log_fatal('unexpected dump output near line %d' % i)
-    start_line = i
-    i += 1
-    while i < len(lines) and (not lines[i] or lines[i].startswith(' ')):
-        i += 1
-    return i, lines[start_line:i]
-
-def parse_callchain_record(lines, i, chain_type, process_maps):
-    if i == len(lines) or not lines[i].startswith('record callchain:'):
-        log_fatal('unexpected dump output near line %d' % i)
-    i += 1
-    record = CallChainRecord()
+    if record is None or not record[1][0].startswith('record sample:'):
+        log_fatal('unexpected dump output near line %d' % (record[0] if record else -1))
+    return record[1]
+
+def parse_callchain_record(record, chain_type, process_maps):
+    if record is None or not record[1][0].startswith('record callchain:'):
+        log_fatal('unexpected dump output near line %d' % (record[0] if record else -1))
+    start_line, lines = record
+    callchain_record = CallChainRecord()
     ips = []
     sps = []
     function_names = []
@@ -320,19 +453,18 @@ def parse_callchain_record(lines, i, chain_type, process_maps):
     map_start_addrs = []
     map_end_addrs = []
     in_callchain = False
-    while i < len(lines) and not lines[i].startswith('record'):
+    for i in range(1, len(lines)):
         line = lines[i].strip()
         items = line.split()
         if not items:
-            i += 1
             continue
         if items[0] == 'pid' and len(items) == 2:
-            record.pid = int(items[1])
+            callchain_record.pid = int(items[1])
         elif items[0] == 'tid' and len(items) == 2:
-            record.tid = int(items[1])
+            callchain_record.tid = int(items[1])
         elif items[0] == 'chain_type' and len(items) == 2:
             if items[1] != chain_type:
-                log_fatal('unexpected dump output near line %d' % i)
+                log_fatal('unexpected dump output near line %d' % (start_line + i))
         elif items[0] == 'ip':
             m = re.search(r'ip\s+0x(\w+),\s+sp\s+0x(\w+)$', line)
             if m:
@@ -353,10 +485,9 @@ def parse_callchain_record(lines, i, chain_type, process_maps):
                     function_names.append(line[:break_pos].strip())
                     filenames.append(m.group(1))
                     vaddr_in_files.append(int(m.group(2), 16))
-        i += 1
 
     for ip in ips:
-        map_entry = process_maps.find(record.pid, ip)
+        map_entry = process_maps.find(callchain_record.pid, ip)
         if map_entry:
             map_start_addrs.append(map_entry.start)
             map_end_addrs.append(map_entry.end)
@@ -364,94 +495,106 @@ def parse_callchain_record(lines, i, chain_type, process_maps):
             map_start_addrs.append(0)
             map_end_addrs.append(0)
     n = len(ips)
-    if (None in [record.pid, record.tid] or n == 0 or len(sps) != n or
+    if (None in [callchain_record.pid, callchain_record.tid] or n == 0 or len(sps) != n or
             len(function_names) != n or len(filenames) != n or len(vaddr_in_files) != n or
             len(map_start_addrs) != n or len(map_end_addrs) != n):
-        log_fatal('unexpected dump output near line %d' % i)
+        log_fatal('unexpected dump output near line %d' % start_line)
     for j in range(n):
-        record.callchain.append(CallChainNode(ips[j], sps[j], filenames[j], vaddr_in_files[j],
-                                              function_names[j], map_start_addrs[j],
-                                              map_end_addrs[j]))
-    return i, record
+        callchain_record.callchain.append(CallChainNode(
+            ips[j], sps[j], filenames[j], vaddr_in_files[j], function_names[j],
+            map_start_addrs[j], map_end_addrs[j]))
+    return callchain_record
 
 
 def build_unwinding_result_report(args):
     simpleperf_path = get_host_binary_path('simpleperf')
     proc = subprocess.Popen([simpleperf_path, 'dump', args.record_file[0]],
                             stdout=subprocess.PIPE)
-    (stdoutdata, _) = proc.communicate()
-    stdoutdata = bytes_to_str(stdoutdata)
-    if 'debug_unwind = true' not in stdoutdata:
+    try:
+        unwinding_report = parse_dump_output(proc.stdout, args)
+    except BaseException:
+        # Don't leave simpleperf running when parsing stops in the middle of the output.
+        proc.kill()
+        raise
+    finally:
+        proc.stdout.close()
+        proc.wait()
+    if unwinding_report is None:
         log_exit("Can't parse unwinding result. Because " +
                  "%s was not generated by the debug-unwind cmd." % args.record_file[0])
+    return unwinding_report
+
+
+def parse_dump_output(lines, args):
+    """ Parse lines of the dump output one record at a time. Return None if the recording
+        file wasn't generated by the debug-unwind cmd.
+    """
     unwinding_report = UnwindingResultErrorReport(args.omit_callchains_fixed_by_joiner)
     process_maps = unwinding_report.process_maps
-    lines = stdoutdata.split('\n')
-    i = 0
-    while i < len(lines):
-        if lines[i].startswith('record mmap:') or lines[i].startswith('record mmap2:'):
-            i += 1
+    is_debug_unwind = False
+    records = iter_dump_records(lines)
+    for start_line, record_lines in records:
+        header = record_lines[0]
+        if header.startswith('record mmap:') or header.startswith('record mmap2:'):
             pid = None
             start = None
             end = None
             filename = None
-            while i < len(lines) and not lines[i].startswith('record'):
-                if lines[i].startswith('  pid'):
-                    m = re.search(r'pid\s+(\d+).+addr\s+0x(\w+).+len\s+0x(\w+)', lines[i])
+            for line in record_lines[1:]:
+                if line.startswith('  pid'):
+                    m = re.search(r'pid\s+(\d+).+addr\s+0x(\w+).+len\s+0x(\w+)', line)
                     if m:
                         pid = int(m.group(1))
                         start = int(m.group(2), 16)
                         end = start + int(m.group(3), 16)
-                elif 'filename' in lines[i]:
-                    pos = lines[i].find('filename') + len('filename')
-                    filename = lines[i][pos:].strip()
-                i += 1
+                elif 'filename' in line:
+                    pos = line.find('filename') + len('filename')
+                    filename = line[pos:].strip()
             if None in [pid, start, end, filename]:
-                log_fatal('unexpected dump output near line %d' % i)
+                log_fatal('unexpected dump output near line %d' % start_line)
             process_maps.add(pid, MapEntry(start, end, filename))
-        elif lines[i].startswith('record unwinding_result:'):
-            i += 1
+        elif header.startswith('record unwinding_result:'):
             unwinding_result = collections.OrderedDict()
-            while i < len(lines) and not lines[i].startswith('record'):
-                strs = (lines[i].strip()).split()
+            for line in record_lines[1:]:
+                strs = line.strip().split()
                 if len(strs) == 2:
                     unwinding_result[strs[0]] = strs[1]
-                i += 1
             for key in ['time', 'used_time', 'stop_reason']:
                 if key not in unwinding_result:
-                    log_fatal('unexpected dump output near line %d' % i)
+                    log_fatal('unexpected dump output near line %d' % start_line)
 
-            i, sample_record = parse_sample_record(lines, i)
-            i, original_record = parse_callchain_record(lines, i, 'ORIGINAL_OFFLINE', process_maps)
-            i, joined_record = parse_callchain_record(lines, i, 'JOINED_OFFLINE', process_maps)
+            sample_record = parse_sample_record(next(records, None))
+            original_record = parse_callchain_record(next(records, None), 'ORIGINAL_OFFLINE',
+                                                     process_maps)
+            joined_record = parse_callchain_record(next(records, None), 'JOINED_OFFLINE',
+                                                   process_maps)
             if args.omit_sample:
                 sample_record = []
             sample_result = SampleResult(original_record.pid, original_record.tid,
                                          unwinding_result, original_record.callchain,
                                          sample_record)
             unwinding_report.add_sample_result(sample_result, joined_record)
-        elif lines[i].startswith('record fork:'):
-            i += 1
+        elif header.startswith('record fork:'):
             pid = None
             ppid = None
-            while i < len(lines) and not lines[i].startswith('record'):
-                if lines[i].startswith('  pid'):
-                    m = re.search(r'pid\s+(\w+),\s+ppid\s+(\w+)', lines[i])
+            for line in record_lines[1:]:
+                if line.startswith('  pid'):
+                    m = re.search(r'pid\s+(\w+),\s+ppid\s+(\w+)', line)
                     if m:
                         pid = int(m.group(1))
                         ppid = int(m.group(2))
-                i += 1
             if None in [pid, ppid]:
-                log_fatal('unexpected dump output near line %d' % i)
+                log_fatal('unexpected dump output near line %d' % start_line)
             process_maps.fork_pid(pid, ppid)
-        elif lines[i].startswith('    debug_unwind_mem'):
-            items = lines[i].strip().split(' = ')
-            if len(items) == 2:
-                unwinding_report.add_mem_stat(items[0], items[1])
-            i += 1
         else:
-            i += 1
-    return unwinding_report
+            for line in record_lines:
+                if 'debug_unwind = true' in line:
+                    is_debug_unwind = True
+                elif line.startswith('    debug_unwind_mem'):
+                    items = line.strip().split(' = ')
+                    if len(items) == 2:
+                        unwinding_report.add_mem_stat(items[0], items[1])
+    return unwinding_report if is_debug_unwind else None
 
 
 def main():
@@ -463,9 +606,13 @@ def main():
                         Don't show incomplete callchains fixed by callchain joiner.""")
     parser.add_argument('--omit-sample', action='store_true', help="""Don't show original sample
                         records.""")
+    parser.add_argument('--unwinding-time-json', help="""Write histograms and percentiles of
+                        unwinding times to a json file.""")
     args = parser.parse_args()
     report = build_unwinding_result_report(args)
     report.show()
+    if args.unwinding_time_json:
+        report.write_unwinding_times_json(args.unwinding_time_json)
 
 if __name__ == '__main__':
     main()
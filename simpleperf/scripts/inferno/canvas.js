@@ -0,0 +1,279 @@
+/*
+ * Copyright (C) 2026 The Android Open Source Project
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *      http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+'use strict';
+
+// Draw flamegraphs generated by canvas_renderer.py. Each flamegraph block contains a canvas
+// element and a json script element. Call sites are stored in a packed int array in
+// depth-first order, with fields defined below.
+const NODE_ID = 0;
+const NODE_DEPTH = 1;
+const NODE_OFFSET = 2;
+const NODE_WIDTH = 3;
+const NODE_METHOD = 4;
+const NODE_DSO = 5;
+
+const NODE_HEIGHT = 17;
+const RECT_HEIGHT = 15;
+const FONT_SIZE = 12;
+const MIN_TEXT_WIDTH = 28;
+const CHAR_WIDTH = 7.5;
+
+function flamegraphInit() {
+    let blocks = document.getElementsByClassName('flamegraph_canvas_block');
+    let flamegraphs = [];
+    for (let i = 0; i < blocks.length; ++i) {
+        flamegraphs.push(new CanvasFlamegraph(blocks[i]));
+    }
+
+    function throttle(callback) {
+        let running = false;
+        return function() {
+            if (!running) {
+                running = true;
+                window.requestAnimationFrame(function () {
+                    callback();
+                    running = false;
+                });
+            }
+        };
+    }
+    window.addEventListener('resize', throttle(function() {
+        for (let flamegraph of flamegraphs) {
+            flamegraph.draw();
+        }
+    }));
+}
+
+function hashToFloat(s) {
+    let hash = 0;
+    for (let i = 0; i < s.length; ++i) {
+        hash = (hash * 31 + s.charCodeAt(i)) | 0;
+    }
+    return (hash >>> 0) / 4294967296;
+}
+
+function reverseString(s) {
+    return s.split('').reverse().join('');
+}
+
+function getProperScaledTimeString(value) {
+    if (value >= 1e9) {
+        return (value / 1e9).toFixed(3) + ' s';
+    }
+    if (value >= 1e6) {
+        return (value / 1e6).toFixed(3) + ' ms';
+    }
+    if (value >= 1e3) {
+        return (value / 1e3).toFixed(3) + ' us';
+    }
+    return value.toFixed(0) + ' ns';
+}
+
+class CanvasFlamegraph {
+    constructor(block) {
+        let data = JSON.parse(block.getElementsByTagName('script')[0].textContent);
+        this.fields = data.nodeFields;
+        this.nodes = data.nodes;
+        this.nodeCount = this.nodes.length / this.fields;
+        this.strings = data.strings;
+        this.totalWeight = data.totalWeight;
+        this.height = data.height;
+        this.colorScheme = data.colorScheme;
+        this.traceOffcpu = data.traceOffcpu;
+        this.diffRatios = data.diffRatios;
+        this.canvas = block.getElementsByTagName('canvas')[0];
+        this.zoomOutButton = block.getElementsByClassName('zoom_out_button')[0];
+        this.percentText = block.getElementsByClassName('percent_text')[0];
+        this.infoText = block.getElementsByClassName('info_text')[0];
+        this.zoomStack = [];  // Indexes of zoomed in call sites.
+        this.searchTerm = '';
+        this.buildSubtreeEnds();
+
+        this.canvas.addEventListener('click', (e) => this.onClick(e));
+        this.canvas.addEventListener('mousemove', (e) => this.onMouseMove(e));
+        this.zoomOutButton.addEventListener('click', () => this.zoomOut());
+        block.getElementsByClassName('search_button')[0].addEventListener(
+            'click', () => this.search());
+        this.draw();
+    }
+
+    // subtreeEnds[i] is the index after the last call site in the subtree of call site i. It is
+    // used to skip subtrees narrower than a pixel, or not containing the mouse position.
+    buildSubtreeEnds() {
+        this.subtreeEnds = new Int32Array(this.nodeCount);
+        let stack = [];
+        for (let i = 0; i < this.nodeCount; ++i) {
+            let depth = this.getField(i, NODE_DEPTH);
+            while (stack.length > 0 &&
+                   this.getField(stack[stack.length - 1], NODE_DEPTH) >= depth) {
+                this.subtreeEnds[stack.pop()] = i;
+            }
+            stack.push(i);
+        }
+        for (let i of stack) {
+            this.subtreeEnds[i] = this.nodeCount;
+        }
+    }
+
+    getField(i, field) {
+        return this.nodes[i * this.fields + field];
+    }
+
+    // Return the range of call sites shown in current zoom level.
+    getView() {
+        if (this.zoomStack.length == 0) {
+            return {start: 0, end: this.nodeCount, offset: 0, width: this.totalWeight, depth: 0};
+        }
+        let i = this.zoomStack[this.zoomStack.length - 1];
+        return {start: i, end: this.subtreeEnds[i], offset: this.getField(i, NODE_OFFSET),
+                width: this.getField(i, NODE_WIDTH), depth: this.getField(i, NODE_DEPTH)};
+    }
+
+    getColor(i) {
+        let method = this.strings[this.getField(i, NODE_METHOD)];
+        if (this.searchTerm && (method.indexOf(this.searchTerm) != -1 ||
+                this.strings[this.getField(i, NODE_DSO)].indexOf(this.searchTerm) != -1)) {
+            return [230, 100, 230];
+        }
+        if (this.diffRatios) {
+            // Red for call sites taking more share of events than in the baseline, blue for
+            // less.
+            let ratio = this.diffRatios[i];
+            if (ratio >= 0) {
+                return [255, Math.floor(255 - 200 * ratio), Math.floor(255 - 200 * ratio)];
+            }
+            return [Math.floor(255 + 200 * ratio), Math.floor(255 + 200 * ratio), 255];
+        }
+        if (this.colorScheme == 'dso') {
+            let dso = this.strings[this.getField(i, NODE_DSO)];
+            return [170 + Math.floor(80 * hashToFloat(reverseString(dso))),
+                    180 + Math.floor(70 * hashToFloat(dso)),
+                    170 + Math.floor(80 * hashToFloat(reverseString(dso)))];
+        }
+        if (this.colorScheme == 'legacy') {
+            return [175 + Math.floor(50 * hashToFloat(reverseString(method))),
+                    60 + Math.floor(180 * hashToFloat(method)),
+                    60 + Math.floor(55 * hashToFloat(reverseString(method)))];
+        }
+        let ratio = 1 - this.getField(i, NODE_WIDTH) / this.totalWeight;
+        return [245 + 10 * ratio, 110 + 105 * ratio, 100];
+    }
+
+    draw() {
+        let canvas = this.canvas;
+        let pixelRatio = window.devicePixelRatio || 1;
+        let width = canvas.parentElement.clientWidth - 2;
+        canvas.style.width = width + 'px';
+        canvas.style.height = this.height + 'px';
+        canvas.width = width * pixelRatio;
+        canvas.height = this.height * pixelRatio;
+        let ctx = canvas.getContext('2d');
+        ctx.setTransform(pixelRatio, 0, 0, pixelRatio, 0, 0);
+        let gradient = ctx.createLinearGradient(0, 0, 0, this.height);
+        gradient.addColorStop(0.05, '#eeeeee');
+        gradient.addColorStop(0.9, '#efefb1');
+        ctx.fillStyle = gradient;
+        ctx.fillRect(0, 0, width, this.height);
+        ctx.font = FONT_SIZE + 'px Monospace';
+        ctx.textBaseline = 'middle';
+
+        let view = this.getView();
+        let scale = width / view.width;
+        for (let i = view.start; i < view.end; ++i) {
+            let rectWidth = this.getField(i, NODE_WIDTH) * scale;
+            if (rectWidth < 1) {
+                // Children are not wider than their parent.
+                i = this.subtreeEnds[i] - 1;
+                continue;
+            }
+            let x = (this.getField(i, NODE_OFFSET) - view.offset) * scale;
+            let y = this.height - (this.getField(i, NODE_DEPTH) - view.depth + 1) * NODE_HEIGHT;
+            let [r, g, b] = this.getColor(i);
+            ctx.fillStyle = `rgb(${r},${g},${b})`;
+            ctx.fillRect(x, y, rectWidth, RECT_HEIGHT);
+            ctx.strokeStyle = `rgb(${Math.max(0, r - 50)},${Math.max(0, g - 50)},` +
+                              `${Math.max(0, b - 50)})`;
+            ctx.strokeRect(x, y, rectWidth, RECT_HEIGHT);
+            if (rectWidth >= MIN_TEXT_WIDTH) {
+                let method = this.strings[this.getField(i, NODE_METHOD)];
+                let numCharacters = Math.floor(rectWidth / CHAR_WIDTH);
+                if (numCharacters < method.length) {
+                    method = method.substring(0, Math.max(2, numCharacters - 2)) + '..';
+                }
+                ctx.fillStyle = 'black';
+                ctx.fillText(method, x + 3, y + RECT_HEIGHT / 2);
+            }
+        }
+    }
+
+    // Return the index of the call site at the mouse position, or -1 if not found.
+    findNode(e) {
+        let rect = this.canvas.getBoundingClientRect();
+        let view = this.getView();
+        let offset = view.offset + (e.clientX - rect.left) / rect.width * view.width;
+        let depth = view.depth + Math.floor((this.height - (e.clientY - rect.top)) / NODE_HEIGHT);
+        let i = view.start;
+        while (i < view.end) {
+            let nodeOffset = this.getField(i, NODE_OFFSET);
+            if (offset < nodeOffset || offset >= nodeOffset + this.getField(i, NODE_WIDTH)) {
+                i = this.subtreeEnds[i];
+            } else if (this.getField(i, NODE_DEPTH) == depth) {
+                return i;
+            } else {
+                i++;
+            }
+        }
+        return -1;
+    }
+
+    onClick(e) {
+        let i = this.findNode(e);
+        if (i != -1) {
+            this.zoomStack.push(i);
+            this.zoomOutButton.style.display = 'inline';
+            this.draw();
+        }
+    }
+
+    zoomOut() {
+        this.zoomStack.pop();
+        if (this.zoomStack.length == 0) {
+            this.zoomOutButton.style.display = 'none';
+        }
+        this.draw();
+    }
+
+    search() {
+        this.searchTerm = prompt('Search for:', '') || '';
+        this.draw();
+    }
+
+    onMouseMove(e) {
+        let i = this.findNode(e);
+        if (i == -1) {
+            this.infoText.textContent = '';
+            return;
+        }
+        let weight = this.getField(i, NODE_WIDTH);
+        let weightStr = this.traceOffcpu ? getProperScaledTimeString(weight) :
+                                           weight.toLocaleString() + ' events';
+        let percent = (weight / this.totalWeight * 100).toFixed(2) + '%';
+        this.percentText.textContent = percent;
+        this.infoText.textContent = this.strings[this.getField(i, NODE_METHOD)] + ' | ' +
+                                    this.strings[this.getField(i, NODE_DSO)] + ' (' +
+                                    weightStr + ': ' + percent + ')';
+    }
+}
@@ -0,0 +1,88 @@
+#
+# Copyright (C) 2026 The Android Open Source Project
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""canvas_renderer.py: render flamegraphs as compact json data, which is drawn on canvas
+   elements by canvas.js. Compared with svg_renderer.py, it doesn't create DOM elements for
+   call sites, so huge flamegraphs load and zoom fast.
+"""
+
+import json
+
+from svg_renderer import SVG_NODE_HEIGHT
+
+# Fields of a call site in the packed node array, in order: id, depth, offset, width (event
+# count), method string id, dso string id.
+NODE_FIELDS = 6
+
+
+def gen_canvas_data(process, flamegraph, color_scheme):
+    """ Return json data of a flamegraph. Call sites are stored in a flat int array in
+        depth-first order, so the subtree of a call site is the following call sites with
+        bigger depths. Method and dso names are stored in a string table.
+    """
+    strings = []
+    string_ids = {}
+
+    def get_string_id(string):
+        string_id = string_ids.get(string)
+        if string_id is None:
+            string_id = string_ids[string] = len(strings)
+            strings.append(string)
+        return string_id
+
+    nodes = []
+    # Compared with a baseline recording, nodes are colored by Process.get_diff_ratio().
+    diff_ratios = [] if process.baseline_events is not None else None
+    stack = [(child, 0) for child in reversed(flamegraph.children)]
+    while stack:
+        callsite, depth = stack.pop()
+        if callsite.num_events <= 0:
+            continue
+        nodes.extend((callsite.id, depth, callsite.offset, callsite.num_events,
+                      get_string_id(callsite.method), get_string_id(callsite.dso)))
+        if diff_ratios is not None:
+            diff_ratios.append(round(process.get_diff_ratio(callsite), 3))
+        stack.extend((child, depth + 1) for child in reversed(callsite.children))
+    data = {
+        'nodeFields': NODE_FIELDS,
+        'nodes': nodes,
+        'strings': strings,
+        'totalWeight': flamegraph.num_events,
+        'height': (flamegraph.get_max_depth() + 2) * SVG_NODE_HEIGHT,
+        'colorScheme': color_scheme,
+        'traceOffcpu': bool(process.props['trace_offcpu']),
+    }
+    if diff_ratios is not None:
+        data['diffRatios'] = diff_ratios
+    return data
+
+
+def render_canvas(process, flamegraph, f, color_scheme):
+    data = json.dumps(gen_canvas_data(process, flamegraph, color_scheme),
+                      separators=(',', ':'))
+    # Avoid ending the script element early.
+    data = data.replace('</', '<\\/')
+    f.write("""<div class="flamegraph_canvas_block">
+            <div class="flamegraph_canvas_toolbar">
+            <button class="zoom_out_button" style="display:none;">Zoom out</button>
+            <button class="search_button">Search</button>
+            <span class="percent_text">100.00%</span>
+            <span class="info_text"></span>
+            </div>
+            <canvas style="border: 1px solid black;"></canvas>
+            <script type="application/json">""")
+    f.write(data)
+    f.write("</script></div><br/>\n\n")
@@ -14,38 +14,147 @@
 # limitations under the License.
 #
 
+from utils import ONLINE_PRUNING_ERROR_RATIO
 
-class CallSite(object):
+# Don't prune before this count of call sites are created since last pruning.
+ONLINE_PRUNING_MIN_NEW_CALLSITES = 10000
 
-    def __init__(self, method, dso):
-        self.method = method
-        self.dso = dso
+# Kernel functions switching a thread off cpu.
+SCHEDULER_FUNCTIONS = {'__schedule', 'schedule', '__switch_to', 'schedule_timeout',
+                       'io_schedule', 'preempt_schedule', 'preempt_schedule_common'}
+
+
+class CallSiteTable(object):
+    """ Intern call sites of a process: map each (dso, method) pair to an int key. Call site
+        nodes are keyed by ints, and share the method and dso strings kept in the table.
+    """
+
+    def __init__(self):
+        self.key_dicts = {}  # map from dso to a map from method to key.
+        self.methods = []
+        self.dsos = []
+
+    def get_key(self, dso, method):
+        key_dict = self.key_dicts.get(dso)
+        if key_dict is None:
+            key_dict = self.key_dicts[dso] = {}
+        key = key_dict.get(method)
+        if key is None:
+            key = key_dict[method] = len(self.methods)
+            self.methods.append(method)
+            self.dsos.append(dso)
+        return key
+
+    def find_key(self, dso, method):
+        """ Return the key of a call site, or None if it isn't in the table. """
+        key_dict = self.key_dicts.get(dso)
+        return key_dict.get(method) if key_dict is not None else None
+
+
+class OffCpuBreakdown(object):
+    """ Split time of threads into on-cpu and off-cpu time, and rank call sites where threads
+        block by their total wait time. Used for recordings generated with --trace-offcpu,
+        where the report lib sets the period of a sample to the difference between its timestamp
+        and the timestamp of the next sample of the same thread. So periods are used as wait
+        times, and they must not be scaled by sampling options like --sample_rate.
+
+        The report lib doesn't tell whether a sample was taken on a context switch. So a sample
+        is considered as blocking when a scheduler function is in its kernel callchain, or its
+        period is at least min_wait_ns, which should be bigger than the interval of on-cpu
+        samples. Its blocking call site is the innermost frame not in the kernel.
+    """
+
+    def __init__(self, callsite_table, min_wait_ns):
+        self.callsite_table = callsite_table
+        self.min_wait_ns = min_wait_ns
+        self.thread_times = {}  # map from tid to [thread name, on-cpu time, off-cpu time]
+        self.callsite_waits = {}  # map from call site key to [wait time, count, max wait time]
+
+    @staticmethod
+    def is_kernel_dso(dso):
+        return dso.startswith('[kernel') or dso.endswith('.ko')
+
+    def add_sample(self, sample, symbol, callchain):
+        blocked = sample.period >= self.min_wait_ns
+        blocking_symbol = None
+        for i in range(-1, callchain.nr):
+            frame = symbol if i == -1 else callchain.entries[i].symbol
+            if self.is_kernel_dso(frame.dso_name):
+                if frame.symbol_name in SCHEDULER_FUNCTIONS:
+                    blocked = True
+            else:
+                blocking_symbol = frame
+                break
+        times = self.thread_times.get(sample.tid)
+        if times is None:
+            times = self.thread_times[sample.tid] = [sample.thread_comm, 0, 0]
+        if not blocked:
+            times[1] += sample.period
+            return
+        times[2] += sample.period
+        if blocking_symbol is None:
+            blocking_symbol = symbol
+        key = self.callsite_table.get_key(blocking_symbol.dso_name, blocking_symbol.symbol_name)
+        wait = self.callsite_waits.get(key)
+        if wait is None:
+            wait = self.callsite_waits[key] = [0, 0, 0]
+        wait[0] += sample.period
+        wait[1] += 1
+        wait[2] = max(wait[2], sample.period)
+
+    def get_top_callsites(self, count):
+        """ Return [(method, dso, wait time, wait count, max wait time)] of the call sites
+            with the most wait time.
+        """
+        keys = sorted(self.callsite_waits, key=lambda k: self.callsite_waits[k][0],
+                      reverse=True)[:count]
+        return [(self.callsite_table.methods[key], self.callsite_table.dsos[key]) +
+                tuple(self.callsite_waits[key]) for key in keys]
 
 
 class Thread(object):
 
-    def __init__(self, tid, pid):
+    def __init__(self, tid, pid, callsite_table):
         self.tid = tid
         self.pid = pid
         self.name = ""
         self.samples = []
+        self.callsite_table = callsite_table
         self.flamegraph = FlameGraphCallSite("root", "", 0)
         self.num_samples = 0
         self.num_events = 0
+        # If not zero, call sites are pruned while adding callchains. See Process.prune().
+        self.pruning_ratio = 0.0
 
     def add_callchain(self, callchain, symbol, sample):
         self.name = sample.thread_comm
         self.num_samples += 1
         self.num_events += sample.period
-        chain = []
-        for j in range(callchain.nr):
-            entry = callchain.entries[callchain.nr - j - 1]
+        get_key = self.callsite_table.get_key
+        keys = []
+        for j in range(callchain.nr - 1, -1, -1):
+            entry = callchain.entries[j]
             if entry.ip == 0:
                 continue
-            chain.append(CallSite(entry.symbol.symbol_name, entry.symbol.dso_name))
+            keys.append(get_key(entry.symbol.dso_name, entry.symbol.symbol_name))
+
+        keys.append(get_key(symbol.dso_name, symbol.symbol_name))
+        self.flamegraph.add_callchain(keys, sample.period, self.callsite_table,
+                                      self.get_pruning_limit())
+
+    def get_pruning_limit(self):
+        return self.num_events * self.pruning_ratio
 
-        chain.append(CallSite(symbol.symbol_name, symbol.dso_name))
-        self.flamegraph.add_callchain(chain, sample.period)
+
+class TimeBucket(Thread):
+    """ Samples of all threads in a time window [start_time, end_time), in nanoseconds
+        relative to the first sample.
+    """
+
+    def __init__(self, index, bucket_ns, callsite_table):
+        Thread.__init__(self, index, 0, callsite_table)
+        self.start_time = index * bucket_ns
+        self.end_time = self.start_time + bucket_ns
 
 
 class Process(object):
@@ -54,6 +163,7 @@ class Process(object):
         self.name = name
         self.pid = pid
         self.threads = {}
+        self.callsite_table = CallSiteTable()
         self.cmd = ""
         self.props = {}
         # num_samples is the count of samples recorded in the profiling file.
@@ -62,22 +172,156 @@ class Process(object):
         # count of events happened since last sample. If we use cpu-cycles event, the count
         # shows how many cpu-cycles have happened during recording.
         self.num_events = 0
+        self.pruning_ratio = 0.0
+        self.kept_callsites = 0
+        self.callsite_counter_at_pruning = 0
+        # If not zero, samples are added to time buckets instead of threads.
+        self.time_bucket_ns = 0
+        self.time_buckets = {}  # map from bucket index to TimeBucket
+        self.first_sample_time = None
+        self.offcpu_breakdown = None
+        # If not None, map from call site id to event count of the same call site in a baseline
+        # recording. See set_baseline().
+        self.baseline_events = None
+        self.baseline_num_events = 0
+
+    def enable_time_buckets(self, time_bucket_ns):
+        """ Split samples into time windows of time_bucket_ns, with a flamegraph for each
+            window instead of each thread. All windows are built in one pass over samples, and
+            share the call site table.
+        """
+        self.time_bucket_ns = time_bucket_ns
+
+    def enable_offcpu_breakdown(self, min_wait_ns):
+        """ Collect an OffCpuBreakdown while adding samples. """
+        self.offcpu_breakdown = OffCpuBreakdown(self.callsite_table, min_wait_ns)
+
+    def enable_online_pruning(self, min_callchain_percentage):
+        """ Remove call sites below min_callchain_percentage while adding samples, instead of
+            only in trim_callchain(). It bounds memory used by huge recordings, at the cost of
+            approximate results.
+
+            It is lossy counting (Manku & Motwani, 2002) on call sites of each thread: the limit
+            of a thread is pruning_ratio * its current num_events. A new call site gets
+            count_error = the current limit, as that many events of it could have been pruned
+            before. A call site and its subtree are pruned when num_events + count_error <=
+            the limit. So a kept call site has exact event count in [num_events, num_events +
+            limit], and a call site whose exact event count is more than the limit is never
+            pruned. With pruning_ratio = ONLINE_PRUNING_ERROR_RATIO * min_callchain_percentage%,
+            trim_callchain() only misses call sites with exact event counts in
+            [min_callchain_percentage%, (1 + ONLINE_PRUNING_ERROR_RATIO) *
+            min_callchain_percentage%) of the thread event count.
+        """
+        self.pruning_ratio = ONLINE_PRUNING_ERROR_RATIO * min_callchain_percentage * 0.01
+        for thread in self.get_flamegraph_threads():
+            thread.pruning_ratio = self.pruning_ratio
+
+    def get_flamegraph_threads(self):
+        """ Return objects owning flamegraphs: time buckets in time order if time buckets are
+            enabled, otherwise threads.
+        """
+        if self.time_bucket_ns:
+            return [self.time_buckets[key] for key in sorted(self.time_buckets)]
+        return list(self.threads.values())
 
     def get_thread(self, tid, pid):
         thread = self.threads.get(tid)
         if thread is None:
-            thread = self.threads[tid] = Thread(tid, pid)
+            thread = self.threads[tid] = Thread(tid, pid, self.callsite_table)
+            thread.pruning_ratio = self.pruning_ratio
         return thread
 
+    def set_baseline(self, baseline_num_events, baseline_tree):
+        """ Align call sites of a baseline recording with call sites of the only flamegraph of
+            this process, by (dso, method) paths. baseline_tree is returned by
+            FlameGraphCallSite.get_flat_tree(). Baseline call sites missing in this process are
+            ignored, as they have no space in the flamegraph. Should be called before
+            trim_callchain().
+        """
+        self.baseline_num_events = baseline_num_events
+        self.baseline_events = {}
+        threads = self.get_flamegraph_threads()
+        if not threads:
+            return
+        root = threads[0].flamegraph
+        self.baseline_events[root.id] = baseline_num_events
+        # path[i] is the matched call site at depth i - 1.
+        path = [root]
+        skip_depth = None
+        for depth, dso, method, num_events in baseline_tree:
+            if skip_depth is not None:
+                if depth > skip_depth:
+                    continue
+                skip_depth = None
+            del path[depth + 1:]
+            parent = path[depth]
+            key = self.callsite_table.find_key(dso, method)
+            child = None
+            if key is not None and parent.child_dict is not None:
+                child = parent.child_dict.get(key)
+            if child is None:
+                # Skip the subtree of the unmatched call site.
+                skip_depth = depth
+                continue
+            self.baseline_events[child.id] = num_events
+            path.append(child)
+
+    def get_diff_ratio(self, callsite):
+        """ Return the change of the call site's share of event count compared with the
+            baseline, normalized to [-1, 1]. 1 means the call site is new, -1 means it only
+            exists in the baseline.
+        """
+        share = float(callsite.num_events) / self.num_events if self.num_events else 0.0
+        baseline_events = self.baseline_events.get(callsite.id, 0)
+        baseline_share = (float(baseline_events) / self.baseline_num_events
+                          if self.baseline_num_events else 0.0)
+        max_share = max(share, baseline_share)
+        return (share - baseline_share) / max_share if max_share else 0.0
+
+    def get_time_bucket(self, time):
+        if self.first_sample_time is None:
+            self.first_sample_time = time
+        index = (time - self.first_sample_time) // self.time_bucket_ns
+        bucket = self.time_buckets.get(index)
+        if bucket is None:
+            bucket = self.time_buckets[index] = TimeBucket(index, self.time_bucket_ns,
+                                                           self.callsite_table)
+            bucket.pruning_ratio = self.pruning_ratio
+        return bucket
+
     def add_sample(self, sample, symbol, callchain):
-        thread = self.get_thread(sample.tid, sample.pid)
+        if self.time_bucket_ns:
+            thread = self.get_time_bucket(sample.time)
+        else:
+            thread = self.get_thread(sample.tid, sample.pid)
         thread.add_callchain(callchain, symbol, sample)
+        if self.offcpu_breakdown:
+            self.offcpu_breakdown.add_sample(sample, symbol, callchain)
         self.num_samples += 1
         # sample.period is the count of events happened since last sample.
         self.num_events += sample.period
+        if self.pruning_ratio:
+            # Prune when more call sites are created than kept, so the pruning cost is O(1)
+            # for each new call site.
+            new_callsites = (FlameGraphCallSite.callsite_counter -
+                             self.callsite_counter_at_pruning)
+            if new_callsites > max(self.kept_callsites, ONLINE_PRUNING_MIN_NEW_CALLSITES):
+                self.prune()
+
+    def prune(self):
+        self.kept_callsites = 0
+        for thread in self.get_flamegraph_threads():
+            self.kept_callsites += thread.flamegraph.prune(thread.get_pruning_limit())
+        self.callsite_counter_at_pruning = FlameGraphCallSite.callsite_counter
 
 
 class FlameGraphCallSite(object):
+    """ A node in the call site tree of a thread. Huge recordings create millions of nodes,
+        so nodes use __slots__, and containers are only created for nodes having children.
+    """
+
+    __slots__ = ['child_dict', 'children', 'method', 'dso', 'num_events', 'count_error',
+                 'offset', 'id']
 
     callsite_counter = 0
     @classmethod
@@ -86,51 +330,117 @@ class FlameGraphCallSite(object):
         return cls.callsite_counter
 
     def __init__(self, method, dso, callsite_id):
-        # map from (dso, method) to FlameGraphCallSite. Used to speed up add_callchain().
-        self.child_dict = {}
-        self.children = []
+        # map from CallSiteTable key to FlameGraphCallSite. Used to speed up add_callchain().
+        # It is None before adding the first child.
+        self.child_dict = None
+        # Children kept by trim_callchain().
+        self.children = ()
         self.method = method
         self.dso = dso
         self.num_events = 0
+        self.count_error = 0  # max underestimation of num_events by online pruning
         self.offset = 0  # Offset allows position nodes in different branches.
         self.id = callsite_id
 
     def weight(self):
         return float(self.num_events)
 
-    def add_callchain(self, chain, num_events):
+    def add_callchain(self, keys, num_events, callsite_table, count_error=0):
+        """ Add a callchain of CallSiteTable keys, from the outermost caller.
+            count_error is set to call sites created for the chain.
+        """
         self.num_events += num_events
         current = self
-        for callsite in chain:
-            current = current.get_child(callsite)
+        for key in keys:
+            current = current.get_child(key, callsite_table, count_error)
             current.num_events += num_events
 
-    def get_child(self, callsite):
-        key = (callsite.dso, callsite.method)
-        child = self.child_dict.get(key)
-        if child is None:
-            child = self.child_dict[key] = FlameGraphCallSite(callsite.method, callsite.dso,
-                                                              self._get_next_callsite_id())
+    def get_child(self, key, callsite_table, count_error=0):
+        if self.child_dict is None:
+            self.child_dict = {}
+        else:
+            child = self.child_dict.get(key)
+            if child is not None:
+                return child
+        child = self.child_dict[key] = FlameGraphCallSite(callsite_table.methods[key],
+                                                          callsite_table.dsos[key],
+                                                          self._get_next_callsite_id())
+        child.count_error = count_error
         return child
 
+    # Tree traversals below use explicit stacks instead of recursion, so deep callchains don't
+    # hit the recursion limit.
+
+    def get_flat_tree(self):
+        """ Return call sites in the subtree (excluding self) as a list of (depth, dso, method,
+            num_events) in depth-first order. It is cheap to pickle, as strings are shared by
+            call sites. Should be called before trim_callchain().
+        """
+        flat_tree = []
+        stack = [(self, -1)]
+        while stack:
+            callsite, depth = stack.pop()
+            if depth >= 0:
+                flat_tree.append((depth, callsite.dso, callsite.method, callsite.num_events))
+            if callsite.child_dict is not None:
+                stack.extend((child, depth + 1) for child in callsite.child_dict.values())
+        return flat_tree
+
+    def prune(self, limit):
+        """ Remove call sites with num_events + count_error <= limit in the subtree.
+            Return the count of call sites left in the subtree.
+        """
+        callsite_count = 0
+        stack = [self]
+        while stack:
+            callsite = stack.pop()
+            callsite_count += 1
+            if callsite.child_dict is None:
+                continue
+            for key in list(callsite.child_dict):
+                child = callsite.child_dict[key]
+                if child.num_events + child.count_error <= limit:
+                    del callsite.child_dict[key]
+                else:
+                    stack.append(child)
+        return callsite_count
+
     def trim_callchain(self, min_num_events):
         """ Remove call sites with num_events < min_num_events in the subtree.
             Remaining children are collected in a list.
         """
-        for key in self.child_dict:
-            child = self.child_dict[key]
-            if child.num_events >= min_num_events:
-                child.trim_callchain(min_num_events)
-                self.children.append(child)
-        # Relese child_dict since it will not be used.
-        self.child_dict = None
+        stack = [self]
+        while stack:
+            callsite = stack.pop()
+            if callsite.child_dict is None:
+                continue
+            children = [child for child in callsite.child_dict.values()
+                        if child.num_events >= min_num_events]
+            if children:
+                callsite.children = children
+                stack.extend(children)
+            # Relese child_dict since it will not be used.
+            callsite.child_dict = None
 
     def get_max_depth(self):
-        return max([c.get_max_depth() for c in self.children]) + 1 if self.children else 1
+        depth = 0
+        callsites = [self]
+        while callsites:
+            depth += 1
+            callsites = [child for callsite in callsites for child in callsite.children]
+        return depth
 
     def generate_offset(self, start_offset):
+        """ Place children of each call site side by side, starting at the offset of the
+            call site. Return the end offset of this call site.
+        """
         self.offset = start_offset
-        child_offset = start_offset
-        for child in self.children:
-            child_offset = child.generate_offset(child_offset)
+        stack = [self]
+        while stack:
+            callsite = stack.pop()
+            child_offset = callsite.offset
+            for child in callsite.children:
+                child.offset = child_offset
+                child_offset += child.num_events
+                stack.append(child)
         return self.offset + self.num_events
@@ -32,6 +32,7 @@
 
 import argparse
 import datetime
+import multiprocessing
 import os
 import subprocess
 import sys
@@ -40,10 +41,16 @@ import sys
 SCRIPTS_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 sys.path.append(SCRIPTS_PATH)
 from simpleperf_report_lib import ReportLib
-from utils import log_exit, log_info, AdbHelper, open_report_in_browser
+from utils import check_sampling_args, log_exit, log_info, AdbHelper, open_report_in_browser
 
+from canvas_renderer import render_canvas
 from data_types import Process
-from svg_renderer import get_proper_scaled_time_string, render_svg
+from svg_renderer import DEFAULT_MIN_NODE_WIDTH, get_proper_scaled_time_string, render_svg
+
+# Count of call sites shown in the off-cpu breakdown.
+OFFCPU_BREAKDOWN_TOP_CALLSITES = 50
+# Sample frequency used by `simpleperf record` without -f or -c options.
+DEFAULT_RECORD_SAMPLE_FREQUENCY = 4000
 
 
 def collect_data(args):
@@ -109,6 +116,10 @@ def parse_samples(process, args, sample_filter_fn):
         lib.SetKallsymsFile(kallsyms_file)
     if args.show_art_frames:
         lib.ShowArtFrames(True)
+    if args.sample_rate > 1:
+        lib.SetSampleRate(args.sample_rate)
+    if args.max_samples:
+        lib.SetMaxSamples(args.max_samples)
     process.cmd = lib.GetRecordCmd()
     product_props = lib.MetaInfo().get("product_props")
     if product_props:
@@ -118,11 +129,28 @@ def parse_samples(process, args, sample_filter_fn):
         process.props['ro.product.name'] = name
     if lib.MetaInfo().get('trace_offcpu') == 'true':
         process.props['trace_offcpu'] = True
-        if args.one_flamegraph:
-            log_exit("It doesn't make sense to report with --one-flamegraph for perf.data " +
-                     "recorded with --trace-offcpu.""")
+        if args.one_flamegraph or args.baseline:
+            log_exit("It doesn't make sense to report with --one-flamegraph or --baseline for " +
+                     "perf.data recorded with --trace-offcpu.")
     else:
         process.props['trace_offcpu'] = False
+    if args.offcpu_breakdown:
+        if not process.props['trace_offcpu']:
+            log_exit("--offcpu_breakdown needs perf.data recorded with --trace-offcpu.")
+        if args.offcpu_min_wait_us is not None:
+            min_wait_ns = int(args.offcpu_min_wait_us * 1e3)
+        else:
+            interval_ns = get_sample_interval_ns(process.cmd)
+            if interval_ns is None:
+                log_exit("Can't get the sample interval from the record cmd '%s'. " % process.cmd +
+                         "Please set --offcpu_min_wait_us.")
+            # Twice the interval of on-cpu samples.
+            min_wait_ns = int(2 * interval_ns)
+        process.enable_offcpu_breakdown(min_wait_ns)
+    if args.online_pruning:
+        process.enable_online_pruning(args.min_callchain_percentage)
+    if args.time_bucket_ms is not None:
+        process.enable_time_buckets(max(1, int(args.time_bucket_ms * 1e6)))
 
     while True:
         sample = lib.GetNextSample()
@@ -141,12 +169,79 @@ def parse_samples(process, args, sample_filter_fn):
             process.name = main_threads[0].name
             process.pid = main_threads[0].pid
 
-    for thread in process.threads.values():
+    log_info("Parsed %s callchains." % process.num_samples)
+
+
+def get_sample_interval_ns(record_cmd):
+    """ Return the interval in ns between on-cpu samples of a thread, set by -f or -c options
+        in the record cmd. Return None if it is unknown, like when the record cmd isn't
+        recorded, or -c is used with an event not counting time.
+    """
+    args = record_cmd.split()
+    if not args:
+        return None
+    interval_ns = 1e9 / DEFAULT_RECORD_SAMPLE_FREQUENCY
+    for i in range(len(args) - 1):
+        try:
+            if args[i] == '-f':
+                interval_ns = 1e9 / float(args[i + 1])
+            elif args[i] == '-c':
+                event_index = args.index('-e') if '-e' in args else -1
+                if event_index == -1 or args[event_index + 1] not in ('cpu-clock', 'task-clock'):
+                    return None
+                # Event counts of cpu-clock and task-clock are in ns.
+                interval_ns = float(args[i + 1])
+        except (ValueError, ZeroDivisionError, IndexError):
+            return None
+    return interval_ns
+
+
+def get_one_flamegraph_filter(process):
+    """ Return a sample filter putting samples of all threads in one flamegraph. """
+    def filter_fn(sample, _symbol, _callchain):
+        sample.pid = sample.tid = process.pid
+        return True
+    return filter_fn
+
+
+def parse_baseline_samples(args):
+    """ Read samples from the baseline record file, in a worker process. Samples of all
+        threads are put in one flamegraph. Return (event count, the flamegraph returned by
+        FlameGraphCallSite.get_flat_tree()).
+    """
+    baseline_args = argparse.Namespace(**vars(args))
+    baseline_args.record_file = args.baseline
+    baseline_args.one_flamegraph = False
+    process = Process("", 0)
+    parse_samples(process, baseline_args, get_one_flamegraph_filter(process))
+    threads = process.get_flamegraph_threads()
+    flat_tree = threads[0].flamegraph.get_flat_tree() if threads else []
+    return process.num_events, flat_tree
+
+
+def parse_baseline_samples_in_worker(args):
+    """ Run parse_baseline_samples() in a worker process. Return (result, error message).
+        Errors, including SystemExit raised by log_exit(), are returned instead of raised. As
+        raising them kills the worker, the parent would wait for the result forever.
+    """
+    try:
+        return parse_baseline_samples(args), None
+    except (Exception, SystemExit) as e:  # pylint: disable=broad-except
+        return None, str(e) or e.__class__.__name__
+
+
+def is_trace_offcpu(record_file):
+    """ Return whether a record file is recorded with --trace-offcpu. """
+    with ReportLib() as lib:
+        lib.SetRecordFile(record_file)
+        return lib.MetaInfo().get('trace_offcpu') == 'true'
+
+
+def trim_callchains(process, args):
+    for thread in process.get_flamegraph_threads():
         min_event_count = thread.num_events * args.min_callchain_percentage * 0.01
         thread.flamegraph.trim_callchain(min_event_count)
 
-    log_info("Parsed %s callchains." % process.num_samples)
-
 
 def get_local_asset_content(local_path):
     """
@@ -158,6 +253,37 @@ def get_local_asset_content(local_path):
         return f.read()
 
 
+def output_offcpu_breakdown(process, f):
+    """ Write tables of on-cpu and off-cpu time of threads, and call sites where threads
+        block the longest.
+    """
+    breakdown = process.offcpu_breakdown
+    f.write("""<br/><br/><b>Off-CPU breakdown (threads blocked for >= %s per sample):</b>
+            <table border="1" cellpadding="3"><tr><th>Thread</th><th>On-CPU</th>
+            <th>Off-CPU</th><th>Off-CPU %%</th></tr>""" %
+            get_proper_scaled_time_string(breakdown.min_wait_ns))
+    thread_times = sorted(breakdown.thread_times.items(), key=lambda item: item[1][2],
+                          reverse=True)
+    for tid, (name, on_cpu, off_cpu) in thread_times:
+        total = on_cpu + off_cpu
+        f.write('<tr><td>%d (%s)</td><td>%s</td><td>%s</td><td>%.2f%%</td></tr>' % (
+            tid, html_escape(name), get_proper_scaled_time_string(on_cpu),
+            get_proper_scaled_time_string(off_cpu), off_cpu * 100.0 / total if total else 0))
+    f.write("""</table><br/><b>Top blocking call sites:</b>
+            <table border="1" cellpadding="3"><tr><th>Method</th><th>Dso</th><th>Wait time</th>
+            <th>Waits</th><th>Max wait</th></tr>""")
+    for method, dso, wait, count, max_wait in breakdown.get_top_callsites(
+            OFFCPU_BREAKDOWN_TOP_CALLSITES):
+        f.write('<tr><td>%s</td><td>%s</td><td>%s</td><td>%d</td><td>%s</td></tr>' % (
+            html_escape(method), html_escape(dso), get_proper_scaled_time_string(wait), count,
+            get_proper_scaled_time_string(max_wait)))
+    f.write('</table>')
+
+
+def html_escape(s):
+    return s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
 def output_report(process, args):
     """
     Generates a HTML report representing the result of simpleperf sampling as flamegraph
@@ -177,7 +303,13 @@ def output_report(process, args):
     f.write(get_local_asset_content("inferno.b64"))
     f.write('"/>')
     process_entry = ("Process : %s (%d)<br/>" % (process.name, process.pid)) if process.pid else ""
-    thread_entry = '' if args.one_flamegraph else ('Threads: %d<br/>' % len(process.threads))
+    if process.time_bucket_ns:
+        thread_entry = 'Time buckets: %d (%s each)<br/>' % (
+            len(process.time_buckets), get_proper_scaled_time_string(process.time_bucket_ns))
+    elif args.one_flamegraph or args.baseline:
+        thread_entry = ''
+    else:
+        thread_entry = 'Threads: %d<br/>' % len(process.threads)
     if process.props['trace_offcpu']:
         event_entry = 'Total time: %s<br/>' % get_proper_scaled_time_string(process.num_events)
     else:
@@ -209,19 +341,38 @@ def output_report(process, args):
     if process.cmd:
         f.write("Capture : %s<br/><br/>" % process.cmd)
     f.write("</div>")
-    f.write("""<br/><br/>
-            <div>Navigate with WASD, zoom in with SPACE, zoom out with BACKSPACE.</div>""")
-    f.write("<script>%s</script>" % get_local_asset_content("script.js"))
+    if process.offcpu_breakdown:
+        output_offcpu_breakdown(process, f)
+    if args.renderer == 'canvas':
+        f.write("""<br/><br/>
+                <div>Click to zoom in, move the mouse over call sites to show details.</div>""")
+        f.write("<script>%s</script>" % get_local_asset_content("canvas.js"))
+    else:
+        f.write("""<br/><br/>
+                <div>Navigate with WASD, zoom in with SPACE, zoom out with BACKSPACE.</div>""")
+        f.write("<script>%s</script>" % get_local_asset_content("script.js"))
     if not args.embedded_flamegraph:
         f.write("<script>document.addEventListener('DOMContentLoaded', flamegraphInit);</script>")
 
-    # Sort threads by the event count in a thread.
-    for thread in sorted(process.threads.values(), key=lambda x: x.num_events, reverse=True):
-        thread_name = 'One flamegraph' if args.one_flamegraph else ('Thread %d (%s)' %
-                                                                    (thread.tid, thread.name))
+    if process.time_bucket_ns:
+        threads = process.get_flamegraph_threads()
+    else:
+        # Sort threads by the event count in a thread.
+        threads = sorted(process.threads.values(), key=lambda x: x.num_events, reverse=True)
+    for thread in threads:
+        if process.time_bucket_ns:
+            thread_name = 'Time %s - %s' % (get_proper_scaled_time_string(thread.start_time),
+                                            get_proper_scaled_time_string(thread.end_time))
+        elif args.one_flamegraph or args.baseline:
+            thread_name = 'One flamegraph'
+        else:
+            thread_name = 'Thread %d (%s)' % (thread.tid, thread.name)
         f.write("<br/><br/><b>%s (%d samples):</b><br/>\n\n\n\n" %
                 (thread_name, thread.num_samples))
-        render_svg(process, thread.flamegraph, f, args.color)
+        if args.renderer == 'canvas':
+            render_canvas(process, thread.flamegraph, f, args.color)
+        else:
+            render_svg(process, thread.flamegraph, f, args.color, args.svg_min_node_width)
 
     f.write("</div>")
     if not args.embedded_flamegraph:
@@ -231,7 +382,7 @@ def output_report(process, args):
 
 
 def generate_threads_offsets(process):
-    for thread in process.threads.values():
+    for thread in process.get_flamegraph_threads():
         thread.flamegraph.generate_offset(0)
 
 
@@ -244,8 +395,6 @@ def collect_machine_info(process):
 
 
 def main():
-    # Allow deep callchain with length >1000.
-    sys.setrecursionlimit(1500)
     parser = argparse.ArgumentParser(description="""Report samples in perf.data. Default option
                                                     is: "-np surfaceflinger -f 6000 -t 10".""")
     record_group = parser.add_argument_group('Record options')
@@ -278,6 +427,11 @@ def main():
                               duration in seconds.""")
 
     report_group = parser.add_argument_group('Report options')
+    report_group.add_argument('--baseline', help="""Generate a differential flamegraph against
+                              a baseline record file. Samples of all threads are put in one
+                              flamegraph, and call sites are colored by how their share of
+                              events changes compared with the baseline: red for more, blue for
+                              less.""")
     report_group.add_argument('-c', '--color', default='hot', choices=['hot', 'dso', 'legacy'],
                               help="""Color theme: hot=percentage of samples, dso=callsite DSO
                                       name, legacy=brendan style""")
@@ -291,12 +445,44 @@ def main():
                               count of the owner thread are collected in the report.""")
     report_group.add_argument('--no_browser', action='store_true', help="""Don't open report
                               in browser.""")
+    report_group.add_argument('--online_pruning', action='store_true', help="""Apply
+                              --min_callchain_percentage while parsing samples, to bound memory
+                              used by huge recordings. The result is approximate: event counts
+                              of shown call sites can be underestimated by at most half of the
+                              limit, so call sites with event counts < 1.5 * the limit may be
+                              missing.""")
+    report_group.add_argument('--sample_rate', type=int, default=1, help="""Generate a quick
+                              preview report by parsing one in N samples, selected randomly.
+                              Event counts of parsed samples are multiplied by N.""")
+    report_group.add_argument('--max_samples', type=int, help="""Generate a quick preview
+                              report by parsing at most N samples, selected randomly. Event counts
+                              of parsed samples are scaled to keep the total event count.""")
+    report_group.add_argument('--offcpu_breakdown', action='store_true', help="""For perf.data
+                              recorded with --trace-offcpu, report on-cpu and off-cpu time of
+                              each thread, and call sites where threads block the longest. It
+                              can't be used with --sample_rate or --max_samples.""")
+    report_group.add_argument('--offcpu_min_wait_us', type=float, help="""With
+                              --offcpu_breakdown, samples with period >= N us are considered as
+                              blocked. Default is twice the sample interval set by -f or -c in
+                              the record cmd stored in the record file.""")
     report_group.add_argument('-o', '--report_path', default='report.html', help="""Set report
                               path.""")
     report_group.add_argument('--one-flamegraph', action='store_true', help="""Generate one
                               flamegraph instead of one for each thread.""")
+    report_group.add_argument('--renderer', default='svg', choices=['svg', 'canvas'], help="""
+                              How to draw flamegraphs. svg: an svg element per call site. canvas:
+                              draw compact json data of call sites on canvas elements, which
+                              loads and zooms faster for huge flamegraphs.""")
+    report_group.add_argument('--svg_min_node_width', type=float,
+                              default=DEFAULT_MIN_NODE_WIDTH, help="""Skip call sites narrower
+                              than N pixels in a 1920-pixel-wide flamegraph with the svg
+                              renderer, together with their subtrees. Default is %s.""" %
+                              DEFAULT_MIN_NODE_WIDTH)
     report_group.add_argument('--symfs', help="""Set the path to find binaries with symbols and
                               debug info.""")
+    report_group.add_argument('--time_bucket_ms', type=float, help="""Split samples into time
+                              windows of N milliseconds, and generate a flamegraph for each window
+                              instead of each thread. It shows when a hot path appears.""")
     report_group.add_argument('--title', help='Show a title in the report.')
     report_group.add_argument('--show_art_frames', action='store_true',
                               help='Show frames of internal methods in the ART Java interpreter.')
@@ -305,6 +491,13 @@ def main():
     debug_group.add_argument('--disable_adb_root', action='store_true', help="""Force adb to run
                              in non root mode.""")
     args = parser.parse_args()
+    check_sampling_args(args)
+    if args.time_bucket_ms is not None and args.time_bucket_ms <= 0:
+        log_exit('--time_bucket_ms should be positive.')
+    if args.offcpu_breakdown and (args.sample_rate > 1 or args.max_samples):
+        # Periods of samples are scaled when sampling, so they are no longer the time between
+        # samples of a thread.
+        log_exit("--offcpu_breakdown can't be used with --sample_rate or --max_samples.")
     process = Process("", 0)
 
     if not args.skip_collection:
@@ -335,15 +528,45 @@ def main():
 
     sample_filter_fn = None
     if args.one_flamegraph:
-        def filter_fn(sample, _symbol, _callchain):
-            sample.pid = sample.tid = process.pid
-            return True
-        sample_filter_fn = filter_fn
+        sample_filter_fn = get_one_flamegraph_filter(process)
         if not args.title:
             args.title = ''
         args.title += '(One Flamegraph)'
 
-    parse_samples(process, args, sample_filter_fn)
+    baseline_pool = None
+    if args.baseline:
+        if not os.path.isfile(args.baseline):
+            log_exit("Can't find baseline record file '%s'." % args.baseline)
+        if args.time_bucket_ms is not None:
+            log_exit("--baseline can't be used with --time_bucket_ms.")
+        if args.offcpu_breakdown:
+            log_exit("--baseline can't be used with --offcpu_breakdown.")
+        # Check record files before starting the worker, as samples of all threads are put in
+        # one flamegraph.
+        for record_file in [args.record_file, args.baseline]:
+            if is_trace_offcpu(record_file):
+                log_exit("It doesn't make sense to report with --baseline for perf.data " +
+                         "recorded with --trace-offcpu: %s" % record_file)
+        sample_filter_fn = get_one_flamegraph_filter(process)
+        if not args.title:
+            args.title = ''
+        args.title += '(Compared with %s)' % args.baseline
+        # Build the baseline flamegraph in parallel.
+        baseline_pool = multiprocessing.Pool(1)
+        baseline_result = baseline_pool.apply_async(parse_baseline_samples_in_worker, (args,))
+
+    try:
+        parse_samples(process, args, sample_filter_fn)
+        if baseline_pool:
+            baseline, error = baseline_result.get()
+            if error:
+                log_exit("Failed to parse baseline record file '%s': %s" % (args.baseline, error))
+            process.set_baseline(*baseline)
+    finally:
+        if baseline_pool:
+            baseline_pool.terminate()
+            baseline_pool.join()
+    trim_callchains(process, args)
     generate_threads_offsets(process)
     report_path = output_report(process, args)
     if not args.no_browser:
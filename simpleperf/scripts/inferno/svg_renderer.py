@@ -29,22 +29,31 @@ SEARCH_NODE_ORIGIN_X = 1190
 SEARCH_NODE_WIDTH = 80
 RECT_TEXT_PADDING = 10
 
+# Assumed width in pixels of a flamegraph at the default zoom. Used to skip call sites too narrow
+# to be seen.
+SVG_DEFAULT_WIDTH = 1920
+DEFAULT_MIN_NODE_WIDTH = 0.1
+# Count of svg nodes buffered before writing them to the report file.
+SVG_NODES_PER_WRITE = 1000
+
 
 def hash_to_float(string):
     return hash(string) / float(sys.maxsize)
 
 
+# Colors of the legacy and dso schemes hash the name and the reversed name. They only depend on
+# the name, like in canvas.js, so they can be cached while rendering.
 def get_legacy_color(method):
-    r = 175 + int(50 * hash_to_float(reversed(method)))
+    r = 175 + int(50 * hash_to_float(method[::-1]))
     g = 60 + int(180 * hash_to_float(method))
-    b = 60 + int(55 * hash_to_float(reversed(method)))
+    b = 60 + int(55 * hash_to_float(method[::-1]))
     return (r, g, b)
 
 
 def get_dso_color(method):
-    r = 170 + int(80 * hash_to_float(reversed(method)))
+    r = 170 + int(80 * hash_to_float(method[::-1]))
     g = 180 + int(70 * hash_to_float((method)))
-    b = 170 + int(80 * hash_to_float(reversed(method)))
+    b = 170 + int(80 * hash_to_float(method[::-1]))
     return (r, g, b)
 
 
@@ -54,6 +63,15 @@ def get_heat_color(callsite, total_weight):
     b = 100
     return (r, g, b)
 
+def get_diff_color(diff_ratio):
+    """ Red for call sites taking more share of events than in the baseline, blue for less.
+        diff_ratio is returned by Process.get_diff_ratio().
+    """
+    if diff_ratio >= 0:
+        return (255, int(255 - 200 * diff_ratio), int(255 - 200 * diff_ratio))
+    return (int(255 + 200 * diff_ratio), int(255 + 200 * diff_ratio), 255)
+
+
 def get_proper_scaled_time_string(value):
     if value >= 1e9:
         return '%.3f s' % (value / 1e9)
@@ -63,19 +81,37 @@ def get_proper_scaled_time_string(value):
         return '%.3f us' % (value / 1e3)
     return '%.0f ns' % value
 
-def create_svg_node(process, callsite, depth, f, total_weight, height, color_scheme, nav):
+def xml_escape(s):
+    return s.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def create_svg_node(process, callsite, depth, total_weight, height, color_scheme, nav,
+                    color_cache=None):
+    """ Return the svg element of a call site. color_cache maps dso or method names to colors
+        for the dso and legacy color schemes.
+    """
     x = float(callsite.offset) / total_weight * 100
     y = height - (depth + 1) * SVG_NODE_HEIGHT
     width = callsite.weight() / total_weight * 100
 
-    method = callsite.method.replace(">", "&gt;").replace("<", "&lt;")
-    if width <= 0:
-        return
-
-    if color_scheme == "dso":
-        r, g, b = get_dso_color(callsite.dso)
+    method = xml_escape(callsite.method)
+
+    if process.baseline_events is not None:
+        r, g, b = get_diff_color(process.get_diff_ratio(callsite))
+    elif color_scheme == "dso":
+        color = color_cache.get(callsite.dso) if color_cache is not None else None
+        if color is None:
+            color = get_dso_color(callsite.dso)
+            if color_cache is not None:
+                color_cache[callsite.dso] = color
+        r, g, b = color
     elif color_scheme == "legacy":
-        r, g, b = get_legacy_color(method)
+        color = color_cache.get(method) if color_cache is not None else None
+        if color is None:
+            color = get_legacy_color(method)
+            if color_cache is not None:
+                color_cache[method] = color
+        r, g, b = color
     else:
         r, g, b = get_heat_color(callsite, total_weight)
 
@@ -85,18 +121,22 @@ def create_svg_node(process, callsite, depth, f, total_weight, height, color_sch
         weight_str = get_proper_scaled_time_string(callsite.weight())
     else:
         weight_str = "{:,}".format(int(callsite.weight())) + ' events'
+    if process.baseline_events is not None and process.baseline_num_events:
+        baseline_percent = (process.baseline_events.get(callsite.id, 0) * 100.0 /
+                            process.baseline_num_events)
+        weight_str = 'baseline: %3.2f%%, %s' % (baseline_percent, weight_str)
 
-    f.write(
-        """<g id=%d class="n" onclick="zoom(this);" onmouseenter="select(this);" nav="%s">
+    return (
+        """<g id="%d" class="n" onclick="zoom(this);" onmouseenter="select(this);" nav="%s">
         <title>%s | %s (%s: %3.2f%%)</title>
         <rect x="%f%%" y="%f" ox="%f" oy="%f" width="%f%%" owidth="%f" height="15.0"
         ofill="rgb(%d,%d,%d)" fill="rgb(%d,%d,%d)" style="stroke:rgb(%d,%d,%d)"/>
         <text x="%f%%" y="%f" font-size="%d" font-family="Monospace"></text>
         </g>""" %
         (callsite.id,
-         ','.join(str(x) for x in nav),
+         '%d,%d,%d,%d' % tuple(nav),
          method,
-         callsite.dso,
+         xml_escape(callsite.dso),
          weight_str,
          callsite.weight() / total_weight * 100,
          x,
@@ -119,34 +159,59 @@ def create_svg_node(process, callsite, depth, f, total_weight, height, color_sch
          FONT_SIZE))
 
 
-def render_svg_nodes(process, flamegraph, depth, f, total_weight, height, color_scheme):
-    for i, child in enumerate(flamegraph.children):
+def get_visible_children(callsite, min_weight):
+    """ Return children of a call site wide enough to be rendered. As children are not wider
+        than their parent, the subtrees of skipped children are skipped too.
+    """
+    return [child for child in callsite.children
+            if child.weight() > 0 and child.weight() >= min_weight]
+
+
+def render_svg_nodes(process, flamegraph, depth, f, total_weight, height, color_scheme,
+                     min_weight=0):
+    """ Render call sites in the subtree of flamegraph with weight >= min_weight. """
+    # Use an explicit stack of (parent's visible children, child index, parent id, depth)
+    # instead of recursion, so deep callchains don't hit the recursion limit. Nodes are rendered
+    # in depth-first order.
+    children = get_visible_children(flamegraph, min_weight)
+    stack = [(children, i, flamegraph.id, depth) for i in reversed(range(len(children)))]
+    # Join svg elements into big chunks, instead of writing them one by one.
+    buf = []
+    color_cache = {}
+    while stack:
+        siblings, i, parent_id, depth = stack.pop()
+        child = siblings[i]
+        children = get_visible_children(child, min_weight)
         # Prebuild navigation target for wasd
 
         if i == 0:
             left_index = 0
         else:
-            left_index = flamegraph.children[i - 1].id
+            left_index = siblings[i - 1].id
 
-        if i == len(flamegraph.children) - 1:
+        if i == len(siblings) - 1:
             right_index = 0
         else:
-            right_index = flamegraph.children[i + 1].id
+            right_index = siblings[i + 1].id
 
-        up_index = max(child.children, key=lambda x: x.weight()).id if child.children else 0
+        up_index = max(children, key=lambda x: x.weight()).id if children else 0
 
         # up, left, down, right
-        nav = [up_index, left_index, flamegraph.id, right_index]
+        nav = [up_index, left_index, parent_id, right_index]
 
-        create_svg_node(process, child, depth, f, total_weight, height, color_scheme, nav)
-        # Recurse down
-        render_svg_nodes(process, child, depth + 1, f, total_weight, height, color_scheme)
+        buf.append(create_svg_node(process, child, depth, total_weight, height, color_scheme,
+                                   nav, color_cache))
+        if len(buf) == SVG_NODES_PER_WRITE:
+            f.write(''.join(buf))
+            buf = []
+        stack.extend((children, j, child.id, depth + 1) for j in reversed(range(len(children))))
+    f.write(''.join(buf))
 
 
 def render_search_node(f):
     f.write(
         """<rect id="search_rect"  style="stroke:rgb(0,0,0);" onclick="search(this);" class="t"
-        rx="10" ry="10" x="%d" y="10" width="%d" height="30" fill="rgb(255,255,255)""/>
+        rx="10" ry="10" x="%d" y="10" width="%d" height="30" fill="rgb(255,255,255)"/>
         <text id="search_text"  class="t" x="%d" y="30"    onclick="search(this);">Search</text>
         """ % (SEARCH_NODE_ORIGIN_X, SEARCH_NODE_WIDTH, SEARCH_NODE_ORIGIN_X + RECT_TEXT_PADDING))
 
@@ -182,7 +247,14 @@ def render_percent_node(f):
                PERCENT_NODE_ORIGIN_X + PERCENT_NODE_WIDTH - RECT_TEXT_PADDING))
 
 
-def render_svg(process, flamegraph, f, color_scheme):
+def render_svg(process, flamegraph, f, color_scheme, min_node_width=DEFAULT_MIN_NODE_WIDTH):
+    """ Render a flamegraph as an svg element. Call sites narrower than min_node_width
+        pixels in a flamegraph SVG_DEFAULT_WIDTH pixels wide are skipped with their subtrees.
+    """
+    total_weight = flamegraph.weight()
+    min_weight = total_weight * min_node_width / SVG_DEFAULT_WIDTH
+    visible_children = get_visible_children(flamegraph, min_weight)
+    root_node = visible_children[0] if visible_children else flamegraph.children[0]
     height = (flamegraph.get_max_depth() + 2) * SVG_NODE_HEIGHT
     f.write("""<div class="flamegraph_block" style="width:100%%; height:%dpx;">
             """ % height)
@@ -190,13 +262,13 @@ def render_svg(process, flamegraph, f, color_scheme):
     xmlns:xlink="http://www.w3.org/1999/xlink" version="1.1"
     width="100%%" height="100%%" style="border: 1px solid black;"
     rootid="%d">
-    """ % (flamegraph.children[0].id))
+    """ % (root_node.id))
     f.write("""<defs > <linearGradient id="background_gradiant" y1="0" y2="1" x1="0" x2="0" >
     <stop stop-color="#eeeeee" offset="5%" /> <stop stop-color="#efefb1" offset="90%" />
     </linearGradient> </defs>""")
     f.write("""<rect x="0.0" y="0" width="100%" height="100%" fill="url(#background_gradiant)" />
             """)
-    render_svg_nodes(process, flamegraph, 0, f, flamegraph.weight(), height, color_scheme)
+    render_svg_nodes(process, flamegraph, 0, f, total_weight, height, color_scheme, min_weight)
     render_search_node(f)
     render_unzoom_node(f)
     render_info_node(f)
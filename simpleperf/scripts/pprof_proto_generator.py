@@ -26,27 +26,71 @@
 
 from __future__ import print_function
 import argparse
+import gzip
 import os
 import os.path
+import zlib
 
 from simpleperf_report_lib import ReportLib
-from utils import Addr2Nearestline, bytes_to_str, extant_dir, find_tool_path, flatten_arg_list
-from utils import log_info, log_exit, str_to_bytes
+from utils import Addr2Nearestline, encode_varint, extant_dir, find_tool_path, flatten_arg_list
+from utils import check_sampling_args, get_default_jobs, log_info, log_exit, map_in_process_pool
+from utils import str_to_bytes
 try:
     import profile_pb2
 except ImportError:
     log_exit('google.protobuf module is missing. Please install it first.')
 
 def load_pprof_profile(filename):
+    """ Load a pprof profile, which can be compressed by gzip or not. """
     profile = profile_pb2.Profile()
     with open(filename, "rb") as f:
-        profile.ParseFromString(bytes_to_str(f.read()))
+        data = f.read()
+    if data[:2] == b'\x1f\x8b':
+        data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    profile.ParseFromString(data)
     return profile
 
 
-def store_pprof_profile(filename, profile):
-    with open(filename, 'wb') as f:
-        f.write(str_to_bytes(profile.SerializeToString()))
+class PprofProfileWriter(object):
+    """ Write a pprof profile field by field, compressed by gzip as pprof expects.
+        Encoding elements of a repeated field one by one is equivalent to encoding the whole
+        field, so a profile can be written without building a profile_pb2.Profile.
+    """
+
+    # Number of encoded fields buffered before writing to the gzip file.
+    BUFFER_SIZE = 1000
+
+    def __init__(self, filename):
+        self.f = gzip.open(filename, 'wb')
+        self.field_tags = {}
+        self.buffer = []
+
+    def add(self, field_name, value):
+        """ Add an element of a repeated field in profile_pb2.Profile. value is a message, or
+            a string for string_table.
+        """
+        tag = self.field_tags.get(field_name)
+        if tag is None:
+            field_number = profile_pb2.Profile.DESCRIPTOR.fields_by_name[field_name].number
+            # Repeated fields written here are messages or strings, encoded as
+            # length-delimited (wire type 2).
+            tag = self.field_tags[field_name] = encode_varint((field_number << 3) | 2)
+        if field_name == 'string_table':
+            data = str_to_bytes(value)
+        else:
+            data = value.SerializeToString()
+        self.buffer.append(tag + encode_varint(len(data)) + data)
+        if len(self.buffer) >= self.BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.f.write(b''.join(self.buffer))
+            self.buffer = []
+
+    def close(self):
+        self.flush()
+        self.f.close()
 
 
 class PprofProfilePrinter(object):
@@ -244,18 +288,11 @@ class PprofProfileGenerator(object):
 
     def __init__(self, config):
         self.config = config
-        self.lib = ReportLib()
+        self.lib = None
 
         config['binary_cache_dir'] = 'binary_cache'
         if not os.path.isdir(config['binary_cache_dir']):
             config['binary_cache_dir'] = None
-        else:
-            self.lib.SetSymfs(config['binary_cache_dir'])
-        if config.get('perf_data_path'):
-            self.lib.SetRecordFile(config['perf_data_path'])
-        kallsyms = 'binary_cache/kallsyms'
-        if os.path.isfile(kallsyms):
-            self.lib.SetKallsymsFile(kallsyms)
         self.comm_filter = set(config['comm_filters']) if config.get('comm_filters') else None
         if config.get('pid_filters'):
             self.pid_filter = {int(x) for x in config['pid_filters']}
@@ -266,25 +303,65 @@ class PprofProfileGenerator(object):
         else:
             self.tid_filter = None
         self.dso_filter = set(config['dso_filters']) if config.get('dso_filters') else None
-        self.profile = profile_pb2.Profile()
-        self.profile.string_table.append('')
         self.string_table = {}
+        self.string_list = ['']
         self.sample_types = {}
+        self.sample_type_list = []
         self.sample_map = {}
         self.sample_list = []
         self.location_map = {}
         self.location_list = []
         self.mapping_map = {}
         self.mapping_list = []
+        self.mapping_id_cache = {}
+        self.build_id_cache = {}
         self.function_map = {}
         self.function_list = []
 
-    def gen(self):
-        # 1. Process all samples in perf.data, aggregate samples.
+    def write(self, filename):
+        """ Write the profile to a gzip file, without keeping the whole encoded profile in
+            memory.
+        """
+        self.load_samples()
+        writer = PprofProfileWriter(filename)
+        for field_name, value in self.gen_profile_fields():
+            writer.add(field_name, value)
+        writer.close()
+
+    def load_samples(self):
+        # 1. Process all samples in perf.data files, aggregate samples.
+        perf_data_paths = self.config.get('perf_data_paths') or ['perf.data']
+        if len(perf_data_paths) == 1:
+            self.read_record_file(perf_data_paths[0])
+        else:
+            # Each record file is read into a partial profile in a worker process, then
+            # merged here.
+            results = map_in_process_pool(self, 'read_partial_profile',
+                                          [(path,) for path in perf_data_paths],
+                                          self.config.get('jobs', 1))
+            for partial_profile in results:
+                self.merge_partial_profile(partial_profile)
+
+        # 2. Generate line info for locations and functions.
+        self.gen_source_lines()
+
+    def read_record_file(self, record_file):
+        self.lib = ReportLib()
+        if self.config['binary_cache_dir']:
+            self.lib.SetSymfs(self.config['binary_cache_dir'])
+        self.lib.SetRecordFile(record_file)
+        if self.config.get('sample_rate', 1) > 1:
+            self.lib.SetSampleRate(self.config['sample_rate'])
+        if self.config.get('max_samples'):
+            self.lib.SetMaxSamples(self.config['max_samples'])
+        kallsyms = 'binary_cache/kallsyms'
+        if os.path.isfile(kallsyms):
+            self.lib.SetKallsymsFile(kallsyms)
         while True:
             report_sample = self.lib.GetNextSample()
             if report_sample is None:
                 self.lib.Close()
+                self.lib = None
                 break
             event = self.lib.GetEventOfCurrentSample()
             symbol = self.lib.GetSymbolOfCurrentSample()
@@ -308,20 +385,79 @@ class PprofProfileGenerator(object):
             if sample.location_ids:
                 self.add_sample(sample)
 
-        # 2. Generate line info for locations and functions.
-        self.gen_source_lines()
-
-        # 3. Produce samples/locations/functions in profile
+    def read_partial_profile(self, record_file):
+        """ Read a record file, and return its samples with local string, sample type, mapping,
+            location and function ids. It runs in worker processes.
+        """
+        generator = PprofProfileGenerator(self.config)
+        generator.read_record_file(record_file)
+        return generator.get_partial_profile()
+
+    def get_partial_profile(self):
+        return (self.string_list, self.sample_types, self.sample_list, self.mapping_list,
+                self.location_list, self.function_list)
+
+    def merge_partial_profile(self, partial_profile):
+        """ Add a partial profile returned by read_partial_profile(), remapping its ids to ids
+            in this profile. Samples with the same locations are merged.
+        """
+        strings, sample_types, samples, mappings, locations, functions = partial_profile
+        string_ids = [self.get_string_id(string) for string in strings]
+        sample_type_ids = {}
+        for name, sample_type_id in sample_types.items():
+            new_id = self.get_sample_type_id(name)
+            sample_type_ids[sample_type_id] = new_id
+            sample_type_ids[sample_type_id + 1] = new_id + 1
+        # Ids start from 1, so index 0 is a placeholder.
+        mapping_ids = [0]
+        for mapping in mappings:
+            mapping_ids.append(self.add_mapping(Mapping(
+                mapping.memory_start, mapping.memory_limit, mapping.file_offset,
+                string_ids[mapping.filename_id], string_ids[mapping.build_id_id])))
+        function_ids = [0]
+        for function in functions:
+            new_function = self.add_function(string_ids[function.name_id],
+                                             string_ids[function.dso_name_id],
+                                             function.vaddr_in_dso)
+            function_ids.append(new_function.id)
+        location_ids = [0]
+        for location in locations:
+            key = (mapping_ids[location.mapping_id], location.address)
+            new_location = self.location_map.get(key)
+            if not new_location:
+                new_location = Location(key[0], key[1], location.vaddr_in_dso)
+                # Lines of the partial profile are left unchanged.
+                for line in location.lines:
+                    new_line = Line()
+                    new_line.function_id = function_ids[line.function_id]
+                    new_line.line = line.line
+                    new_location.lines.append(new_line)
+                self.add_location(new_location)
+            location_ids.append(new_location.id)
+        for sample in samples:
+            new_sample = Sample()
+            new_sample.location_ids = [location_ids[x] for x in sample.location_ids]
+            for sample_type_id, value in sample.values.items():
+                new_sample.add_value(sample_type_ids[sample_type_id], value)
+            self.add_sample(new_sample)
+
+    def gen_profile_fields(self):
+        """ Yield (field name, value) pairs for elements of repeated fields in the profile. """
+        for sample_type in self.sample_type_list:
+            yield 'sample_type', sample_type
         for sample in self.sample_list:
-            self.gen_profile_sample(sample)
+            yield 'sample', self.gen_profile_sample(sample)
+        # Samples are no longer needed, release them before generating other fields.
+        self.sample_list = []
+        self.sample_map = {}
         for mapping in self.mapping_list:
-            self.gen_profile_mapping(mapping)
+            yield 'mapping', self.gen_profile_mapping(mapping)
         for location in self.location_list:
-            self.gen_profile_location(location)
+            yield 'location', self.gen_profile_location(location)
         for function in self.function_list:
-            self.gen_profile_function(function)
-
-        return self.profile
+            yield 'function', self.gen_profile_function(function)
+        for string in self.string_list:
+            yield 'string_table', string
 
     def _filter_report_sample(self, sample):
         """Return true if the sample can be used."""
@@ -349,28 +485,35 @@ class PprofProfileGenerator(object):
             return str_id
         str_id = len(self.string_table) + 1
         self.string_table[str_value] = str_id
-        self.profile.string_table.append(str_value)
+        self.string_list.append(str_value)
         return str_id
 
     def get_string(self, str_id):
-        return self.profile.string_table[str_id]
+        return self.string_list[str_id]
 
     def get_sample_type_id(self, name):
         sample_type_id = self.sample_types.get(name)
         if sample_type_id is not None:
             return sample_type_id
-        sample_type_id = len(self.profile.sample_type)
-        sample_type = self.profile.sample_type.add()
+        sample_type_id = len(self.sample_type_list)
+        sample_type = profile_pb2.ValueType()
         sample_type.type = self.get_string_id('event_' + name + '_samples')
         sample_type.unit = self.get_string_id('count')
-        sample_type = self.profile.sample_type.add()
+        self.sample_type_list.append(sample_type)
+        sample_type = profile_pb2.ValueType()
         sample_type.type = self.get_string_id('event_' + name + '_count')
         sample_type.unit = self.get_string_id('count')
+        self.sample_type_list.append(sample_type)
         self.sample_types[name] = sample_type_id
         return sample_type_id
 
     def get_location_id(self, ip, symbol):
         mapping_id = self.get_mapping_id(symbol.mapping[0], symbol.dso_name)
+        # Look up by key first, so Location and Line objects are only created for new locations.
+        key = (mapping_id, ip)
+        location = self.location_map.get(key)
+        if location:
+            return location.id
         location = Location(mapping_id, ip, symbol.vaddr_in_file)
         function_id = self.get_function_id(symbol.symbol_name, symbol.dso_name,
                                            symbol.symbol_addr)
@@ -380,10 +523,9 @@ class PprofProfileGenerator(object):
             line = Line()
             line.function_id = function_id
             location.lines.append(line)
+        return self.add_location(location)
 
-        exist_location = self.location_map.get(location.key)
-        if exist_location:
-            return exist_location.id
+    def add_location(self, location):
         # location_id starts from 1
         location.id = len(self.location_list) + 1
         self.location_list.append(location)
@@ -391,13 +533,21 @@ class PprofProfileGenerator(object):
         return location.id
 
     def get_mapping_id(self, report_mapping, filename):
+        start, end, pgoff = report_mapping.start, report_mapping.end, report_mapping.pgoff
+        # Build ids don't change for a dso path, so mappings can be looked up without the
+        # build id.
+        key = (start, end, pgoff, filename)
+        mapping_id = self.mapping_id_cache.get(key)
+        if mapping_id is not None:
+            return mapping_id
         filename_id = self.get_string_id(filename)
-        build_id = self.lib.GetBuildIdForPath(filename)
-        if build_id and build_id[0:2] == "0x":
-            build_id = build_id[2:]
-        build_id_id = self.get_string_id(build_id)
-        mapping = Mapping(report_mapping.start, report_mapping.end,
-                          report_mapping.pgoff, filename_id, build_id_id)
+        build_id_id = self.get_build_id_id(filename)
+        mapping_id = self.add_mapping(Mapping(start, end, pgoff, filename_id, build_id_id))
+        self.mapping_id_cache[key] = mapping_id
+        return mapping_id
+
+    def add_mapping(self, mapping):
+        """ Add a mapping if it doesn't exist, and return its id. """
         exist_mapping = self.mapping_map.get(mapping.key)
         if exist_mapping:
             return exist_mapping.id
@@ -407,21 +557,36 @@ class PprofProfileGenerator(object):
         self.mapping_map[mapping.key] = mapping
         return mapping.id
 
+    def get_build_id_id(self, filename):
+        build_id_id = self.build_id_cache.get(filename)
+        if build_id_id is None:
+            build_id = self.lib.GetBuildIdForPath(filename)
+            if build_id and build_id[0:2] == "0x":
+                build_id = build_id[2:]
+            build_id_id = self.build_id_cache[filename] = self.get_string_id(build_id)
+        return build_id_id
+
     def get_mapping(self, mapping_id):
         return self.mapping_list[mapping_id - 1] if mapping_id > 0 else None
 
     def get_function_id(self, name, dso_name, vaddr_in_file):
         if name == 'unknown':
             return 0
-        function = Function(self.get_string_id(name), self.get_string_id(dso_name), vaddr_in_file)
-        exist_function = self.function_map.get(function.key)
-        if exist_function:
-            return exist_function.id
+        return self.add_function(self.get_string_id(name), self.get_string_id(dso_name),
+                                 vaddr_in_file).id
+
+    def add_function(self, name_id, dso_name_id, vaddr_in_dso):
+        """ Return the function with the name and dso, which is added if it doesn't exist. """
+        key = (name_id, dso_name_id)
+        function = self.function_map.get(key)
+        if function:
+            return function
+        function = Function(name_id, dso_name_id, vaddr_in_dso)
         # function_id starts from 1
         function.id = len(self.function_list) + 1
         self.function_list.append(function)
-        self.function_map[function.key] = function
-        return function.id
+        self.function_map[key] = function
+        return function
 
     def get_function(self, function_id):
         return self.function_list[function_id - 1] if function_id > 0 else None
@@ -456,7 +621,7 @@ class PprofProfileGenerator(object):
             addr2line.add_addr(dso_name, function.vaddr_in_dso, function.vaddr_in_dso)
 
         # 3. Generate source lines.
-        addr2line.convert_addrs_to_lines()
+        addr2line.convert_addrs_to_lines(self.config.get('jobs', 1))
 
         # 4. Annotate locations and functions.
         for location in self.location_list:
@@ -501,16 +666,17 @@ class PprofProfileGenerator(object):
         return line
 
     def gen_profile_sample(self, sample):
-        profile_sample = self.profile.sample.add()
+        profile_sample = profile_pb2.Sample()
         profile_sample.location_id.extend(sample.location_ids)
         sample_type_count = len(self.sample_types) * 2
         values = [0] * sample_type_count
         for sample_type_id in sample.values:
             values[sample_type_id] = sample.values[sample_type_id]
         profile_sample.value.extend(values)
+        return profile_sample
 
     def gen_profile_mapping(self, mapping):
-        profile_mapping = self.profile.mapping.add()
+        profile_mapping = profile_pb2.Mapping()
         profile_mapping.id = mapping.id
         profile_mapping.memory_start = mapping.memory_start
         profile_mapping.memory_limit = mapping.memory_limit
@@ -525,9 +691,10 @@ class PprofProfileGenerator(object):
         else:
             profile_mapping.has_line_numbers = False
             profile_mapping.has_inline_frames = False
+        return profile_mapping
 
     def gen_profile_location(self, location):
-        profile_location = self.profile.location.add()
+        profile_location = profile_pb2.Location()
         profile_location.id = location.id
         profile_location.mapping_id = location.mapping_id
         profile_location.address = location.address
@@ -535,23 +702,25 @@ class PprofProfileGenerator(object):
             line = profile_location.line.add()
             line.function_id = location.lines[i].function_id
             line.line = location.lines[i].line
+        return profile_location
 
     def gen_profile_function(self, function):
-        profile_function = self.profile.function.add()
+        profile_function = profile_pb2.Function()
         profile_function.id = function.id
         profile_function.name = function.name_id
         profile_function.system_name = function.name_id
         profile_function.filename = function.source_filename_id
         profile_function.start_line = function.start_line
+        return profile_function
 
 
 def main():
     parser = argparse.ArgumentParser(description='Generate pprof profile data in pprof.profile.')
     parser.add_argument('--show', nargs='?', action='append', help='print existing pprof.profile.')
-    parser.add_argument('-i', '--perf_data_path', default='perf.data', help="""
-        The path of profiling data.""")
+    parser.add_argument('-i', '--perf_data_path', nargs='+', default=['perf.data'], help="""
+        The paths of profiling data. Samples in multiple files are merged into one profile.""")
     parser.add_argument('-o', '--output_file', default='pprof.profile', help="""
-        The path of generated pprof profile data.""")
+        The path of generated pprof profile data, compressed by gzip.""")
     parser.add_argument('--comm', nargs='+', action='append', help="""
         Use samples only in threads with selected names.""")
     parser.add_argument('--pid', nargs='+', action='append', help="""
@@ -561,6 +730,14 @@ def main():
     parser.add_argument('--dso', nargs='+', action='append', help="""
         Use samples only in selected binaries.""")
     parser.add_argument('--ndk_path', type=extant_dir, help='Set the path of a ndk release.')
+    parser.add_argument('--sample_rate', type=int, default=1, help="""
+        Generate a quick preview profile by reading one in N samples, selected randomly.
+        Event counts of read samples are multiplied by N.""")
+    parser.add_argument('--max_samples', type=int, help="""
+        Generate a quick preview profile by reading at most N samples, selected randomly.
+        Event counts of read samples are scaled to keep the total event count.""")
+    parser.add_argument('-j', '--jobs', type=int, default=get_default_jobs(), help="""
+        Read multiple profiling data files in up to N worker processes.""")
 
     args = parser.parse_args()
     if args.show:
@@ -570,17 +747,20 @@ def main():
         printer.show()
         return
 
+    check_sampling_args(args)
     config = {}
-    config['perf_data_path'] = args.perf_data_path
+    config['perf_data_paths'] = args.perf_data_path
     config['output_file'] = args.output_file
     config['comm_filters'] = flatten_arg_list(args.comm)
     config['pid_filters'] = flatten_arg_list(args.pid)
     config['tid_filters'] = flatten_arg_list(args.tid)
     config['dso_filters'] = flatten_arg_list(args.dso)
     config['ndk_path'] = args.ndk_path
+    config['sample_rate'] = args.sample_rate
+    config['max_samples'] = args.max_samples
+    config['jobs'] = args.jobs
     generator = PprofProfileGenerator(config)
-    profile = generator.gen()
-    store_pprof_profile(config['output_file'], profile)
+    generator.write(config['output_file'])
 
 
 if __name__ == '__main__':
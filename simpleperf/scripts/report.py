@@ -43,12 +43,16 @@ from utils import *
 
 PAD_X = 3
 PAD_Y = 3
+# Number of report items inserted into the tree view at a time.
+ITEMS_PER_BATCH = 500
 
 
 class CallTreeNode(object):
 
   """Representing a node in call-graph."""
 
+  __slots__ = ['percentage', 'call_stack', 'children']
+
   def __init__(self, percentage, function_name):
     self.percentage = percentage
     self.call_stack = [function_name]
@@ -101,19 +105,13 @@ class EventReport(object):
 
 
 def parse_event_reports(lines):
-  # Parse common report context
+  """Parse report lines one by one. lines can be any iterable, like a file object, so the
+     whole report doesn't need to be kept in memory."""
   common_report_context = []
-  line_id = 0
-  while line_id < len(lines):
-    line = lines[line_id]
-    if not line or line.find('Event:') == 0:
-      break
-    common_report_context.append(line)
-    line_id += 1
-
+  in_common_report_context = True
   event_reports = []
   in_report_context = True
-  cur_event_report = EventReport(common_report_context)
+  cur_event_report = None
   cur_report_item = None
   call_tree_stack = {}
   vertical_columns = []
@@ -121,7 +119,16 @@ def parse_event_reports(lines):
 
   has_skipped_callgraph = False
 
-  for line in lines[line_id:]:
+  for line in lines:
+    line = line.rstrip()
+    if in_common_report_context:
+      # Parse common report context
+      if line and line.find('Event:') != 0:
+        common_report_context.append(line)
+        continue
+      in_common_report_context = False
+      cur_event_report = EventReport(common_report_context)
+
     if not line:
       in_report_context = not in_report_context
       if in_report_context:
@@ -229,10 +236,18 @@ class ReportWindow(object):
     tree.config(xscrollcommand=xscrollbar.set)
     xscrollbar.config(command=tree.xview)
 
-    self.display_report_items(tree, report_items)
-
-  def display_report_items(self, tree, report_items):
-    for report_item in report_items:
+    # Rows of call trees are inserted only when their parent rows are expanded. Map from the
+    # id of a collapsed row to (call tree nodes under it, indent of the nodes).
+    self.pending_nodes = {}
+    tree.bind('<<TreeviewOpen>>', lambda event: self.on_open(tree))
+    self.master = master
+    self.display_report_items(tree, report_items, 0)
+
+  def display_report_items(self, tree, report_items, start):
+    # Insert report items in batches, so the window shows up and responds before all items
+    # are inserted.
+    end = min(start + ITEMS_PER_BATCH, len(report_items))
+    for report_item in report_items[start:end]:
       prefix_str = '+ ' if report_item.call_tree is not None else '  '
       id = tree.insert(
           '',
@@ -243,7 +258,23 @@ class ReportWindow(object):
               report_item.raw_line],
           tag='set_font')
       if report_item.call_tree is not None:
-        self.display_call_tree(tree, id, report_item.call_tree, 1)
+        self.add_pending_nodes(tree, id, [report_item.call_tree], 1)
+    if end < len(report_items):
+      self.master.after_idle(self.display_report_items, tree, report_items, end)
+
+  def add_pending_nodes(self, tree, parent_id, nodes, indent):
+    # Add an empty row, so parent_id can be expanded.
+    tree.insert(parent_id, 'end', None, values=[''])
+    self.pending_nodes[parent_id] = (nodes, indent)
+
+  def on_open(self, tree):
+    id = tree.focus()
+    pending = self.pending_nodes.pop(id, None)
+    if pending:
+      tree.delete(*tree.get_children(id))
+      nodes, indent = pending
+      for node in nodes:
+        self.display_call_tree(tree, id, node, indent)
 
   def display_call_tree(self, tree, parent_id, node, indent):
     id = parent_id
@@ -263,17 +294,18 @@ class ReportWindow(object):
       id = tree.insert(id, 'end', None, values=[s], open=child_open,
                        tag='set_font')
 
-    for child in node.children:
-      self.display_call_tree(tree, id, child, indent + 1)
+    if not node.children:
+      return
+    if child_open:
+      for child in node.children:
+        self.display_call_tree(tree, id, child, indent + 1)
+    else:
+      self.add_pending_nodes(tree, id, node.children, indent + 1)
 
 
 def display_report_file(report_file, self_kill_after_sec):
-    fh = open(report_file, 'r')
-    lines = fh.readlines()
-    fh.close()
-
-    lines = [x.rstrip() for x in lines]
-    event_reports = parse_event_reports(lines)
+    with open(report_file, 'r') as fh:
+        event_reports = parse_event_reports(fh)
 
     if event_reports:
         root = Tk()
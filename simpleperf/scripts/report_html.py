@@ -25,10 +25,14 @@ import sys
 from simpleperf_report_lib import ReportLib
 from utils import log_info, log_exit
 from utils import Addr2Nearestline, get_script_dir, Objdump, open_report_in_browser
-from utils import SourceFileSearcher
+from utils import check_sampling_args, get_default_jobs, get_line_offset_index, map_in_process_pool
+from utils import ONLINE_PRUNING_ERROR_RATIO, SourceFileSearcher
 
 MAX_CALLSTACK_LENGTH = 750
 
+# Don't prune a thread before it creates this count of new nodes.
+ONLINE_PRUNING_MIN_NEW_NODES = 10000
+
 class HtmlWriter(object):
 
     def __init__(self, output_path):
@@ -71,11 +75,12 @@ class EventScope(object):
         self.processes = {}  # map from pid to ProcessScope
         self.sample_count = 0
         self.event_count = 0
+        self.pruner = None  # OnlinePruner used by threads of this event
 
     def get_process(self, pid):
         process = self.processes.get(pid)
         if not process:
-            process = self.processes[pid] = ProcessScope(pid)
+            process = self.processes[pid] = ProcessScope(pid, self.pruner)
         return process
 
     def get_sample_info(self, gen_addr_hit_map):
@@ -103,16 +108,17 @@ class EventScope(object):
 
 class ProcessScope(object):
 
-    def __init__(self, pid):
+    def __init__(self, pid, pruner=None):
         self.pid = pid
         self.name = ''
         self.event_count = 0
         self.threads = {}  # map from tid to ThreadScope
+        self.pruner = pruner
 
     def get_thread(self, tid, thread_name):
         thread = self.threads.get(tid)
         if not thread:
-            thread = self.threads[tid] = ThreadScope(tid)
+            thread = self.threads[tid] = ThreadScope(tid, self.pruner)
         thread.name = thread_name
         if self.pid == tid:
             self.name = thread_name
@@ -130,7 +136,7 @@ class ProcessScope(object):
 
 class ThreadScope(object):
 
-    def __init__(self, tid):
+    def __init__(self, tid, pruner=None):
         self.tid = tid
         self.name = ''
         self.event_count = 0
@@ -138,10 +144,18 @@ class ThreadScope(object):
         self.libs = {}  # map from lib_id to LibScope
         self.call_graph = CallNode(-1)
         self.reverse_call_graph = CallNode(-1)
+        # OnlinePruner, or None if all functions and nodes are kept until limit_percents().
+        self.pruner = pruner
+        self.new_node_count = 0
+        self.kept_node_count = 0
 
     def add_callstack(self, event_count, callstack, build_addr_hit_map):
         """ callstack is a list of tuple (lib_id, func_id, addr).
             For each i > 0, callstack[i] calls callstack[i-1]."""
+        if self.pruner:
+            func_count_error, node_count_error = self.pruner.get_count_errors(self)
+        else:
+            func_count_error = node_count_error = 0
         hit_func_ids = set()
         for i, (lib_id, func_id, addr) in enumerate(callstack):
             # When a callstack contains recursive function, only add for each function once.
@@ -152,7 +166,11 @@ class ThreadScope(object):
             lib = self.libs.get(lib_id)
             if not lib:
                 lib = self.libs[lib_id] = LibScope(lib_id)
-            function = lib.get_function(func_id)
+            function = lib.functions.get(func_id)
+            if not function:
+                function = lib.functions[func_id] = FunctionScope(func_id)
+                function.count_error = func_count_error
+                self.new_node_count += 1
             function.subtree_event_count += event_count
             if i == 0:
                 lib.event_count += event_count
@@ -162,16 +180,33 @@ class ThreadScope(object):
                 function.build_addr_hit_map(addr, event_count if i == 0 else 0, event_count)
 
         # build call graph and reverse call graph
-        node = self.call_graph
-        for item in reversed(callstack):
-            node = node.get_child(item[1])
-        node.event_count += event_count
-        node = self.reverse_call_graph
+        self._add_to_call_graph(self.call_graph, reversed(callstack), event_count,
+                                node_count_error)
+        self._add_to_call_graph(self.reverse_call_graph, callstack, event_count,
+                                node_count_error)
+        if self.pruner and self.new_node_count > max(self.kept_node_count,
+                                                     ONLINE_PRUNING_MIN_NEW_NODES):
+            self.pruner.prune(self)
+
+    def _add_to_call_graph(self, node, callstack, event_count, count_error):
+        # Subtree event counts are kept up to date for OnlinePruner. Without pruning, they are
+        # recomputed by update_subtree_event_count().
+        node.subtree_event_count += event_count
         for item in callstack:
-            node = node.get_child(item[1])
+            child = node.children.get(item[1])
+            if not child:
+                child = node.children[item[1]] = CallNode(item[1])
+                child.count_error = count_error
+                self.new_node_count += 1
+            child.subtree_event_count += event_count
+            node = child
         node.event_count += event_count
 
     def update_subtree_event_count(self):
+        if self.pruner:
+            # Subtree event counts are updated while adding callstacks, and can't be recomputed
+            # after pruning.
+            return
         self.call_graph.update_subtree_event_count()
         self.reverse_call_graph.update_subtree_event_count()
 
@@ -230,6 +265,7 @@ class FunctionScope(object):
         self.sample_count = 0
         self.event_count = 0
         self.subtree_event_count = 0
+        self.count_error = 0  # max underestimation of subtree_event_count by OnlinePruner
         self.addr_hit_map = None  # map from addr to [event_count, subtree_event_count].
         # map from (source_file_id, line) to [event_count, subtree_event_count].
         self.line_hit_map = None
@@ -280,6 +316,7 @@ class CallNode(object):
     def __init__(self, func_id):
         self.event_count = 0
         self.subtree_event_count = 0
+        self.count_error = 0  # max underestimation of subtree_event_count by OnlinePruner
         self.func_id = func_id
         self.children = collections.OrderedDict()  # map from func_id to CallNode
 
@@ -289,31 +326,113 @@ class CallNode(object):
             child = self.children[func_id] = CallNode(func_id)
         return child
 
+    # Tree traversals below use explicit stacks instead of recursion, so deep callstacks don't
+    # hit the recursion limit.
+
     def update_subtree_event_count(self):
-        self.subtree_event_count = self.event_count
-        for child in self.children.values():
-            self.subtree_event_count += child.update_subtree_event_count()
+        # Visit nodes in breadth-first order, then update them in reverse order, so children
+        # are updated before their parents.
+        nodes = [self]
+        for node in nodes:
+            nodes.extend(node.children.values())
+        for node in reversed(nodes):
+            node.subtree_event_count = node.event_count
+            for child in node.children.values():
+                node.subtree_event_count += child.subtree_event_count
         return self.subtree_event_count
 
     def cut_edge(self, min_limit, hit_func_ids):
-        hit_func_ids.add(self.func_id)
-        to_del_children = []
-        for key in self.children:
-            child = self.children[key]
-            if child.subtree_event_count < min_limit:
-                to_del_children.append(key)
-            else:
-                child.cut_edge(min_limit, hit_func_ids)
-        for key in to_del_children:
-            del self.children[key]
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            hit_func_ids.add(node.func_id)
+            to_del_children = []
+            for key in node.children:
+                child = node.children[key]
+                if child.subtree_event_count < min_limit:
+                    to_del_children.append(key)
+                else:
+                    stack.append(child)
+            for key in to_del_children:
+                del node.children[key]
+
+    def prune(self, limit):
+        """ Remove children (with their subtrees) whose subtree_event_count + count_error
+            <= limit. Return the count of nodes left in the subtree.
+        """
+        node_count = 0
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            node_count += 1
+            to_del_children = []
+            for key in node.children:
+                child = node.children[key]
+                if child.subtree_event_count + child.count_error <= limit:
+                    to_del_children.append(key)
+                else:
+                    stack.append(child)
+            for key in to_del_children:
+                del node.children[key]
+        return node_count
 
     def gen_sample_info(self):
-        result = {}
-        result['e'] = self.event_count
-        result['s'] = self.subtree_event_count
-        result['f'] = self.func_id
-        result['c'] = [child.gen_sample_info() for child in self.children.values()]
-        return result
+        sample_info = {}
+        stack = [(self, sample_info)]
+        while stack:
+            node, result = stack.pop()
+            result['e'] = node.event_count
+            result['s'] = node.subtree_event_count
+            result['f'] = node.func_id
+            result['c'] = [{} for _ in node.children]
+            stack.extend(zip(node.children.values(), result['c']))
+        return sample_info
+
+
+class OnlinePruner(object):
+    """ Apply --min_func_percent and --min_callchain_percent while loading samples, so memory
+        used by a huge recording is bounded by the limits instead of by the recording size.
+
+        It uses lossy counting (Manku & Motwani, 2002) on functions and call graph nodes of a
+        thread. The limit of an item is limit_ratio * the current event count of the event (for
+        functions) or of the thread (for call graph nodes), with limit_ratio =
+        ONLINE_PRUNING_ERROR_RATIO * percent * 0.01. A new item gets count_error = its current
+        limit, because up to that many events of it could have been pruned before. An item is
+        pruned when subtree_event_count + count_error <= its current limit. As a result:
+          1. The exact count of a kept item is in [count, count + limit].
+          2. An item whose exact count is more than its limit is never pruned. So compared with
+             limit_percents() on the exact data, only items with exact counts in
+             [percent, percent * (1 + ONLINE_PRUNING_ERROR_RATIO)) may be missing in the report.
+        A thread is pruned each time it has created more new nodes than it kept after the last
+        pruning, which amortizes pruning cost to O(1) per new node.
+    """
+
+    def __init__(self, event, min_func_percent, min_callchain_percent):
+        self.event = event
+        self.func_limit_ratio = ONLINE_PRUNING_ERROR_RATIO * min_func_percent * 0.01
+        self.callchain_limit_ratio = ONLINE_PRUNING_ERROR_RATIO * min_callchain_percent * 0.01
+
+    def get_count_errors(self, thread):
+        """ Return count_error of functions and of call graph nodes newly added to a thread. """
+        return (self.func_limit_ratio * self.event.event_count,
+                self.callchain_limit_ratio * thread.call_graph.subtree_event_count)
+
+    def prune(self, thread):
+        func_limit = self.func_limit_ratio * self.event.event_count
+        kept_node_count = 0
+        for lib in thread.libs.values():
+            to_del_funcs = []
+            for function in lib.functions.values():
+                if function.subtree_event_count + function.count_error <= func_limit:
+                    to_del_funcs.append(function.func_id)
+            for func_id in to_del_funcs:
+                del lib.functions[func_id]
+            kept_node_count += len(lib.functions)
+        callchain_limit = self.callchain_limit_ratio * thread.call_graph.subtree_event_count
+        kept_node_count += thread.call_graph.prune(callchain_limit)
+        kept_node_count += thread.reverse_call_graph.prune(callchain_limit)
+        thread.kept_node_count = kept_node_count
+        thread.new_node_count = 0
 
 
 class LibSet(object):
@@ -382,16 +501,12 @@ class SourceFile(object):
         self.line_to_code = {}  # map from line to code in that line.
 
     def request_lines(self, start_line, end_line):
-        self.requested_lines |= set(range(start_line, end_line + 1))
+        self.requested_lines.update(range(start_line, end_line + 1))
 
     def add_source_code(self, real_path):
         self.real_path = real_path
-        with open(real_path, 'r') as f:
-            source_code = f.readlines()
-        max_line = len(source_code)
-        for line in self.requested_lines:
-            if line > 0 and line <= max_line:
-                self.line_to_code[line] = source_code[line - 1]
+        # Only read requested lines, instead of the whole file.
+        self.line_to_code = get_line_offset_index(real_path).get_lines(self.requested_lines)
         # requested_lines is no longer used.
         self.requested_lines = None
 
@@ -408,8 +523,8 @@ class SourceFileSet(object):
             self.path_to_source_files[file_path] = source_file
         return source_file
 
-    def load_source_code(self, source_dirs):
-        file_searcher = SourceFileSearcher(source_dirs)
+    def load_source_code(self, source_dirs, source_index=None):
+        file_searcher = SourceFileSearcher(source_dirs, source_index)
         for source_file in self.path_to_source_files.values():
             real_path = file_searcher.get_real_path(source_file.abstract_path)
             if real_path:
@@ -510,6 +625,20 @@ class RecordData(object):
         self.total_samples = 0
         self.source_files = SourceFileSet()
         self.gen_addr_hit_map_in_record_info = False
+        self.online_pruning_percents = None
+        self.sample_rate = 1
+        self.max_samples = None
+
+    def enable_sampling(self, sample_rate, max_samples):
+        """ Only load a random subset of samples, to generate a quick preview report.
+            See ReportLib.SetSampleRate() and ReportLib.SetMaxSamples().
+        """
+        self.sample_rate = sample_rate
+        self.max_samples = max_samples
+
+    def enable_online_pruning(self, min_func_percent, min_callchain_percent):
+        """ Prune functions and callchains while loading record files. See OnlinePruner. """
+        self.online_pruning_percents = (min_func_percent, min_callchain_percent)
 
     def load_record_file(self, record_file, show_art_frames):
         lib = ReportLib()
@@ -521,6 +650,10 @@ class RecordData(object):
             lib.ShowArtFrames()
         if self.binary_cache_path:
             lib.SetSymfs(self.binary_cache_path)
+        if self.sample_rate > 1:
+            lib.SetSampleRate(self.sample_rate)
+        if self.max_samples:
+            lib.SetMaxSamples(self.max_samples)
         self.meta_info = lib.MetaInfo()
         self.cmdline = lib.GetRecordCmd()
         self.arch = lib.GetArch()
@@ -575,14 +708,18 @@ class RecordData(object):
 
     def _get_event(self, event_name):
         if event_name not in self.events:
-            self.events[event_name] = EventScope(event_name)
+            event = self.events[event_name] = EventScope(event_name)
+            if self.online_pruning_percents:
+                event.pruner = OnlinePruner(event, *self.online_pruning_percents)
         return self.events[event_name]
 
-    def add_source_code(self, source_dirs, filter_lib):
+    def add_source_code(self, source_dirs, filter_lib, jobs=1, source_index=None):
         """ Collect source code information:
             1. Find line ranges for each function in FunctionSet.
             2. Find line for each addr in FunctionScope.addr_hit_map.
             3. Collect needed source code in SourceFileSet.
+            Up to `jobs` worker processes are used to convert addrs in different libraries.
+            If source_index isn't None, paths of source files are kept in it for later runs.
         """
         addr2line = Addr2Nearestline(self.ndk_path, self.binary_cache_path, False)
         # Request line range for each function.
@@ -603,7 +740,7 @@ class RecordData(object):
                         func_addr = self.functions.id_to_func[function.func_id].start_addr
                         for addr in function.addr_hit_map:
                             addr2line.add_addr(lib_name, func_addr, addr)
-        addr2line.convert_addrs_to_lines()
+        addr2line.convert_addrs_to_lines(jobs)
 
         # Set line range for each function.
         for function in self.functions.id_to_func.values():
@@ -644,30 +781,31 @@ class RecordData(object):
                                                         count_info[1])
 
         # Collect needed source code in SourceFileSet.
-        self.source_files.load_source_code(source_dirs)
+        self.source_files.load_source_code(source_dirs, source_index)
 
-    def add_disassembly(self, filter_lib):
+    def add_disassembly(self, filter_lib, jobs=1):
         """ Collect disassembly information:
-            1. Use objdump to collect disassembly for each function in FunctionSet.
+            1. Use objdump to collect disassembly for each function in FunctionSet. Functions
+               in different libraries are disassembled in up to `jobs` worker processes.
             2. Set flag to dump addr_hit_map when generating record info.
         """
         objdump = Objdump(self.ndk_path, self.binary_cache_path)
-        cur_lib_name = None
-        dso_info = None
+        lib_functions = collections.OrderedDict()  # map from lib_name to [Function].
         for function in sorted(self.functions.id_to_func.values(), key=lambda a: a.lib_id):
             if function.func_name == 'unknown':
                 continue
             lib_name = self.libs.get_lib_name(function.lib_id)
-            if lib_name != cur_lib_name:
-                cur_lib_name = lib_name
-                if filter_lib(lib_name):
-                    dso_info = objdump.get_dso_info(lib_name)
-                else:
-                    dso_info = None
-                if dso_info:
-                    log_info('Disassemble %s' % dso_info[0])
-            if dso_info:
-                code = objdump.disassemble_code(dso_info, function.start_addr, function.addr_len)
+            if filter_lib(lib_name):
+                lib_functions.setdefault(lib_name, []).append(function)
+        tasks = []
+        for lib_name, functions in lib_functions.items():
+            tasks.append((lib_name, [(f.start_addr, f.addr_len) for f in functions]))
+        results = map_in_process_pool(objdump, 'disassemble_functions', tasks, jobs)
+        for functions, codes in zip(lib_functions.values(), results):
+            if codes is None:
+                continue
+            log_info('Disassemble %s' % self.libs.get_lib_name(functions[0].lib_id))
+            for function, code in zip(functions, codes):
                 function.disassembly = code
 
         self.gen_addr_hit_map_in_record_info = True
@@ -809,6 +947,7 @@ class ReportGenerator(object):
 
 
 def main():
+    # json.dumps() recurses into nested call graph nodes (a dict and a list per node).
     sys.setrecursionlimit(MAX_CALLSTACK_LENGTH * 2 + 50)
     parser = argparse.ArgumentParser(description='report profiling data')
     parser.add_argument('-i', '--record_file', nargs='+', default=['perf.data'], help="""
@@ -824,12 +963,32 @@ def main():
                         It is used to limit nodes shown in the function flamegraph. For example,
                         when set to 0.01, only callchains taking >= 0.01%% of the event count of
                         the starting function are collected in the report. Default is 0.01.""")
+    parser.add_argument('--online_pruning', action='store_true', help="""
+                        Apply --min_func_percent and --min_callchain_percent while loading
+                        samples, to bound memory used by huge recordings. The result is
+                        approximate: event counts of shown items can be underestimated by at
+                        most half of the limit, so items with event counts < 1.5 * the limit
+                        may be missing.""")
+    parser.add_argument('--sample_rate', type=int, default=1, help="""
+                        Generate a quick preview report by loading one in N samples, selected
+                        randomly. Event counts of loaded samples are multiplied by N.""")
+    parser.add_argument('--max_samples', type=int, help="""
+                        Generate a quick preview report by loading at most N samples of each
+                        record file, selected randomly. Event counts of loaded samples are
+                        scaled to keep the total event count.""")
     parser.add_argument('--add_source_code', action='store_true', help='Add source code.')
     parser.add_argument('--source_dirs', nargs='+', help='Source code directories.')
+    parser.add_argument('--source_index', help="""
+                        Save paths of source files found in source_dirs in this file, and reuse
+                        them in the next run. Only directories modified since then are listed
+                        again.""")
     parser.add_argument('--add_disassembly', action='store_true', help='Add disassembled code.')
     parser.add_argument('--binary_filter', nargs='+', help="""Annotate source code and disassembly
                         only for selected binaries.""")
     parser.add_argument('--ndk_path', nargs=1, help='Find tools in the ndk path.')
+    parser.add_argument('-j', '--jobs', type=int, default=get_default_jobs(), help="""
+                        Use up to N worker processes to add source code and disassembly.
+                        Default is the count of cpus.""")
     parser.add_argument('--no_browser', action='store_true', help="Don't open report in browser.")
     parser.add_argument('--show_art_frames', action='store_true',
                         help='Show frames of internal methods in the ART Java interpreter.')
@@ -847,11 +1006,16 @@ def main():
 
     if args.add_source_code and not args.source_dirs:
         log_exit('--source_dirs is needed to add source code.')
+    check_sampling_args(args)
     build_addr_hit_map = args.add_source_code or args.add_disassembly
     ndk_path = None if not args.ndk_path else args.ndk_path[0]
 
     # 2. Produce record data.
     record_data = RecordData(binary_cache_path, ndk_path, build_addr_hit_map)
+    if args.sample_rate > 1 or args.max_samples:
+        record_data.enable_sampling(args.sample_rate, args.max_samples)
+    if args.online_pruning:
+        record_data.enable_online_pruning(args.min_func_percent, args.min_callchain_percent)
     for record_file in args.record_file:
         record_data.load_record_file(record_file, args.show_art_frames)
     record_data.limit_percents(args.min_func_percent, args.min_callchain_percent)
@@ -864,9 +1028,9 @@ def main():
                 return True
         return False
     if args.add_source_code:
-        record_data.add_source_code(args.source_dirs, filter_lib)
+        record_data.add_source_code(args.source_dirs, filter_lib, args.jobs, args.source_index)
     if args.add_disassembly:
-        record_data.add_disassembly(filter_lib)
+        record_data.add_disassembly(filter_lib, args.jobs)
 
     # 3. Generate report html.
     report_generator = ReportGenerator(args.report_path)
@@ -15,16 +15,222 @@
 # limitations under the License.
 #
 
-"""report_sample.py: report samples in the same format as `perf script`.
+"""report_sample.py: report samples in the same format as `perf script`, or in protobuf or
+   chrome trace format.
 """
 
 from __future__ import print_function
 import argparse
+import json
+import struct
+import sys
+
 from simpleperf_report_lib import ReportLib
+from utils import encode_varint, is_python3, str_to_bytes
+
+# Number of samples buffered before writing to the output file.
+SAMPLES_PER_WRITE = 1000
+
+
+class TextSampleWriter(object):
+    """ Write samples in the same format as `perf script`. """
+
+    def __init__(self, f):
+        self.f = f
+        self.buffer = []
+        self.sample_count = 0
+
+    def write_sample(self, sample, event, symbol, callchain, tracing_data):
+        buf = self.buffer
+        buf.append('%s\t%d [%03d] %d.%06d:\t\t%d %s:\n' % (
+            sample.thread_comm, sample.tid, sample.cpu, sample.time // 1000000000,
+            sample.time % 1000000000 // 1000, sample.period, event.name))
+        buf.append('%16x\t%s (%s)\n' % (sample.ip, symbol.symbol_name, symbol.dso_name))
+        for i in range(callchain.nr):
+            entry = callchain.entries[i]
+            buf.append('%16x\t%s (%s)\n' % (entry.ip, entry.symbol.symbol_name,
+                                              entry.symbol.dso_name))
+        if tracing_data:
+            buf.append('\ttracing data:\n')
+            for key, value in tracing_data.items():
+                buf.append('\t\t%s : %s\n' % (key, value))
+        buf.append('\n')
+        self.sample_count += 1
+        if self.sample_count % SAMPLES_PER_WRITE == 0:
+            self.flush()
+
+    def flush(self):
+        self.f.write(''.join(self.buffer))
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+
+
+def _encode_varint_field(field_number, value):
+    return encode_varint(field_number << 3) + encode_varint(value)
+
+
+def _encode_bytes_field(field_number, data):
+    return encode_varint((field_number << 3) | 2) + encode_varint(len(data)) + data
+
+
+class ProtobufSampleWriter(object):
+    """ Write samples in the format generated by `simpleperf report-sample --protobuf`, which
+        is described in report_sample.proto. Records are encoded directly, without depending
+        on the protobuf module. Sample records are written while samples are read. File,
+        thread and meta info records are written at the end.
+    """
+
+    MAGIC = b'SIMPLEPERF'
+    VERSION = 1
+
+    def __init__(self, f, app_package_name):
+        self.f = f
+        self.app_package_name = app_package_name
+        self.buffer = [self.MAGIC, struct.pack('<H', self.VERSION)]
+        self.sample_count = 0
+        self.files = {}  # map from dso name to (file_id, map from symbol name to symbol_id).
+        self.file_list = []  # list of (dso name, [symbol name]).
+        self.threads = {}  # map from tid to (pid, thread name).
+        self.event_types = {}  # map from event name to event_type_id.
+        self.event_type_list = []
 
+    def _get_file_and_symbol_id(self, dso_name, symbol_name):
+        file_info = self.files.get(dso_name)
+        if file_info is None:
+            file_info = self.files[dso_name] = (len(self.file_list), {})
+            self.file_list.append((dso_name, []))
+        file_id, symbol_ids = file_info
+        symbol_id = symbol_ids.get(symbol_name)
+        if symbol_id is None:
+            symbols = self.file_list[file_id][1]
+            symbol_id = symbol_ids[symbol_name] = len(symbols)
+            symbols.append(symbol_name)
+        return file_id, symbol_id
 
-def report_sample(record_file, symfs_dir, kallsyms_file, show_tracing_data):
-    """ read record_file, and print each sample"""
+    def _encode_callchain_entry(self, symbol):
+        file_id, symbol_id = self._get_file_and_symbol_id(symbol.dso_name, symbol.symbol_name)
+        return _encode_bytes_field(3, _encode_varint_field(1, symbol.vaddr_in_file) +
+                                   _encode_varint_field(2, file_id) +
+                                   _encode_varint_field(3, symbol_id))
+
+    def _add_record(self, field_number, data):
+        record = _encode_bytes_field(field_number, data)
+        self.buffer.append(struct.pack('<I', len(record)))
+        self.buffer.append(record)
+
+    def write_sample(self, sample, event, symbol, callchain, tracing_data):
+        event_type_id = self.event_types.get(event.name)
+        if event_type_id is None:
+            event_type_id = self.event_types[event.name] = len(self.event_type_list)
+            self.event_type_list.append(event.name)
+        if sample.tid not in self.threads:
+            self.threads[sample.tid] = (sample.pid, sample.thread_comm)
+        data = [_encode_varint_field(1, sample.time), _encode_varint_field(2, sample.tid),
+                self._encode_callchain_entry(symbol)]
+        for i in range(callchain.nr):
+            data.append(self._encode_callchain_entry(callchain.entries[i].symbol))
+        data.append(_encode_varint_field(4, sample.period))
+        data.append(_encode_varint_field(5, event_type_id))
+        # Record.sample
+        self._add_record(1, b''.join(data))
+        self.sample_count += 1
+        if self.sample_count % SAMPLES_PER_WRITE == 0:
+            self.flush()
+
+    def flush(self):
+        self.f.write(b''.join(self.buffer))
+        self.buffer = []
+
+    def close(self):
+        for file_id, (dso_name, symbols) in enumerate(self.file_list):
+            data = [_encode_varint_field(1, file_id),
+                    _encode_bytes_field(2, str_to_bytes(dso_name))]
+            for symbol in symbols:
+                data.append(_encode_bytes_field(3, str_to_bytes(symbol)))
+            # Record.file
+            self._add_record(3, b''.join(data))
+        for tid in sorted(self.threads):
+            pid, thread_name = self.threads[tid]
+            # Record.thread
+            self._add_record(4, _encode_varint_field(1, tid) + _encode_varint_field(2, pid) +
+                             _encode_bytes_field(3, str_to_bytes(thread_name)))
+        data = [_encode_bytes_field(1, str_to_bytes(x)) for x in self.event_type_list]
+        if self.app_package_name:
+            data.append(_encode_bytes_field(2, str_to_bytes(self.app_package_name)))
+        # Record.meta_info
+        self._add_record(5, b''.join(data))
+        self.buffer.append(struct.pack('<I', 0))
+        self.flush()
+
+
+class ChromeTraceSampleWriter(object):
+    """ Write samples in Chrome trace event format, which can be opened by chrome://tracing
+        and Perfetto. Samples are written while they are read. Stack frames, shared by
+        samples, and thread names are written at the end.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.buffer = ['{"samples":[']
+        self.sample_count = 0
+        self.stack_frame_ids = {}  # map from (parent frame id, dso, symbol) to frame id.
+        self.threads = {}  # map from tid to (pid, thread name).
+
+    def _get_stack_frame_id(self, parent_id, symbol):
+        key = (parent_id, symbol.dso_name, symbol.symbol_name)
+        frame_id = self.stack_frame_ids.get(key)
+        if frame_id is None:
+            frame_id = self.stack_frame_ids[key] = len(self.stack_frame_ids) + 1
+        return frame_id
+
+    def write_sample(self, sample, event, symbol, callchain, tracing_data):
+        if sample.tid not in self.threads:
+            self.threads[sample.tid] = (sample.pid, sample.thread_comm)
+        frame_id = None
+        for i in range(callchain.nr - 1, -1, -1):
+            frame_id = self._get_stack_frame_id(frame_id, callchain.entries[i].symbol)
+        frame_id = self._get_stack_frame_id(frame_id, symbol)
+        if self.sample_count > 0:
+            self.buffer.append(',')
+        self.buffer.append(json.dumps({'cpu': sample.cpu, 'tid': sample.tid,
+                                       'ts': sample.time / 1000.0, 'name': event.name,
+                                       'sf': frame_id, 'weight': sample.period},
+                                      separators=(',', ':')))
+        self.sample_count += 1
+        if self.sample_count % SAMPLES_PER_WRITE == 0:
+            self.flush()
+
+    def flush(self):
+        self.f.write(''.join(self.buffer))
+        self.buffer = []
+
+    def close(self):
+        self.buffer.append('],"stackFrames":{')
+        for i, (key, frame_id) in enumerate(self.stack_frame_ids.items()):
+            parent_id, dso_name, symbol_name = key
+            frame = {'name': symbol_name, 'category': dso_name}
+            if parent_id is not None:
+                frame['parent'] = str(parent_id)
+            if i > 0:
+                self.buffer.append(',')
+            self.buffer.append('"%d":%s' % (frame_id, json.dumps(frame, separators=(',', ':'))))
+        self.buffer.append('},"traceEvents":[')
+        for i, tid in enumerate(sorted(self.threads)):
+            pid, thread_name = self.threads[tid]
+            if i > 0:
+                self.buffer.append(',')
+            self.buffer.append(json.dumps({'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                                           'tid': tid, 'args': {'name': thread_name}},
+                                          separators=(',', ':')))
+        self.buffer.append(']}\n')
+        self.flush()
+
+
+def report_sample(record_file, symfs_dir, kallsyms_file, show_tracing_data,
+                  output_format='text', output_file=None):
+    """ read record_file, and write each sample in output_format"""
     lib = ReportLib()
 
     lib.ShowIpForUnknownSymbol()
@@ -35,6 +241,20 @@ def report_sample(record_file, symfs_dir, kallsyms_file, show_tracing_data):
     if kallsyms_file is not None:
         lib.SetKallsymsFile(kallsyms_file)
 
+    is_binary = output_format == 'protobuf'
+    if output_file:
+        f = open(output_file, 'wb' if is_binary else 'w')
+    elif is_binary and is_python3():
+        f = sys.stdout.buffer
+    else:
+        f = sys.stdout
+    if output_format == 'protobuf':
+        writer = ProtobufSampleWriter(f, lib.MetaInfo().get('app_package_name'))
+    elif output_format == 'chrome_trace':
+        writer = ChromeTraceSampleWriter(f)
+    else:
+        writer = TextSampleWriter(f)
+
     while True:
         sample = lib.GetNextSample()
         if sample is None:
@@ -43,23 +263,13 @@ def report_sample(record_file, symfs_dir, kallsyms_file, show_tracing_data):
         event = lib.GetEventOfCurrentSample()
         symbol = lib.GetSymbolOfCurrentSample()
         callchain = lib.GetCallChainOfCurrentSample()
-
-        sec = sample.time / 1000000000
-        usec = (sample.time - sec * 1000000000) / 1000
-        print('%s\t%d [%03d] %d.%06d:\t\t%d %s:' % (sample.thread_comm,
-                                                    sample.tid, sample.cpu, sec,
-                                                    usec, sample.period, event.name))
-        print('%16x\t%s (%s)' % (sample.ip, symbol.symbol_name, symbol.dso_name))
-        for i in range(callchain.nr):
-            entry = callchain.entries[i]
-            print('%16x\t%s (%s)' % (entry.ip, entry.symbol.symbol_name, entry.symbol.dso_name))
-        if show_tracing_data:
-            data = lib.GetTracingDataOfCurrentSample()
-            if data:
-                print('\ttracing data:')
-                for key, value in data.items():
-                    print('\t\t%s : %s' % (key, value))
-        print('')
+        tracing_data = lib.GetTracingDataOfCurrentSample() if show_tracing_data else None
+        writer.write_sample(sample, event, symbol, callchain, tracing_data)
+    writer.close()
+    if output_file:
+        f.close()
+    else:
+        f.flush()
 
 
 def main():
@@ -69,9 +279,19 @@ def main():
     parser.add_argument('--kallsyms', help='Set the path to find kernel symbols.')
     parser.add_argument('record_file', nargs='?', default='perf.data',
                         help='Default is perf.data.')
-    parser.add_argument('--show_tracing_data', action='store_true', help='print tracing data.')
+    parser.add_argument('--show_tracing_data', action='store_true', help="""
+        print tracing data. Only used in text format.""")
+    parser.add_argument('--output_format', choices=['text', 'protobuf', 'chrome_trace'],
+                        default='text', help="""
+        text: the same format as `perf script`.
+        protobuf: the format generated by `simpleperf report-sample --protobuf`, described in
+                  report_sample.proto.
+        chrome_trace: chrome trace event format, which can be opened by chrome://tracing.
+        Default is text.""")
+    parser.add_argument('-o', '--output_file', help='Default is stdout.')
     args = parser.parse_args()
-    report_sample(args.record_file, args.symfs, args.kallsyms, args.show_tracing_data)
+    report_sample(args.record_file, args.symfs, args.kallsyms, args.show_tracing_data,
+                  args.output_format, args.output_file)
 
 
 if __name__ == '__main__':
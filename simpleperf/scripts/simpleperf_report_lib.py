@@ -22,10 +22,21 @@
 
 import collections
 import ctypes as ct
+import random
 import struct
 from utils import bytes_to_str, get_host_binary_path, is_windows, str_to_bytes
 
 
+# Names of feature sections in perf.data, defined in record_file_reader.cpp.
+FEATURE_NAMES = ('tracing_data', 'build_id', 'hostname', 'osrelease', 'version', 'arch',
+                 'nrcpus', 'cpudesc', 'cpuid', 'total_mem', 'cmdline', 'event_desc',
+                 'cpu_topology', 'numa_topology', 'branch_stack', 'pmu_mappings', 'group_desc',
+                 'file', 'meta_info')
+# Feature sections that can be large in big recordings. They aren't cached, and aren't read by
+# GetFeatureSections() unless asked for.
+LARGE_FEATURE_NAMES = ('tracing_data', 'build_id', 'file')
+
+
 def _get_native_lib():
     return get_host_binary_path('libsimpleperf_report.so')
 
@@ -96,36 +107,48 @@ class TracingFieldFormatStruct(ct.Structure):
     def name(self):
         return _char_pt_to_str(self._name)
 
+    def is_string(self):
+        return self.elem_count > 1 and self.elem_size == 1 and self.is_signed == 0
+
+    def get_unpack_key(self):
+        """ Return the struct format character of an element, or None if the element type
+            is unknown.
+        """
+        unpack_key = self._unpack_key_dict.get(self.elem_size)
+        if unpack_key and not self.is_signed:
+            unpack_key = unpack_key.upper()
+        return unpack_key
+
     def parse_value(self, data):
         """ Parse value of a field in a tracepoint event.
             The return value depends on the type of the field, and can be an int value, a string,
             an array of int values, etc. If the type can't be parsed, return a byte array or an
             array of byte arrays.
         """
-        if self.elem_count > 1 and self.elem_size == 1 and self.is_signed == 0:
-            # The field is a string.
-            length = 0
-            while length < self.elem_count and bytes_to_str(data[self.offset + length]) != '\x00':
-                length += 1
-            return bytes_to_str(data[self.offset : self.offset + length])
-        unpack_key = self._unpack_key_dict.get(self.elem_size)
+        if self.is_string():
+            return _parse_string(data[self.offset : self.offset + self.elem_count])
+        unpack_key = self.get_unpack_key()
         if unpack_key:
-            if not self.is_signed:
-                unpack_key = unpack_key.upper()
-            value = struct.unpack('%d%s' % (self.elem_count, unpack_key),
+            value = struct.unpack('=%d%s' % (self.elem_count, unpack_key),
                                   data[self.offset:self.offset + self.elem_count * self.elem_size])
         else:
             # Since we don't know the element type, just return the bytes.
-            value = []
-            offset = self.offset
-            for _ in range(self.elem_count):
-                value.append(data[offset : offset + self.elem_size])
-                offset += self.elem_size
+            value = _split_bytes(data[self.offset:], self.elem_size, self.elem_count)
         if self.elem_count == 1:
             value = value[0]
         return value
 
 
+def _parse_string(data):
+    end = data.find(b'\x00')
+    return bytes_to_str(data if end == -1 else data[:end])
+
+
+def _split_bytes(data, elem_size, elem_count):
+    """ Split data into elem_count byte arrays of elem_size bytes. elem_size can be 0. """
+    return [data[i * elem_size : (i + 1) * elem_size] for i in range(elem_count)]
+
+
 class TracingDataFormatStruct(ct.Structure):
     """Format of tracing data of a tracepoint event, like
        https://www.kernel.org/doc/html/latest/trace/events.html#event-formats.
@@ -138,6 +161,108 @@ class TracingDataFormatStruct(ct.Structure):
                 ('fields', ct.POINTER(TracingFieldFormatStruct))]
 
 
+class TracingDataDecoder(object):
+    """ Decode tracing data of a tracepoint event. A struct.Struct unpacking all fields at once
+        is compiled from TracingDataFormatStruct when the decoder is created, so decoding tracing
+        data of a sample takes a single unpack call plus per field conversions.
+        field_names: names of fields, in the order of the values returned by decode().
+    """
+
+    def __init__(self, data_format):
+        self.size = data_format.size
+        fields = [data_format.fields[i] for i in range(data_format.field_count)]
+        self.field_names = [field.name for field in fields]
+        # Fields are unpacked by self.structs, a list of (struct.Struct, offset). Fields not
+        # overlapping with each other share the first struct. Each overlapping field gets an
+        # extra struct.
+        # self.layouts is a list of (struct index, index of the first value, field kind,
+        # elem_count, elem_size), in the order of fields.
+        self.structs = []
+        self.layouts = [None] * len(fields)
+        fmt = ['=']
+        fmt_end = 0
+        value_count = 0
+        for i in sorted(range(len(fields)), key=lambda i: fields[i].offset):
+            field = fields[i]
+            if field.is_string():
+                kind, item_fmt, item_count = 'string', '%ds' % field.elem_count, 1
+            elif field.get_unpack_key():
+                kind = 'int'
+                item_fmt = '%d%s' % (field.elem_count, field.get_unpack_key())
+                item_count = field.elem_count
+            else:
+                kind = 'bytes'
+                item_fmt = '%ds' % (field.elem_count * field.elem_size)
+                item_count = 1
+            if field.offset < fmt_end:
+                self.layouts[i] = (len(self.structs) + 1, 0, kind, field.elem_count,
+                                   field.elem_size)
+                self.structs.append((struct.Struct('=' + item_fmt), field.offset))
+                continue
+            if field.offset > fmt_end:
+                fmt.append('%dx' % (field.offset - fmt_end))
+            self.layouts[i] = (0, value_count, kind, field.elem_count, field.elem_size)
+            fmt.append(item_fmt)
+            fmt_end = field.offset + field.elem_count * field.elem_size
+            value_count += item_count
+        if fmt_end < self.size:
+            fmt.append('%dx' % (self.size - fmt_end))
+        self.structs.insert(0, (struct.Struct(''.join(fmt)), 0))
+        self.converters = [self._get_converter(*layout) for layout in self.layouts]
+
+    @staticmethod
+    def _get_converter(struct_index, start, kind, elem_count, elem_size):
+        """ Return a function converting unpacked values of all structs to a field value. """
+        if kind == 'string':
+            return lambda values: _parse_string(values[struct_index][start])
+        if kind == 'bytes':
+            if elem_count == 1:
+                return lambda values: values[struct_index][start]
+            return lambda values: _split_bytes(values[struct_index][start], elem_size,
+                                               elem_count)
+        if elem_count == 1:
+            return lambda values: values[struct_index][start]
+        end = start + elem_count
+        return lambda values: values[struct_index][start:end]
+
+    def decode(self, data):
+        """ Decode tracing data of a sample, which is a bytes object of at least self.size bytes.
+            Return a list of field values, parsed like TracingFieldFormatStruct.parse_value().
+        """
+        values = [s.unpack_from(data, offset) for s, offset in self.structs]
+        return [convert(values) for convert in self.converters]
+
+    def decode_columns(self, data_list):
+        """ Decode tracing data of many samples of the event in a batch. It is faster than
+            calling decode() for each sample when a recording contains many tracepoint samples.
+            Return an OrderedDict mapping from field names to lists of field values, in the order
+            of data_list.
+        """
+        struct_columns = []
+        for s, offset in self.structs:
+            rows = [s.unpack_from(data, offset) for data in data_list]
+            columns = list(zip(*rows))
+            if not columns:
+                columns = [()] * len(s.unpack_from(b'\x00' * s.size))
+            struct_columns.append(columns)
+        result = collections.OrderedDict()
+        for name, layout in zip(self.field_names, self.layouts):
+            struct_index, start, kind, elem_count, elem_size = layout
+            columns = struct_columns[struct_index]
+            if kind == 'string':
+                values = [_parse_string(value) for value in columns[start]]
+            elif kind == 'bytes' and elem_count != 1:
+                values = [_split_bytes(value, elem_size, elem_count) for value in columns[start]]
+            elif kind == 'int' and elem_count == 0:
+                values = [()] * len(data_list)
+            elif kind == 'int' and elem_count != 1:
+                values = list(zip(*columns[start : start + elem_count]))
+            else:
+                values = list(columns[start])
+            result[name] = values
+        return result
+
+
 class EventStruct(ct.Structure):
     """Event type of a sample.
        name: name of the event type.
@@ -222,17 +347,58 @@ class ReportLibStructure(ct.Structure):
     _fields_ = []
 
 
+class _SampleCopy(object):
+    """ A copy of the current sample and its related data, which stays valid after moving to
+        the next sample. Strings and mappings are copied to python objects kept in keep_alive.
+    """
+    def __init__(self, sample, event, symbol, callchain, tracing_data):
+        self.sample = sample
+        self.event = event
+        self.symbol = symbol
+        self.callchain = callchain
+        self.tracing_data = tracing_data
+        self.keep_alive = []
+
+
+# Map from native lib paths to loaded native libs, shared by all ReportLib instances.
+_native_libs = {}
+
+
+def _load_native_lib(native_lib_path):
+    """ Load the native lib and set prototypes of its functions, only once per process. """
+    lib = _native_libs.get(native_lib_path)
+    if lib is not None:
+        return lib
+    # As the windows dll is built with mingw we need to load 'libwinpthread-1.dll'.
+    if is_windows() and 'libwinpthread' not in _native_libs:
+        _native_libs['libwinpthread'] = ct.CDLL(get_host_binary_path('libwinpthread-1.dll'))
+    lib = ct.CDLL(native_lib_path)
+    lib.CreateReportLib.restype = ct.POINTER(ReportLibStructure)
+    lib.GetNextSample.restype = ct.POINTER(SampleStruct)
+    lib.GetEventOfCurrentSample.restype = ct.POINTER(EventStruct)
+    lib.GetSymbolOfCurrentSample.restype = ct.POINTER(SymbolStruct)
+    lib.GetCallChainOfCurrentSample.restype = ct.POINTER(CallChainStructure)
+    lib.GetTracingDataOfCurrentSample.restype = ct.POINTER(ct.c_char)
+    lib.GetBuildIdForPath.restype = ct.c_char_p
+    lib.GetFeatureSection.restype = ct.POINTER(FeatureSectionStructure)
+    _native_libs[native_lib_path] = lib
+    return lib
+
+
 # pylint: disable=invalid-name
 class ReportLib(object):
+    """ Read samples in record files through the native lib.
+        A ReportLib instance can read several record files one after another, by calling
+        SetRecordFile() for each of them. It can be used in a with statement to close it
+        deterministically.
+    """
 
     def __init__(self, native_lib_path=None):
         if native_lib_path is None:
             native_lib_path = _get_native_lib()
 
-        self._load_dependent_lib()
-        self._lib = ct.CDLL(native_lib_path)
+        self._lib = _load_native_lib(native_lib_path)
         self._CreateReportLibFunc = self._lib.CreateReportLib
-        self._CreateReportLibFunc.restype = ct.POINTER(ReportLibStructure)
         self._DestroyReportLibFunc = self._lib.DestroyReportLib
         self._SetLogSeverityFunc = self._lib.SetLogSeverity
         self._SetSymfsFunc = self._lib.SetSymfs
@@ -241,30 +407,48 @@ class ReportLib(object):
         self._ShowIpForUnknownSymbolFunc = self._lib.ShowIpForUnknownSymbol
         self._ShowArtFramesFunc = self._lib.ShowArtFrames
         self._GetNextSampleFunc = self._lib.GetNextSample
-        self._GetNextSampleFunc.restype = ct.POINTER(SampleStruct)
         self._GetEventOfCurrentSampleFunc = self._lib.GetEventOfCurrentSample
-        self._GetEventOfCurrentSampleFunc.restype = ct.POINTER(EventStruct)
         self._GetSymbolOfCurrentSampleFunc = self._lib.GetSymbolOfCurrentSample
-        self._GetSymbolOfCurrentSampleFunc.restype = ct.POINTER(SymbolStruct)
         self._GetCallChainOfCurrentSampleFunc = self._lib.GetCallChainOfCurrentSample
-        self._GetCallChainOfCurrentSampleFunc.restype = ct.POINTER(CallChainStructure)
         self._GetTracingDataOfCurrentSampleFunc = self._lib.GetTracingDataOfCurrentSample
-        self._GetTracingDataOfCurrentSampleFunc.restype = ct.POINTER(ct.c_char)
         self._GetBuildIdForPathFunc = self._lib.GetBuildIdForPath
-        self._GetBuildIdForPathFunc.restype = ct.c_char_p
         self._GetFeatureSection = self._lib.GetFeatureSection
-        self._GetFeatureSection.restype = ct.POINTER(FeatureSectionStructure)
+        self._instance = None
+        # Map from option names to (native function, args) of options set on the native
+        # instance, which are set again on a new native instance created by Reset().
+        self._options = collections.OrderedDict()
+        self._sample_rate = 1
+        self._max_samples = None
+        self.Reset()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.Close()
+
+    def Reset(self):
+        """ Start reading a record file from the beginning, by replacing the native instance
+            with a new one. Options set before (like symfs, kallsyms file, sample rate) are kept,
+            while the record file is reset to the default perf.data.
+        """
+        if self._instance is not None:
+            self._DestroyReportLibFunc(self._instance)
         self._instance = self._CreateReportLibFunc()
         assert not _is_null(self._instance)
-
+        for func, args in self._options.values():
+            func(self._instance, *args)
+        self._record_file_opened = False
         self.meta_info = None
         self.current_sample = None
         self.record_cmd = None
-
-    def _load_dependent_lib(self):
-        # As the windows dll is built with mingw we need to load 'libwinpthread-1.dll'.
-        if is_windows():
-            self._libwinpthread = ct.CDLL(get_host_binary_path('libwinpthread-1.dll'))
+        self._random = random.Random(0)
+        self._reservoir = None
+        self._current_copy = None
+        self._string_copies = {}
+        self._tracing_data_decoders = {}
+        self._feature_sections = {}
+        self._reading_samples = False
 
     def Close(self):
         if self._instance is None:
@@ -272,115 +456,273 @@ class ReportLib(object):
         self._DestroyReportLibFunc(self._instance)
         self._instance = None
 
+    def _SetOption(self, name, failmsg, func, *args):
+        """ Set an option on the native instance, and remember it for Reset(). If failmsg isn't
+            None, func returns whether the option is set, and a failed option isn't remembered.
+        """
+        result = func(self.getInstance(), *args)
+        if failmsg is not None:
+            _check(result, failmsg)
+        self._options[name] = (func, args)
+
     def SetLogSeverity(self, log_level='info'):
         """ Set log severity of native lib, can be verbose,debug,info,error,fatal."""
-        cond = self._SetLogSeverityFunc(self.getInstance(), _char_pt(log_level))
-        _check(cond, 'Failed to set log level')
+        self._SetOption('log_severity', 'Failed to set log level', self._SetLogSeverityFunc,
+                        _char_pt(log_level))
 
     def SetSymfs(self, symfs_dir):
         """ Set directory used to find symbols."""
-        cond = self._SetSymfsFunc(self.getInstance(), _char_pt(symfs_dir))
-        _check(cond, 'Failed to set symbols directory')
+        self._SetOption('symfs', 'Failed to set symbols directory', self._SetSymfsFunc,
+                        _char_pt(symfs_dir))
 
     def SetRecordFile(self, record_file):
-        """ Set the path of record file, like perf.data."""
+        """ Set the path of record file, like perf.data. If a record file has been read, the
+            instance is reset to read the new one.
+        """
+        if self._record_file_opened:
+            self.Reset()
         cond = self._SetRecordFileFunc(self.getInstance(), _char_pt(record_file))
         _check(cond, 'Failed to set record file')
 
     def ShowIpForUnknownSymbol(self):
-        self._ShowIpForUnknownSymbolFunc(self.getInstance())
+        self._SetOption('show_ip_for_unknown_symbol', None, self._ShowIpForUnknownSymbolFunc)
 
     def ShowArtFrames(self, show=True):
         """ Show frames of internal methods of the Java interpreter. """
-        self._ShowArtFramesFunc(self.getInstance(), show)
+        self._SetOption('show_art_frames', None, self._ShowArtFramesFunc, show)
 
     def SetKallsymsFile(self, kallsym_file):
         """ Set the file path to a copy of the /proc/kallsyms file (for off device decoding) """
-        cond = self._SetKallsymsFileFunc(self.getInstance(), _char_pt(kallsym_file))
-        _check(cond, 'Failed to set kallsyms file')
+        self._SetOption('kallsyms', 'Failed to set kallsyms file', self._SetKallsymsFileFunc,
+                        _char_pt(kallsym_file))
+
+    def SetSampleRate(self, sample_rate):
+        """ Only report a uniformly random subset of samples, each sample is reported with
+            probability 1 / sample_rate. The period of a reported sample is multiplied by
+            sample_rate, so event counts stay unbiased. Used to generate quick preview reports.
+        """
+        _check(sample_rate >= 1, 'Invalid sample rate')
+        self._sample_rate = sample_rate
+
+    def SetMaxSamples(self, max_samples):
+        """ Only report a uniformly random subset of at most max_samples samples, selected by
+            reservoir sampling. Selected samples are copied when reading the record file, and
+            reported in their original order after all samples are read. Their periods are
+            scaled by (sample count / max_samples), so event counts stay unbiased.
+        """
+        _check(max_samples > 0, 'Invalid max samples')
+        self._max_samples = max_samples
 
     def GetNextSample(self):
+        if self._max_samples is not None:
+            return self._GetNextSampleFromReservoir()
+        self._record_file_opened = True
+        self._reading_samples = True
         psample = self._GetNextSampleFunc(self.getInstance())
+        if self._sample_rate > 1:
+            keep_ratio = 1.0 / self._sample_rate
+            while not _is_null(psample) and self._random.random() >= keep_ratio:
+                psample = self._GetNextSampleFunc(self.getInstance())
         if _is_null(psample):
             self.current_sample = None
+            self._reading_samples = False
+        elif self._sample_rate > 1:
+            # Don't modify the sample owned by the native lib.
+            self.current_sample = SampleStruct.from_buffer_copy(psample[0])
+            self.current_sample.period *= self._sample_rate
         else:
             self.current_sample = psample[0]
         return self.current_sample
 
+    def _GetNextSampleFromReservoir(self):
+        if self._reservoir is None:
+            self._FillReservoir()
+        if not self._reservoir:
+            self._current_copy = self.current_sample = None
+        else:
+            self._current_copy = self._reservoir.popleft()
+            self.current_sample = self._current_copy.sample
+        return self.current_sample
+
+    def _FillReservoir(self):
+        max_samples = self._max_samples
+        self._max_samples = None
+        reservoir = []  # list of (sample index, _SampleCopy).
+        sample_count = 0
+        while self.GetNextSample() is not None:
+            if len(reservoir) < max_samples:
+                reservoir.append((sample_count, self._CopyCurrentSample()))
+            else:
+                pos = self._random.randint(0, sample_count)
+                if pos < max_samples:
+                    reservoir[pos] = (sample_count, self._CopyCurrentSample())
+            sample_count += 1
+        self._max_samples = max_samples
+        self._string_copies = {}
+        reservoir.sort(key=lambda item: item[0])
+        if sample_count > max_samples:
+            scale = float(sample_count) / max_samples
+            for _, sample_copy in reservoir:
+                sample_copy.sample.period = int(round(sample_copy.sample.period * scale))
+        self._reservoir = collections.deque(item[1] for item in reservoir)
+
+    def _CopyCurrentSample(self):
+        sample = SampleStruct.from_buffer_copy(self.current_sample)
+        event = EventStruct.from_buffer_copy(self.GetEventOfCurrentSample())
+        symbol = self.GetSymbolOfCurrentSample()
+        callchain = self.GetCallChainOfCurrentSample()
+        tracing_data = self.GetRawTracingDataOfCurrentSample()
+        sample_copy = _SampleCopy(sample, event, None, CallChainStructure(), tracing_data)
+        keep_alive = sample_copy.keep_alive
+        sample._thread_comm = self._CopyString(sample._thread_comm)
+        sample_copy.symbol = self._CopySymbol(symbol, keep_alive)
+        entries = (CallChainEntryStructure * callchain.nr)()
+        for i in range(callchain.nr):
+            entries[i].ip = callchain.entries[i].ip
+            entries[i].symbol = self._CopySymbol(callchain.entries[i].symbol, keep_alive)
+        keep_alive.append(entries)
+        sample_copy.callchain.nr = callchain.nr
+        sample_copy.callchain.entries = ct.cast(entries, ct.POINTER(CallChainEntryStructure))
+        return sample_copy
+
+    def _CopySymbol(self, symbol, keep_alive):
+        symbol_copy = SymbolStruct.from_buffer_copy(symbol)
+        symbol_copy._dso_name = self._CopyString(symbol._dso_name)
+        symbol_copy._symbol_name = self._CopyString(symbol._symbol_name)
+        if not _is_null(symbol.mapping):
+            mapping = MappingStruct.from_buffer_copy(symbol.mapping[0])
+            keep_alive.append(mapping)
+            symbol_copy.mapping = ct.pointer(mapping)
+        keep_alive.append(symbol_copy)
+        return symbol_copy
+
+    def _CopyString(self, value):
+        # Share copies of the same string, and keep them alive as long as the reservoir.
+        return self._string_copies.setdefault(value, value)
+
     def GetCurrentSample(self):
         return self.current_sample
 
     def GetEventOfCurrentSample(self):
+        if self._current_copy:
+            return self._current_copy.event
         event = self._GetEventOfCurrentSampleFunc(self.getInstance())
         assert not _is_null(event)
         return event[0]
 
     def GetSymbolOfCurrentSample(self):
+        if self._current_copy:
+            return self._current_copy.symbol
         symbol = self._GetSymbolOfCurrentSampleFunc(self.getInstance())
         assert not _is_null(symbol)
         return symbol[0]
 
     def GetCallChainOfCurrentSample(self):
+        if self._current_copy:
+            return self._current_copy.callchain
         callchain = self._GetCallChainOfCurrentSampleFunc(self.getInstance())
         assert not _is_null(callchain)
         return callchain[0]
 
-    def GetTracingDataOfCurrentSample(self):
+    def GetRawTracingDataOfCurrentSample(self):
+        """ Return tracing data of the current sample as a bytes object, or None if the sample
+            isn't of a tracepoint event. To decode tracing data of many samples in a batch, collect
+            raw data per event and pass them to TracingDataDecoder.decode_columns().
+        """
+        if self._current_copy:
+            return self._current_copy.tracing_data
         data = self._GetTracingDataOfCurrentSampleFunc(self.getInstance())
         if _is_null(data):
             return None
-        event = self.GetEventOfCurrentSample()
-        result = collections.OrderedDict()
-        for i in range(event.tracing_data_format.field_count):
-            field = event.tracing_data_format.fields[i]
-            result[field.name] = field.parse_value(data)
-        return result
+        return ct.string_at(data, self.GetEventOfCurrentSample().tracing_data_format.size)
+
+    def GetTracingDataDecoder(self, event=None):
+        """ Return the TracingDataDecoder of an event, which is the event of the current sample
+            by default. Decoders are compiled once per event and reused.
+        """
+        if event is None:
+            event = self.GetEventOfCurrentSample()
+        decoder = self._tracing_data_decoders.get(event._name)
+        if decoder is None:
+            decoder = TracingDataDecoder(event.tracing_data_format)
+            self._tracing_data_decoders[event._name] = decoder
+        return decoder
+
+    def GetTracingDataOfCurrentSample(self):
+        data = self.GetRawTracingDataOfCurrentSample()
+        if data is None:
+            return None
+        decoder = self.GetTracingDataDecoder()
+        return collections.OrderedDict(zip(decoder.field_names, decoder.decode(data)))
 
     def GetBuildIdForPath(self, path):
+        self._record_file_opened = True
         build_id = self._GetBuildIdForPathFunc(self.getInstance(), _char_pt(path))
         assert not _is_null(build_id)
         return _char_pt_to_str(build_id)
 
+    def _GetFeatureSectionData(self, feature_name):
+        """ Return data of a feature section as a bytes object, or None if the section doesn't
+            exist. The native lib reuses one buffer for all sections, so the data is copied with
+            a single ct.string_at() call. Sections not in LARGE_FEATURE_NAMES are cached.
+        """
+        if feature_name in self._feature_sections:
+            return self._feature_sections[feature_name]
+        # The native lib reads feature sections and records at the same file position. So reading
+        # a feature section between two samples breaks reading the following samples.
+        _check(not self._reading_samples,
+               "Can't read feature section %s while reading samples" % feature_name)
+        self._record_file_opened = True
+        feature_data = self._GetFeatureSection(self.getInstance(), _char_pt(feature_name))
+        data = None
+        if not _is_null(feature_data):
+            data = ct.string_at(feature_data[0].data, feature_data[0].data_size)
+        if feature_name not in LARGE_FEATURE_NAMES:
+            self._feature_sections[feature_name] = data
+        return data
+
+    def GetFeatureSections(self, feature_names=None):
+        """ Return a map from feature names to data (bytes objects) of feature sections in the
+            record file. feature_names selects the sections to read. By default, all sections
+            except those in LARGE_FEATURE_NAMES are read.
+            Feature sections should be read before reading samples, or after GetNextSample()
+            returns None.
+        """
+        if feature_names is None:
+            feature_names = [x for x in FEATURE_NAMES if x not in LARGE_FEATURE_NAMES]
+        result = {}
+        for feature_name in feature_names:
+            data = self._GetFeatureSectionData(feature_name)
+            if data is not None:
+                result[feature_name] = data
+        return result
+
     def GetRecordCmd(self):
         if self.record_cmd is not None:
             return self.record_cmd
+        data = self._GetFeatureSectionData('cmdline')
         self.record_cmd = ''
-        feature_data = self._GetFeatureSection(self.getInstance(), _char_pt('cmdline'))
-        if not _is_null(feature_data):
-            void_p = ct.cast(feature_data[0].data, ct.c_void_p)
-            arg_count = ct.cast(void_p, ct.POINTER(ct.c_uint32)).contents.value
-            void_p.value += 4
+        if data is not None:
+            arg_count = struct.unpack_from('=I', data)[0]
+            offset = 4
             args = []
             for _ in range(arg_count):
-                str_len = ct.cast(void_p, ct.POINTER(ct.c_uint32)).contents.value
-                void_p.value += 4
-                char_p = ct.cast(void_p, ct.POINTER(ct.c_char))
-                current_str = ''
-                for j in range(str_len):
-                    c = bytes_to_str(char_p[j])
-                    if c != '\0':
-                        current_str += c
+                str_len = struct.unpack_from('=I', data, offset)[0]
+                offset += 4
+                current_str = bytes_to_str(data[offset : offset + str_len].replace(b'\x00', b''))
                 if ' ' in current_str:
                     current_str = '"' + current_str + '"'
                 args.append(current_str)
-                void_p.value += str_len
+                offset += str_len
             self.record_cmd = ' '.join(args)
         return self.record_cmd
 
     def _GetFeatureString(self, feature_name):
-        feature_data = self._GetFeatureSection(self.getInstance(), _char_pt(feature_name))
-        result = ''
-        if not _is_null(feature_data):
-            void_p = ct.cast(feature_data[0].data, ct.c_void_p)
-            str_len = ct.cast(void_p, ct.POINTER(ct.c_uint32)).contents.value
-            void_p.value += 4
-            char_p = ct.cast(void_p, ct.POINTER(ct.c_char))
-            for i in range(str_len):
-                c = bytes_to_str(char_p[i])
-                if c == '\0':
-                    break
-                result += c
-        return result
+        data = self._GetFeatureSectionData(feature_name)
+        if data is None:
+            return ''
+        str_len = struct.unpack_from('=I', data)[0]
+        return _parse_string(data[4 : 4 + str_len])
 
     def GetArch(self):
         return self._GetFeatureString('arch')
@@ -390,20 +732,11 @@ class ReportLib(object):
             It is used to pass some short meta information.
         """
         if self.meta_info is None:
+            data = self._GetFeatureSectionData('meta_info')
             self.meta_info = {}
-            feature_data = self._GetFeatureSection(self.getInstance(), _char_pt('meta_info'))
-            if not _is_null(feature_data):
-                str_list = []
-                data = feature_data[0].data
-                data_size = feature_data[0].data_size
-                current_str = ''
-                for i in range(data_size):
-                    c = bytes_to_str(data[i])
-                    if c != '\0':
-                        current_str += c
-                    else:
-                        str_list.append(current_str)
-                        current_str = ''
+            if data is not None:
+                # Each string ends with a '\0'.
+                str_list = [bytes_to_str(x) for x in data.split(b'\x00')[:-1]]
                 for i in range(0, len(str_list), 2):
                     self.meta_info[str_list[i]] = str_list[i + 1]
         return self.meta_info
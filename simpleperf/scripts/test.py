@@ -36,25 +36,50 @@ Test using both `adb root` and `adb unroot`.
 """
 from __future__ import print_function
 import argparse
+import collections
+import ctypes as ct
 import filecmp
 import fnmatch
 import inspect
+import json
 import os
 import re
 import shutil
 import signal
+import struct
 import subprocess
 import sys
 import time
 import types
 import unittest
+from xml.etree import ElementTree
 
+from annotate import Period, SourceFileAnnotator, SourceLine
 from app_profiler import NativeLibDownloader
 from binary_cache_builder import BinaryCacheBuilder
-from simpleperf_report_lib import ReportLib
+from debug_unwind_reporter import iter_dump_records, LatencyHistogram, parse_dump_output
+from debug_unwind_reporter import UnwindingTimes
+from report_html import CallNode, EventScope, OnlinePruner, SourceFileSet
+from simpleperf_report_lib import ReportLib, TracingDataDecoder, TracingDataFormatStruct
+from simpleperf_report_lib import TracingFieldFormatStruct
 from utils import log_exit, log_info, log_fatal
-from utils import AdbHelper, Addr2Nearestline, bytes_to_str, find_tool_path, get_script_dir
-from utils import is_python3, is_windows, Objdump, ReadElf, remove, SourceFileSearcher
+from utils import AdbHelper, Addr2Nearestline, bytes_to_str, check_sampling_args, find_tool_path
+from utils import get_line_offset_index, get_script_dir, is_python3, is_windows, Objdump, ReadElf
+from utils import ONLINE_PRUNING_ERROR_RATIO, remove, SourceFileSearcher, str_to_bytes
+
+# pylint: disable=wrong-import-position
+sys.path.append(os.path.join(get_script_dir(), 'inferno'))
+from canvas_renderer import gen_canvas_data, NODE_FIELDS
+from data_types import CallSiteTable, FlameGraphCallSite, OffCpuBreakdown, Process
+from inferno.inferno import get_sample_interval_ns
+from svg_renderer import DEFAULT_MIN_NODE_WIDTH, get_diff_color, get_legacy_color
+from svg_renderer import get_visible_children
+from svg_renderer import render_svg
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
 
 try:
     # pylint: disable=unused-import
@@ -302,6 +327,15 @@ class TestExampleBase(TestBase):
         self.run_cmd(["report_sample.py"])
         output = self.run_cmd(["report_sample.py", "perf.data"], return_output=True)
         self.check_strings_in_content(output, check_strings)
+        self.run_cmd(["report_sample.py", "--output_format", "protobuf", "-o", "samples.pb"])
+        with open("samples.pb", "rb") as f:
+            self.assertEqual(f.read(10), b"SIMPLEPERF")
+        self.run_cmd(["report_sample.py", "--output_format", "chrome_trace", "-o",
+                      "samples.json"])
+        with open("samples.json", "r") as f:
+            data = json.load(f)
+        self.assertTrue(data["samples"])
+        self.assertTrue(data["stackFrames"])
 
     def common_test_pprof_proto_generator(self, check_strings_with_lines,
                                           check_strings_without_lines):
@@ -317,6 +351,13 @@ class TestExampleBase(TestBase):
         output = self.run_cmd(["pprof_proto_generator.py", "--show", "pprof.profile"],
                               return_output=True)
         self.check_strings_in_content(output, check_strings_with_lines + ["has_line_numbers: True"])
+        # Merge samples in multiple record files.
+        shutil.copy("perf.data", "perf2.data")
+        self.run_cmd(["pprof_proto_generator.py", "-i", "perf.data", "perf2.data", "-j", "2"])
+        output = self.run_cmd(["pprof_proto_generator.py", "--show", "pprof.profile"],
+                              return_output=True)
+        self.check_strings_in_content(output, check_strings_with_lines)
+        remove("perf2.data")
         remove("binary_cache")
         self.run_cmd(["pprof_proto_generator.py"])
         output = self.run_cmd(["pprof_proto_generator.py", "--show", "pprof.profile"],
@@ -855,6 +896,17 @@ class TestReportLib(unittest.TestCase):
         build_id = self.report_lib.GetBuildIdForPath('/data/t2')
         self.assertEqual(build_id, '0x70f1fe24500fc8b0d9eb477199ca1ca21acca4de')
 
+    def test_failed_option_is_not_kept(self):
+        self.report_lib.SetLogSeverity('error')
+        with self.assertRaises(RuntimeError):
+            self.report_lib.SetLogSeverity('invalid_level')
+        with self.assertRaises(RuntimeError):
+            self.report_lib.SetSymfs('non_exist_dir')
+        # Only options set successfully are set again when the instance is reset.
+        options = self.report_lib._options  # pylint: disable=protected-access
+        self.assertEqual(list(options), ['log_severity'])
+        self.assertEqual(options['log_severity'][1], (str_to_bytes('error'),))
+
     def test_symbol(self):
         found_func2 = False
         while self.report_lib.GetNextSample():
@@ -899,12 +951,74 @@ class TestReportLib(unittest.TestCase):
         self.assertTrue('sched:sched_switch' in event_names)
         self.assertTrue('cpu-cycles' in event_names)
 
+    def _get_event_count_and_samples(self):
+        event_count = 0
+        samples = []
+        while self.report_lib.GetNextSample():
+            sample = self.report_lib.GetCurrentSample()
+            event_count += sample.period
+            callchain = self.report_lib.GetCallChainOfCurrentSample()
+            samples.append((sample.time, self.report_lib.GetSymbolOfCurrentSample().symbol_name,
+                            [callchain.entries[i].symbol.dso_name for i in range(callchain.nr)]))
+        return event_count, samples
+
+    def test_sample_rate(self):
+        record_file = os.path.join('testdata', 'perf_with_interpreter_frames.data')
+        self.report_lib.SetRecordFile(record_file)
+        event_count, samples = self._get_event_count_and_samples()
+        self.report_lib.Close()
+        self.report_lib = ReportLib()
+        self.report_lib.SetRecordFile(record_file)
+        self.report_lib.SetSampleRate(4)
+        sampled_event_count, sampled_samples = self._get_event_count_and_samples()
+        self.assertLess(len(sampled_samples), len(samples))
+        self.assertGreater(sampled_event_count, event_count * 0.5)
+        self.assertLess(sampled_event_count, event_count * 1.5)
+
+    def test_max_samples(self):
+        record_file = os.path.join('testdata', 'perf_with_interpreter_frames.data')
+        self.report_lib.SetRecordFile(record_file)
+        event_count, samples = self._get_event_count_and_samples()
+        self.report_lib.Close()
+        self.report_lib = ReportLib()
+        self.report_lib.SetRecordFile(record_file)
+        self.report_lib.SetMaxSamples(100)
+        sampled_event_count, sampled_samples = self._get_event_count_and_samples()
+        self.assertEqual(len(sampled_samples), 100)
+        # Selected samples keep their data and original order after being copied.
+        times = [sample[0] for sample in sampled_samples]
+        self.assertEqual(times, sorted(times))
+        sample_dict = dict((sample[0], sample) for sample in samples)
+        for sample in sampled_samples:
+            self.assertEqual(sample, sample_dict[sample[0]])
+        self.assertGreater(sampled_event_count, event_count * 0.5)
+        self.assertLess(sampled_event_count, event_count * 1.5)
+
     def test_record_cmd(self):
         self.report_lib.SetRecordFile(os.path.join('testdata', 'perf_with_trace_offcpu.data'))
         self.assertEqual(self.report_lib.GetRecordCmd(),
                          "/data/local/tmp/simpleperf record --trace-offcpu --duration 2 -g " +
                          "./simpleperf_runtest_run_and_sleep64")
 
+    def test_feature_sections(self):
+        self.report_lib.SetRecordFile(os.path.join('testdata', 'perf_with_trace_offcpu.data'))
+        sections = self.report_lib.GetFeatureSections()
+        self.assertIn('cmdline', sections)
+        self.assertIn('arch', sections)
+        self.assertIn(str_to_bytes(self.report_lib.GetArch()), sections['arch'])
+        self.assertIs(self.report_lib.GetFeatureSections()['cmdline'], sections['cmdline'])
+        # Large sections are only read when asked for.
+        self.assertNotIn('build_id', sections)
+        self.assertIn('build_id', self.report_lib.GetFeatureSections(['build_id']))
+        # Uncached sections can't be read in the middle of reading samples.
+        self.assertIsNotNone(self.report_lib.GetNextSample())
+        self.assertIs(self.report_lib.GetFeatureSections()['cmdline'], sections['cmdline'])
+        with self.assertRaises(RuntimeError):
+            self.report_lib.GetFeatureSections(['build_id'])
+        while self.report_lib.GetNextSample() is not None:
+            pass
+        self.assertIn('build_id', self.report_lib.GetFeatureSections(['build_id']))
+
     def test_offcpu(self):
         self.report_lib.SetRecordFile(os.path.join('testdata', 'perf_with_trace_offcpu.data'))
         total_period = 0
@@ -947,6 +1061,27 @@ class TestReportLib(unittest.TestCase):
         report_lib.ShowArtFrames(True)
         self.assertTrue(has_art_frame(report_lib))
 
+    def test_reuse_for_record_files(self):
+        def get_sample_times(report_lib, record_file):
+            report_lib.SetRecordFile(os.path.join('testdata', record_file))
+            times = []
+            while report_lib.GetNextSample():
+                times.append(report_lib.GetCurrentSample().time)
+            return times
+
+        expected = {}
+        record_files = ['perf_with_symbols.data', 'perf_with_trace_offcpu.data']
+        for record_file in record_files:
+            with ReportLib() as report_lib:
+                expected[record_file] = get_sample_times(report_lib, record_file)
+            self.assertRaises(Exception, report_lib.getInstance)
+        with ReportLib() as report_lib:
+            for record_file in record_files + record_files:
+                self.assertEqual(get_sample_times(report_lib, record_file), expected[record_file])
+            self.assertEqual(report_lib.GetRecordCmd(),
+                             "/data/local/tmp/simpleperf record --trace-offcpu --duration 2 -g " +
+                             "./simpleperf_runtest_run_and_sleep64")
+
     def test_tracing_data(self):
         self.report_lib.SetRecordFile(os.path.join('testdata', 'perf_with_tracepoint_event.data'))
         has_tracing_data = False
@@ -963,6 +1098,51 @@ class TestReportLib(unittest.TestCase):
                 self.assertIsNone(tracing_data)
         self.assertTrue(has_tracing_data)
 
+    def test_tracing_data_decode_columns(self):
+        self.report_lib.SetRecordFile(os.path.join('testdata', 'perf_with_tracepoint_event.data'))
+        raw_data_list = []
+        expected_rows = []
+        while self.report_lib.GetNextSample():
+            if self.report_lib.GetEventOfCurrentSample().name == 'sched:sched_switch':
+                decoder = self.report_lib.GetTracingDataDecoder()
+                raw_data_list.append(self.report_lib.GetRawTracingDataOfCurrentSample())
+                expected_rows.append(self.report_lib.GetTracingDataOfCurrentSample())
+        self.assertTrue(raw_data_list)
+        columns = decoder.decode_columns(raw_data_list)
+        self.assertIn(9896, columns['prev_pid'])
+        for i, row in enumerate(expected_rows):
+            self.assertEqual(row, collections.OrderedDict(
+                (name, values[i]) for name, values in columns.items()))
+
+
+class TestTracingDataDecoder(unittest.TestCase):
+    def create_data_format(self, size, fields):
+        """ fields is a list of (name, offset, elem_size, elem_count, is_signed). """
+        field_array = (TracingFieldFormatStruct * len(fields))(
+            *[TracingFieldFormatStruct(str_to_bytes(field[0]), *field[1:]) for field in fields])
+        self.field_array = field_array  # Keep the array alive while the format is used.
+        return TracingDataFormatStruct(size, len(fields), ct.cast(
+            field_array, ct.POINTER(TracingFieldFormatStruct)))
+
+    def test_decode(self):
+        data_format = self.create_data_format(16, [
+            ('pid', 0, 4, 1, 1),
+            ('comm', 4, 1, 4, 0),
+            ('raw', 8, 3, 2, 0),
+            ('empty', 14, 0, 3, 0),
+            ('empty_one', 14, 0, 1, 0),
+            ('shorts', 14, 2, 1, 0),
+        ])
+        data = struct.pack('=i4s6sH', -2, b'ab\x00c', b'123456', 7)
+        expected = [-2, 'ab', [b'123', b'456'], [b'', b'', b''], b'', 7]
+        decoder = TracingDataDecoder(data_format)
+        self.assertEqual(decoder.decode(data), expected)
+        fields = [data_format.fields[i] for i in range(data_format.field_count)]
+        self.assertEqual([field.parse_value(data) for field in fields], expected)
+        columns = decoder.decode_columns([data, data])
+        self.assertEqual(list(columns), decoder.field_names)
+        self.assertEqual(list(columns.values()), [[value, value] for value in expected])
+
 
 class TestRunSimpleperfOnDevice(TestBase):
     def test_smoke(self):
@@ -974,7 +1154,11 @@ class TestTools(unittest.TestCase):
         self.run_addr2nearestline_test(True)
         self.run_addr2nearestline_test(False)
 
-    def run_addr2nearestline_test(self, with_function_name):
+    def test_addr2nearestline_with_jobs(self):
+        self.run_addr2nearestline_test(True, jobs=2)
+        self.run_addr2nearestline_test(False, jobs=2)
+
+    def run_addr2nearestline_test(self, with_function_name, jobs=1):
         binary_cache_path = 'testdata'
         test_map = {
             '/simpleperf_runtest_two_functions_arm64': [
@@ -1049,7 +1233,7 @@ class TestTools(unittest.TestCase):
             test_addrs = test_map[dso_path]
             for test_addr in test_addrs:
                 addr2line.add_addr(dso_path, test_addr['func_addr'], test_addr['addr'])
-        addr2line.convert_addrs_to_lines()
+        addr2line.convert_addrs_to_lines(jobs)
         for dso_path in test_map:
             dso = addr2line.get_dso(dso_path)
             self.assertTrue(dso is not None)
@@ -1187,6 +1371,70 @@ class TestTools(unittest.TestCase):
                         'simpleperf/simpleperfexampleofkotlin/MainActivity.kt'),
             searcher.get_real_path('MainActivity.kt'))
 
+    def test_source_file_searcher_index(self):
+        index_file = 'source_file_index_test'
+        source_dir = 'source_file_index_test_dir'
+        remove(index_file)
+        remove(source_dir)
+        def create_file(path):
+            dirname = os.path.dirname(path)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            with open(path, 'w'):
+                pass
+        create_file(os.path.join(source_dir, 'a', 'main.cpp'))
+        searcher = SourceFileSearcher([source_dir], index_file)
+        self.assertTrue(os.path.isfile(index_file))
+        self.assertIsNone(searcher.get_real_path('new.cpp'))
+        # Modified directories are listed again when loading the index.
+        create_file(os.path.join(source_dir, 'b', 'main.cpp'))
+        create_file(os.path.join(source_dir, 'b', 'new.cpp'))
+        os.utime(source_dir, (0, 0))
+        searcher = SourceFileSearcher([source_dir], index_file)
+        self.assertEqual(os.path.join(source_dir, 'b', 'new.cpp'),
+                         searcher.get_real_path('new.cpp'))
+        # Select the path with the longest common suffix.
+        self.assertEqual(os.path.join(source_dir, 'a', 'main.cpp'),
+                         searcher.get_real_path('/src/a/main.cpp'))
+        self.assertEqual(os.path.join(source_dir, 'b', 'main.cpp'),
+                         searcher.get_real_path('/src/b/main.cpp'))
+        # The index is saved as json, and a broken index is rebuilt.
+        with open(index_file, 'r') as f:
+            self.assertIn(source_dir, json.load(f)['dirs'])
+        for content in ['', '{"version": 3}', '[1, 2]', '\x80\x02}q\x00.']:
+            with open(index_file, 'w') as f:
+                f.write(content)
+            searcher = SourceFileSearcher([source_dir], index_file)
+            self.assertEqual(os.path.join(source_dir, 'b', 'new.cpp'),
+                             searcher.get_real_path('new.cpp'))
+            with open(index_file, 'r') as f:
+                self.assertIn(source_dir, json.load(f)['dirs'])
+        remove(index_file)
+        remove(source_dir)
+
+    def test_check_sampling_args(self):
+        check_sampling_args(argparse.Namespace(sample_rate=1, max_samples=None))
+        check_sampling_args(argparse.Namespace(sample_rate=4, max_samples=100))
+        for sample_rate, max_samples in [(0, None), (-1, None), (1, 0), (1, -5)]:
+            with self.assertRaises(SystemExit):
+                check_sampling_args(argparse.Namespace(sample_rate=sample_rate,
+                                                       max_samples=max_samples))
+
+    def test_line_offset_index(self):
+        path = 'line_offset_index_test.txt'
+        with open(path, 'wb') as f:
+            f.write(b'line1\nline2\r\n\nline4')
+        index = get_line_offset_index(path)
+        self.assertEqual(index.get_lines([2]), {2: 'line2\n'})
+        self.assertFalse(index.scanned_all)
+        self.assertEqual(index.get_lines([0, 1, 3, 4, 5]), {1: 'line1\n', 3: '\n', 4: 'line4'})
+        self.assertTrue(get_line_offset_index(path) is index)
+        with open(path, 'wb') as f:
+            f.write(b'new_line1\n')
+        os.utime(path, (0, 0))
+        self.assertEqual(get_line_offset_index(path).get_lines([1, 2]), {1: 'new_line1\n'})
+        remove(path)
+
 
 class TestNativeLibDownloader(unittest.TestCase):
     def test_smoke(self):
@@ -1239,6 +1487,807 @@ class TestReportHtml(TestBase):
     def test_long_callchain(self):
         self.run_cmd(['report_html.py', '-i', 'testdata/perf_with_long_callchain.data'])
 
+    def test_online_pruning(self):
+        def build_thread(use_pruner):
+            event = EventScope('cpu-cycles')
+            if use_pruner:
+                event.pruner = OnlinePruner(event, 1, 5)
+            thread = event.get_process(1).get_thread(1, 't1')
+            seed = 1
+            for _ in range(20000):
+                seed = (seed * 1103515245 + 12345) % (2 ** 31)
+                # Skewed callstacks: small ids are much more likely than large ids.
+                callstack = [(0, (seed >> shift) % (1 + (seed >> 20) % 40), 0)
+                             for shift in (3, 8, 13)]
+                event.event_count += 1
+                thread.event_count += 1
+                thread.add_callstack(1, callstack, False)
+            thread.update_subtree_event_count()
+            return thread
+
+        def collect_nodes(node, path, result):
+            for child in node.children.values():
+                child_path = path + (child.func_id,)
+                result[child_path] = child.subtree_event_count
+                collect_nodes(child, child_path, result)
+            return result
+
+        exact = build_thread(False)
+        approx = build_thread(True)
+        approx.pruner.prune(approx)
+        exact_nodes = collect_nodes(exact.call_graph, (), {})
+        approx_nodes = collect_nodes(approx.call_graph, (), {})
+        self.assertLess(len(approx_nodes), len(exact_nodes))
+        max_error = ONLINE_PRUNING_ERROR_RATIO * 0.05 * exact.call_graph.subtree_event_count
+        for path, count in approx_nodes.items():
+            self.assertLessEqual(count, exact_nodes[path])
+            self.assertGreaterEqual(count, exact_nodes[path] - max_error)
+        for path, count in exact_nodes.items():
+            if count > max_error:
+                self.assertIn(path, approx_nodes)
+        for lib_id, lib in exact.libs.items():
+            for func_id, function in lib.functions.items():
+                if function.subtree_event_count > ONLINE_PRUNING_ERROR_RATIO * 0.01 * 20000:
+                    self.assertIn(func_id, approx.libs[lib_id].functions)
+
+    def test_load_source_code_with_index(self):
+        index_file = 'report_html_source_index_test'
+        source_dir = 'report_html_source_index_test_dir'
+        remove(index_file)
+        remove(source_dir)
+        os.makedirs(os.path.join(source_dir, 'a'))
+        source_path = os.path.join(source_dir, 'a', 'main.cpp')
+        with open(source_path, 'w') as f:
+            f.write('line1\nline2\nline3\n')
+        for _ in range(2):
+            source_files = SourceFileSet()
+            source_file = source_files.get_source_file('/src/a/main.cpp')
+            source_file.request_lines(2, 3)
+            source_files.load_source_code([source_dir], index_file)
+            self.assertEqual(source_file.real_path, source_path)
+            self.assertEqual(source_file.line_to_code, {2: 'line2\n', 3: 'line3\n'})
+            self.assertTrue(os.path.isfile(index_file))
+        remove(index_file)
+        remove(source_dir)
+
+    def test_deep_call_graph(self):
+        # Tree traversals shouldn't hit the default recursion limit.
+        root = CallNode(0)
+        node = root
+        for i in range(1, 5000):
+            node = node.get_child(i)
+            node.event_count = 1
+        self.assertEqual(root.update_subtree_event_count(), 4999)
+        hit_func_ids = set()
+        root.cut_edge(10, hit_func_ids)
+        self.assertEqual(len(hit_func_ids), 4991)
+        sample_info = root.gen_sample_info()
+        depth = 0
+        while sample_info['c']:
+            sample_info = sample_info['c'][0]
+            depth += 1
+        self.assertEqual(depth, 4990)
+        self.assertEqual(sample_info['s'], 10)
+
+
+class TestAnnotate(unittest.TestCase):
+    # pylint: disable=protected-access
+    class FakeAddr2Line(object):
+        """ Map (dso_name, addr) to a list of (file, function, line), from the innermost
+            inlined function.
+        """
+
+        def __init__(self, sources):
+            self.sources = sources
+            self.addrs = set()
+
+        def add_addr(self, dso_path, _func_addr, addr):
+            self.addrs.add((dso_path, addr))
+
+        def get_sources(self, dso_path, addr):
+            return [SourceLine(*x) for x in self.sources.get((dso_path, addr), [])]
+
+    SOURCES = {
+        ('libA.so', 0x100): [('a.cpp', 'funcA', 10)],
+        ('libA.so', 0x110): [('a.cpp', 'funcA', 12)],
+        ('libA.so', 0x120): [('a.cpp', 'funcA', 12)],
+        ('libA.so', 0x200): [('a.cpp', 'funcB', 20)],
+        # An address in funcB with funcC inlined.
+        ('libA.so', 0x210): [('b.h', 'funcC', 5), ('a.cpp', 'funcB', 22)],
+        ('libB.so', 0x300): [('c.cpp', 'funcD', 30)],
+        ('libB.so', 0x310): [('c.cpp', 'funcD', 31)],
+    }
+
+    def create_annotator(self, dso_filter=None):
+        annotator = SourceFileAnnotator.__new__(SourceFileAnnotator)
+        annotator.period = 0
+        annotator.dso_periods = {}
+        annotator.file_periods = {}
+        annotator.callchain_periods = {}
+        annotator.dso_filter = dso_filter
+        annotator.addr2line = self.FakeAddr2Line(self.SOURCES)
+        return annotator
+
+    @staticmethod
+    def add_periods_per_sample(annotator, symbols, sample_period):
+        """ Attribute periods of a sample as annotate.py did before aggregating callchains. """
+        is_sample_used = False
+        used_dso_dict = {}
+        used_file_dict = {}
+        used_function_dict = {}
+        used_line_dict = {}
+        period = Period(sample_period, sample_period)
+        for j, symbol in enumerate(symbols):
+            if j == 1:
+                period = Period(0, sample_period)
+            if not annotator._filter_symbol(symbol):
+                continue
+            is_sample_used = True
+            annotator._add_dso_period(symbol.dso_name, period, used_dso_dict)
+            for source in annotator.addr2line.get_sources(symbol.dso_name, symbol.vaddr_in_file):
+                if source.file:
+                    annotator._add_file_period(source, period, used_file_dict)
+                    if source.line:
+                        annotator._add_line_period(source, period, used_line_dict)
+            for source in annotator.addr2line.get_sources(symbol.dso_name, symbol.symbol_addr):
+                if source.file:
+                    annotator._add_file_period(source, period, used_file_dict)
+                    if source.function:
+                        annotator._add_function_period(source, period, used_function_dict)
+        if is_sample_used:
+            annotator.period += sample_period
+
+    @staticmethod
+    def get_periods(annotator):
+        def to_tuple(period):
+            return (period.period, period.acc_period)
+        dso_periods = {name: to_tuple(x.period) for name, x in annotator.dso_periods.items()}
+        file_periods = {}
+        for name, file_period in annotator.file_periods.items():
+            file_periods[name] = (
+                to_tuple(file_period.period),
+                {line: to_tuple(x) for line, x in file_period.line_dict.items()},
+                {func: (x[0], to_tuple(x[1])) for func, x in file_period.function_dict.items()})
+        return annotator.period, dso_periods, file_periods
+
+    def test_callchain_periods(self):
+        def create_symbol(dso_name, symbol_addr, vaddr_in_file):
+            return argparse.Namespace(dso_name=dso_name, symbol_addr=symbol_addr,
+                                      vaddr_in_file=vaddr_in_file)
+        a1 = create_symbol('libA.so', 0x100, 0x110)
+        a2 = create_symbol('libA.so', 0x100, 0x120)
+        b = create_symbol('libA.so', 0x200, 0x210)
+        d = create_symbol('libB.so', 0x300, 0x310)
+        callchains = [
+            ([a1, b, d], 10),
+            ([a1, b, d], 20),
+            # funcA and line 12 repeat in the callchain.
+            ([a1, a2, b, a1], 5),
+            ([a2, a1], 7),
+            # funcB is called recursively.
+            ([b, b, d], 3),
+            ([d], 4),
+            ([d, a1], 6),
+        ]
+        for dso_filter in [None, {'libA.so'}, {'libB.so'}]:
+            annotator = self.create_annotator(dso_filter)
+            for symbols, period in callchains:
+                annotator._add_callchain(symbols, period)
+            annotator._generate_periods()
+            expected_annotator = self.create_annotator(dso_filter)
+            for symbols, period in callchains:
+                self.add_periods_per_sample(expected_annotator, symbols, period)
+            self.assertEqual(self.get_periods(annotator), self.get_periods(expected_annotator))
+            self.assertEqual(annotator.callchain_periods, {})
+        # Samples with the same callchain are aggregated.
+        annotator = self.create_annotator()
+        for symbols, period in callchains[:2]:
+            annotator._add_callchain(symbols, period)
+        self.assertEqual(list(annotator.callchain_periods.values()), [30])
+        self.assertIn(('libA.so', 0x110), annotator.addr2line.addrs)
+        self.assertIn(('libA.so', 0x100), annotator.addr2line.addrs)
+
+
+class TestPprofProtoGenerator(unittest.TestCase):
+    def setUp(self):
+        if not HAS_GOOGLE_PROTOBUF:
+            self.skipTest('google.protobuf is missing')
+
+    @staticmethod
+    def create_generator():
+        from pprof_proto_generator import PprofProfileGenerator
+        generator = PprofProfileGenerator({})
+        generator.config['binary_cache_dir'] = None
+        build_ids = {'libA.so': '0xaaaa', 'libB.so': '0xbbbb'}
+        generator.lib = argparse.Namespace(GetBuildIdForPath=build_ids.get)
+        return generator
+
+    @staticmethod
+    def add_sample(generator, period, frames):
+        """ Add a sample like PprofProfileGenerator.read_record_file(). frames is a list of
+            (dso, mapping start, ip, function name), from the innermost frame.
+        """
+        from pprof_proto_generator import Sample
+        sample_type_id = generator.get_sample_type_id('cpu-cycles')
+        sample = Sample()
+        sample.add_value(sample_type_id, 1)
+        sample.add_value(sample_type_id + 1, period)
+        for dso, start, ip, function_name in frames:
+            mapping = argparse.Namespace(start=start, end=start + 0x1000, pgoff=0)
+            symbol = argparse.Namespace(mapping=[mapping], dso_name=dso, vaddr_in_file=ip - start,
+                                        symbol_name=function_name, symbol_addr=0)
+            sample.add_location_id(generator.get_location_id(ip, symbol))
+        generator.add_sample(sample)
+
+    def add_samples(self, generator):
+        frames = [('libA.so', 0x1000, 0x1010, 'funcA'), ('libB.so', 0x3000, 0x3020, 'funcB')]
+        self.add_sample(generator, 100, frames)
+        self.add_sample(generator, 200, frames)
+        self.add_sample(generator, 50, [('libA.so', 0x1000, 0x1500, 'unknown')])
+
+    def test_pprof_profile_writer(self):
+        from pprof_proto_generator import load_pprof_profile, PprofProfileWriter
+        import profile_pb2
+        generator = self.create_generator()
+        self.add_samples(generator)
+        path = 'pprof_profile_writer_test.profile'
+        writer = PprofProfileWriter(path)
+        writer.BUFFER_SIZE = 3
+        for field_name, value in generator.gen_profile_fields():
+            writer.add(field_name, value)
+        writer.close()
+        profile = load_pprof_profile(path)
+        remove(path)
+
+        expected = profile_pb2.Profile()
+        expected.string_table.extend(['', 'event_cpu-cycles_samples', 'count',
+                                      'event_cpu-cycles_count', 'libA.so', 'aaaa', 'funcA',
+                                      'libB.so', 'bbbb', 'funcB'])
+        for type_id in [1, 3]:
+            sample_type = expected.sample_type.add()
+            sample_type.type = type_id
+            sample_type.unit = 2
+        for location_ids, values in [([1, 2], [2, 300]), ([3], [1, 50])]:
+            sample = expected.sample.add()
+            sample.location_id.extend(location_ids)
+            sample.value.extend(values)
+        for mapping_id, start, filename_id in [(1, 0x1000, 4), (2, 0x3000, 7)]:
+            mapping = expected.mapping.add()
+            mapping.id = mapping_id
+            mapping.memory_start = start
+            mapping.memory_limit = start + 0x1000
+            mapping.filename = filename_id
+            mapping.build_id = filename_id + 1
+            mapping.has_filenames = True
+            mapping.has_functions = True
+        for location_id, mapping_id, address, function_id in [
+                (1, 1, 0x1010, 1), (2, 2, 0x3020, 2), (3, 1, 0x1500, None)]:
+            location = expected.location.add()
+            location.id = location_id
+            location.mapping_id = mapping_id
+            location.address = address
+            if function_id:
+                location.line.add().function_id = function_id
+        for function_id, name_id in [(1, 6), (2, 9)]:
+            function = expected.function.add()
+            function.id = function_id
+            function.name = name_id
+            function.system_name = name_id
+        self.assertEqual(profile, expected)
+
+    def test_merge_partial_profile(self):
+        generator1 = self.create_generator()
+        self.add_samples(generator1)
+        generator2 = self.create_generator()
+        # Strings, mappings, locations and functions are added in a different order than in
+        # generator1, so they have different ids.
+        self.add_sample(generator2, 10, [('libB.so', 0x3000, 0x3020, 'funcB'),
+                                         ('libA.so', 0x1000, 0x1030, 'funcC')])
+        self.add_sample(generator2, 400, [('libA.so', 0x1000, 0x1010, 'funcA'),
+                                          ('libB.so', 0x3000, 0x3020, 'funcB')])
+        partial_lines = [[(line.function_id, line.line) for line in location.lines]
+                         for location in generator2.location_list]
+
+        merged = self.create_generator()
+        merged.merge_partial_profile(generator1.get_partial_profile())
+        merged.merge_partial_profile(generator2.get_partial_profile())
+
+        def get_location(location_id):
+            location = merged.location_list[location_id - 1]
+            mapping = merged.get_mapping(location.mapping_id)
+            function_names = [merged.get_string(merged.get_function(line.function_id).name_id)
+                              for line in location.lines]
+            return (merged.get_string(mapping.filename_id), location.address, function_names)
+
+        self.assertEqual([merged.get_string(m.filename_id) for m in merged.mapping_list],
+                         ['libA.so', 'libB.so'])
+        self.assertEqual([merged.get_string(m.build_id_id) for m in merged.mapping_list],
+                         ['aaaa', 'bbbb'])
+        self.assertEqual([merged.get_string(f.name_id) for f in merged.function_list],
+                         ['funcA', 'funcB', 'funcC'])
+        self.assertEqual([get_location(i) for i in range(1, len(merged.location_list) + 1)],
+                         [('libA.so', 0x1010, ['funcA']), ('libB.so', 0x3020, ['funcB']),
+                          ('libA.so', 0x1500, []), ('libA.so', 0x1030, ['funcC'])])
+        self.assertEqual(len(merged.string_list), len(set(merged.string_list)))
+        # Samples with the same locations are merged, and their values are added.
+        samples = {tuple(get_location(i)[1] for i in sample.location_ids): sample.values
+                   for sample in merged.sample_list}
+        self.assertEqual(samples, {(0x1010, 0x3020): {0: 3, 1: 700},
+                                   (0x1500,): {0: 1, 1: 50},
+                                   (0x3020, 0x1030): {0: 1, 1: 10}})
+        # The partial profile isn't modified.
+        self.assertEqual([[(line.function_id, line.line) for line in location.lines]
+                          for location in generator2.location_list], partial_lines)
+
+
+class TestInferno(TestBase):
+    @staticmethod
+    def create_sample(tid, time, period, frames, pid=1, thread_comm='t'):
+        """ Return (sample, symbol, callchain) like those returned by ReportLib. frames is a list
+            of (dso, method) pairs, from the innermost frame.
+        """
+        def create_symbol(frame):
+            return argparse.Namespace(dso_name=frame[0], symbol_name=frame[1])
+        sample = argparse.Namespace(tid=tid, pid=pid, time=time, period=period,
+                                    thread_comm=thread_comm)
+        entries = [argparse.Namespace(ip=1, symbol=create_symbol(frame)) for frame in frames[1:]]
+        callchain = argparse.Namespace(nr=len(entries), entries=entries)
+        return sample, create_symbol(frames[0]), callchain
+
+    def test_callsite_table(self):
+        table = CallSiteTable()
+        key = table.get_key('libc.so', 'malloc')
+        self.assertEqual(table.get_key('libc.so', 'malloc'), key)
+        self.assertNotEqual(table.get_key('libm.so', 'malloc'), key)
+        self.assertNotEqual(table.get_key('libc.so', 'free'), key)
+        self.assertEqual(table.find_key('libc.so', 'malloc'), key)
+        self.assertIsNone(table.find_key('libc.so', 'calloc'))
+        self.assertIsNone(table.find_key('libz.so', 'malloc'))
+        self.assertEqual((table.dsos[key], table.methods[key]), ('libc.so', 'malloc'))
+
+    def test_callsite_children(self):
+        table = CallSiteTable()
+        root = FlameGraphCallSite('root', '', 0)
+        self.assertIsNone(root.child_dict)
+        keys = [table.get_key('app', 'main'), table.get_key('app', 'run')]
+        root.add_callchain(keys, 10, table)
+        child = root.child_dict[keys[0]]
+        leaf = child.child_dict[keys[1]]
+        self.assertIsNone(leaf.child_dict)
+        # Equal keys reach the same call sites.
+        root.add_callchain([table.get_key('app', 'main'), table.get_key('app', 'run')], 5, table)
+        self.assertIs(root.child_dict[keys[0]], child)
+        self.assertIs(child.child_dict[keys[1]], leaf)
+        self.assertEqual(len(root.child_dict), 1)
+        self.assertEqual((root.num_events, child.num_events, leaf.num_events), (15, 15, 15))
+        self.assertEqual((leaf.dso, leaf.method), ('app', 'run'))
+        # Strings are shared with the call site table.
+        self.assertIs(leaf.method, table.methods[keys[1]])
+
+    @staticmethod
+    def find_callsite(process, methods):
+        """ Return the call site reached by a path of methods in the flamegraph of thread 1. """
+        callsite = process.threads[1].flamegraph
+        for method in methods:
+            key = process.callsite_table.find_key('app', method)
+            callsite = callsite.child_dict[key]
+        return callsite
+
+    def test_baseline(self):
+        process = Process('app', 1)
+        for period, methods in [(6, ['a', 'main']), (4, ['b', 'main']), (2, ['x', 'c', 'main'])]:
+            process.add_sample(*self.create_sample(1, 0, period, [('app', m) for m in methods]))
+        baseline = Process('app', 1)
+        for period, methods in [(2, ['a', 'main']), (5, ['y', 'a', 'main']),
+                                (3, ['x', 'd', 'main']), (10, ['c', 'main'])]:
+            baseline.add_sample(*self.create_sample(1, 0, period, [('app', m) for m in methods]))
+        flat_tree = baseline.threads[1].flamegraph.get_flat_tree()
+        process.set_baseline(baseline.num_events, flat_tree)
+
+        root = process.threads[1].flamegraph
+        main_node = self.find_callsite(process, ['main'])
+        a = self.find_callsite(process, ['main', 'a'])
+        b = self.find_callsite(process, ['main', 'b'])
+        c = self.find_callsite(process, ['main', 'c'])
+        x = self.find_callsite(process, ['main', 'c', 'x'])
+        # Call sites are aligned by paths. main -> a -> y and main -> d -> x in the baseline have
+        # no space in the flamegraph, and x under c isn't matched with x under d.
+        self.assertEqual(process.baseline_events, {root.id: 20, main_node.id: 20, a.id: 7,
+                                                   c.id: 10})
+        self.assertEqual(process.get_diff_ratio(main_node), 0)
+        # a: 50% of events, 35% in the baseline.
+        self.assertAlmostEqual(process.get_diff_ratio(a), (0.5 - 0.35) / 0.5)
+        # b and x are new.
+        self.assertEqual(process.get_diff_ratio(b), 1)
+        self.assertEqual(process.get_diff_ratio(x), 1)
+        # c: 1/6 of events, 50% in the baseline.
+        self.assertAlmostEqual(process.get_diff_ratio(c), (1.0 / 6 - 0.5) / 0.5)
+
+        self.assertEqual(get_diff_color(0), (255, 255, 255))
+        self.assertEqual(get_diff_color(1), (255, 55, 55))
+        self.assertEqual(get_diff_color(-1), (55, 55, 255))
+        self.assertEqual(get_diff_color(0.5), (255, 155, 155))
+        self.assertEqual(get_diff_color(-0.5), (155, 155, 255))
+
+    def test_offcpu_breakdown(self):
+        table = CallSiteTable()
+        breakdown = OffCpuBreakdown(table, 1000)
+        kernel_frames = [('[kernel.kallsyms]', '__schedule'), ('[kernel.kallsyms]', 'sys_read')]
+        samples = [
+            # On cpu: short period, no scheduler function.
+            self.create_sample(1, 0, 200, [('app', 'compute'), ('app', 'main')]),
+            self.create_sample(1, 0, 300, [('[kernel.kallsyms]', 'sys_write'), ('app', 'log')]),
+            # Blocked in a scheduler function, the blocking call site is the innermost frame
+            # not in the kernel.
+            self.create_sample(1, 0, 500, kernel_frames + [('libc.so', 'read'), ('app', 'main')]),
+            # Blocked for a long period.
+            self.create_sample(2, 0, 5000, [('libc.so', 'futex_wait'), ('app', 'lock')],
+                               thread_comm='t2'),
+            self.create_sample(2, 0, 3000, [('libc.so', 'futex_wait'), ('app', 'lock')],
+                               thread_comm='t2'),
+            # All frames in the kernel, the blocking call site is the innermost frame.
+            self.create_sample(2, 0, 100, kernel_frames, thread_comm='t2'),
+        ]
+        for sample in samples:
+            breakdown.add_sample(*sample)
+        self.assertEqual(breakdown.thread_times, {1: ['t', 500, 500], 2: ['t2', 0, 8100]})
+        self.assertEqual(breakdown.get_top_callsites(10), [
+            ('futex_wait', 'libc.so', 8000, 2, 5000),
+            ('read', 'libc.so', 500, 1, 500),
+            ('__schedule', '[kernel.kallsyms]', 100, 1, 100)])
+        self.assertEqual(len(breakdown.get_top_callsites(1)), 1)
+
+    def test_get_sample_interval_ns(self):
+        cmd = '/data/local/tmp/simpleperf record --trace-offcpu --duration 2 -g ./a'
+        self.assertEqual(get_sample_interval_ns(cmd), 1e9 / 4000)
+        self.assertEqual(get_sample_interval_ns(cmd + ' -f 1000'), 1e6)
+        self.assertEqual(get_sample_interval_ns(cmd + ' -e cpu-clock -c 100000'), 100000)
+        self.assertIsNone(get_sample_interval_ns(cmd + ' -e cpu-cycles -c 100000'))
+        self.assertIsNone(get_sample_interval_ns(''))
+
+    def test_time_buckets(self):
+        process = Process('app', 1)
+        process.enable_time_buckets(10)
+        frames = [('app', 'run'), ('app', 'main')]
+        # Bucket boundaries are relative to the first sample.
+        for tid, time in [(1, 100), (2, 109), (1, 110), (2, 135), (1, 139)]:
+            process.add_sample(*self.create_sample(tid, time, 1, frames))
+        buckets = process.get_flamegraph_threads()
+        self.assertEqual([(b.start_time, b.end_time, b.num_samples) for b in buckets],
+                         [(0, 10, 2), (10, 20, 1), (30, 40, 2)])
+        self.assertEqual(process.threads, {})
+        self.assertEqual(sum(b.flamegraph.num_events for b in buckets), process.num_events)
+        # Time buckets share the call site table.
+        self.assertEqual(len(process.callsite_table.methods), 2)
+
+    def test_time_bucket_ms_option(self):
+        for value in ['0', '-1']:
+            subproc = subprocess.Popen(
+                [sys.executable, os.path.join('inferno', 'inferno.py'), '-sc', '--no_browser',
+                 '--time_bucket_ms', value], stderr=subprocess.PIPE)
+            _, error = subproc.communicate()
+            self.assertNotEqual(subproc.returncode, 0)
+            self.assertIn('--time_bucket_ms should be positive', bytes_to_str(error))
+
+    def test_offcpu_breakdown_with_sampling_options(self):
+        for option in [['--sample_rate', '2'], ['--max_samples', '100']]:
+            subproc = subprocess.Popen(
+                [sys.executable, os.path.join('inferno', 'inferno.py'), '-sc', '--no_browser',
+                 '--offcpu_breakdown'] + option, stderr=subprocess.PIPE)
+            _, error = subproc.communicate()
+            self.assertNotEqual(subproc.returncode, 0)
+            self.assertIn("--offcpu_breakdown can't be used with", bytes_to_str(error))
+
+    def build_process(self, samples, trace_offcpu=False):
+        """ Return a Process with samples of all threads in one flamegraph, ready to render.
+            samples is a list of (period, frames).
+        """
+        process = Process('app', 1)
+        process.props['trace_offcpu'] = trace_offcpu
+        for period, frames in samples:
+            process.add_sample(*self.create_sample(1, 0, period, frames))
+        flamegraph = process.threads[1].flamegraph
+        flamegraph.trim_callchain(0)
+        flamegraph.generate_offset(0)
+        return process
+
+    def test_canvas_data(self):
+        process = self.build_process([(6, [('app', 'f1'), ('app', 'main')]),
+                                      (4, [('libc.so', 'f2'), ('app', 'main')])])
+        data = gen_canvas_data(process, process.threads[1].flamegraph, 'hot')
+        self.assertEqual(data['nodeFields'], NODE_FIELDS)
+        self.assertEqual(data['totalWeight'], 10)
+        self.assertNotIn('diffRatios', data)
+        nodes = data['nodes']
+        self.assertEqual(len(nodes), 3 * NODE_FIELDS)
+        # Nodes are in depth-first order: (id, depth, offset, width, method, dso).
+        rows = [nodes[i:i + NODE_FIELDS] for i in range(0, len(nodes), NODE_FIELDS)]
+        strings = data['strings']
+        self.assertEqual([(row[1], row[2], row[3], strings[row[4]], strings[row[5]])
+                          for row in rows],
+                         [(0, 0, 10, 'main', 'app'), (1, 0, 6, 'f1', 'app'),
+                          (1, 6, 4, 'f2', 'libc.so')])
+
+    def test_svg_renderer(self):
+        process = self.build_process([(100000, [('app', 'hot<int>&'), ('app', 'main')]),
+                                      (1, [('app', 'cold'), ('app', 'main')])])
+        flamegraph = process.threads[1].flamegraph
+        main_node = flamegraph.children[0]
+        hot, cold = sorted(main_node.children, key=lambda x: x.num_events, reverse=True)
+        # The cold node is narrower than DEFAULT_MIN_NODE_WIDTH pixels.
+        min_weight = flamegraph.weight() * DEFAULT_MIN_NODE_WIDTH / 1920
+        self.assertEqual(get_visible_children(main_node, min_weight), [hot])
+        self.assertEqual(get_visible_children(main_node, 0), [hot, cold])
+
+        def render(color_scheme, **kwargs):
+            f = StringIO()
+            render_svg(process, flamegraph, f, color_scheme, **kwargs)
+            # The output should be well-formed.
+            root = ElementTree.fromstring('<root>' + f.getvalue() + '</root>')
+            svg = root.find('div/{http://www.w3.org/2000/svg}svg')
+            self.assertIsNotNone(svg)
+            return dict((int(g.get('id')), g) for g in svg.iter('{http://www.w3.org/2000/svg}g'))
+
+        for color_scheme in ['hot', 'dso', 'legacy']:
+            nodes = render(color_scheme)
+            self.assertEqual(set(nodes), set([main_node.id, hot.id]))
+            self.assertIn('hot<int>&', nodes[hot.id].find('{http://www.w3.org/2000/svg}title').text)
+        nodes = render('legacy', min_node_width=0)
+        self.assertEqual(set(nodes), set([main_node.id, hot.id, cold.id]))
+        # Colors of the legacy scheme only depend on the method name.
+        self.assertEqual(set(get_legacy_color('main') for _ in range(10)),
+                         set([get_legacy_color('main')]))
+
+    def test_canvas_renderer(self):
+        report_path = 'report_canvas.html'
+        remove(report_path)
+        self.run_cmd([os.path.join('inferno', 'inferno.py'), '-sc', '--record_file',
+                      os.path.join('testdata', 'perf_with_symbols.data'), '--renderer',
+                      'canvas', '--no_browser', '-o', report_path])
+        with open(report_path, 'r') as f:
+            data = f.read()
+        remove(report_path)
+        self.assertIn('class CanvasFlamegraph', data)
+        self.assertNotIn('class="flamegraph_block"', data)
+        blocks = re.findall(r'<script type="application/json">(.*?)</script>', data, re.S)
+        self.assertTrue(blocks)
+        for block in blocks:
+            tree = json.loads(block)
+            self.assertEqual(tree['nodeFields'], NODE_FIELDS)
+            self.assertTrue(tree['nodes'])
+            self.assertEqual(len(tree['nodes']) % NODE_FIELDS, 0)
+            self.assertGreater(tree['totalWeight'], 0)
+
+    def test_process_shares_callsite_table(self):
+        process = Process('app', 1)
+        process.add_sample(*self.create_sample(1, 0, 1, [('app', 'run'), ('app', 'main')]))
+        process.add_sample(*self.create_sample(2, 0, 1, [('app', 'run'), ('app', 'main')]))
+        self.assertEqual(len(process.callsite_table.methods), 2)
+        main1 = list(process.threads[1].flamegraph.child_dict.values())[0]
+        main2 = list(process.threads[2].flamegraph.child_dict.values())[0]
+        self.assertIsNot(main1, main2)
+        self.assertIs(main1.method, main2.method)
+
+
+class TestDebugUnwindReporter(unittest.TestCase):
+    DUMP_LINES = [
+        'file_attr 0:',
+        '  type 1, config 0',
+        'feature section for meta_info: offset 100, size 200',
+        '    debug_unwind = true',
+        '    debug_unwind_mem_before = VmPeak:100 kB;VmRSS:50 kB',
+        '    debug_unwind_mem_after = VmPeak:200 kB;VmRSS:60 kB',
+        'record mmap: type 1, misc 0x2, size 80',
+        '  pid 1, tid 1, addr 0x1000, len 0x1000',
+        '  pgoff 0x0, filename /system/lib/libc.so',
+        'record fork: type 7, misc 0x0, size 40',
+        '  pid 2, ppid 1, tid 2, ptid 1',
+        'record unwinding_result: type 32769, misc 0x0, size 64',
+        '  time 100',
+        '  used_time 5000',
+        '  stop_reason 4',
+        'record sample: type 9, misc 0x2, size 1024',
+        '  sample_type: 0x105ef',
+        '',
+        '  ip 0x1100',
+        'record callchain: type 32770, misc 0x0, size 128',
+        '  pid 2',
+        '  tid 2',
+        '  chain_type ORIGINAL_OFFLINE',
+        '  ip 0x1100, sp 0x7000',
+        '  ip 0x1200, sp 0x7100',
+        '  callchain:',
+        '    memcpy (/system/lib/libc.so[+100])',
+        '    pthread_mutex_lock (/system/lib/libc.so[+200])',
+        'record callchain: type 32770, misc 0x0, size 128',
+        '  pid 2',
+        '  tid 2',
+        '  chain_type JOINED_OFFLINE',
+        '  ip 0x1100, sp 0x7000',
+        '  callchain:',
+        '    memcpy (/system/lib/libc.so[+100])',
+    ]
+
+    def parse_dump(self, lines, omit_sample=False):
+        args = argparse.Namespace(omit_callchains_fixed_by_joiner=False, omit_sample=omit_sample)
+        return parse_dump_output((str_to_bytes(line + '\n') for line in lines), args)
+
+    def test_iter_dump_records(self):
+        lines = [str_to_bytes(line + '\n') for line in ['  header'] + self.DUMP_LINES[:11]]
+        records = list(iter_dump_records(iter(lines)))
+        # Lines before the first record are skipped.
+        self.assertEqual([start_line for start_line, _ in records], [2, 4, 8, 11])
+        self.assertEqual(records[0][1], ['file_attr 0:', '  type 1, config 0'])
+        self.assertEqual(records[3][1], self.DUMP_LINES[9:11])
+
+    def test_parse_dump_output(self):
+        report = self.parse_dump(self.DUMP_LINES)
+        self.assertEqual(report.mem_stat.before_unwinding,
+                         [('VmPeak', '100 kB'), ('VmRSS', '50 kB')])
+        self.assertEqual(report.process_maps.find(2, 0x1100).filename, '/system/lib/libc.so')
+        self.assertEqual(report.unwinding_times.count, 1)
+        self.assertEqual(report.unwinding_times.total_time, 5000)
+        function_result = report.file_results['/system/lib/libc.so'].function_results[
+            'pthread_mutex_lock']
+        sample_result = function_result.sample_results['4'][0]
+        self.assertEqual((sample_result.pid, sample_result.tid), (2, 2))
+        self.assertEqual([node.ip for node in sample_result.callchain], [0x1100, 0x1200])
+        self.assertEqual([node.map_start_addr for node in sample_result.callchain],
+                         [0x1000, 0x1000])
+        self.assertEqual(sample_result.sample_record, self.DUMP_LINES[15:19])
+        report = self.parse_dump(self.DUMP_LINES, omit_sample=True)
+        function_result = report.file_results['/system/lib/libc.so'].function_results[
+            'pthread_mutex_lock']
+        self.assertEqual(function_result.sample_results['4'][0].sample_record, [])
+
+    def test_parse_dump_output_errors(self):
+        # Not generated by the debug-unwind cmd.
+        self.assertIsNone(self.parse_dump(self.DUMP_LINES[:2] + self.DUMP_LINES[6:]))
+        # Truncated in the middle of a sample.
+        with self.assertRaises(Exception):
+            self.parse_dump(self.DUMP_LINES[:-7])
+        # A sample without callchain records.
+        with self.assertRaises(Exception):
+            self.parse_dump(self.DUMP_LINES[:19])
+
+    def test_latency_histogram(self):
+        for value in list(range(100)) + [1000, 5000, 1 << 40]:
+            histogram = LatencyHistogram()
+            histogram.add(value)
+            (index,) = histogram.buckets
+            low, high = histogram.get_bucket_range(index)
+            self.assertTrue(low <= value < high)
+            self.assertLessEqual(high - low, max(1, low // LatencyHistogram.SUB_BUCKETS))
+        histogram = LatencyHistogram()
+        for value in [1, 2, 3, 4]:
+            histogram.add(value)
+        self.assertEqual(histogram.get_percentile(50, 4), 2)
+        self.assertEqual(histogram.get_percentile(99.9, 4), 4)
+        self.assertEqual(histogram.to_json(), [[1, 2, 1], [2, 3, 1], [3, 4, 1], [4, 5, 1]])
+
+    def test_unwinding_time_percentiles(self):
+        times = UnwindingTimes()
+        for used_time in range(1, 1001):
+            times.add_time(used_time)
+        for percentile in UnwindingTimes.PERCENTILES:
+            expected = 1000 * percentile / 100.0
+            self.assertGreaterEqual(times.get_percentile(percentile), expected)
+            self.assertLessEqual(times.get_percentile(percentile),
+                                 expected * (1 + 1.0 / LatencyHistogram.SUB_BUCKETS))
+        # Percentiles never exceed the max time.
+        self.assertEqual(times.get_percentile(99.9), 1000)
+
+    def test_unwinding_time_json(self):
+        report = self.parse_dump(self.DUMP_LINES)
+        json_path = 'unwinding_time_test.json'
+        report.write_unwinding_times_json(json_path)
+        with open(json_path, 'r') as f:
+            data = json.load(f)
+        remove(json_path)
+        self.assertEqual(data['all']['count'], 1)
+        self.assertEqual(data['all']['max_time'], 5000)
+        self.assertEqual(data['all']['percentiles'], {'p50': 5000, 'p90': 5000, 'p99': 5000,
+                                                      'p99.9': 5000})
+        self.assertEqual(list(data['per_stop_reason']), ['4'])
+        self.assertEqual(list(data['per_leaf_dso']), ['/system/lib/libc.so'])
+        self.assertEqual(data['per_leaf_dso']['/system/lib/libc.so']['histogram'],
+                         [[4992, 5120, 1]])
+
+
+class TestReportGui(unittest.TestCase):
+    REPORT_LINES = [
+        'Cmdline: /system/bin/simpleperf record -g',
+        'Arch: arm64',
+        'Event: cpu-cycles (type 0, config 0)',
+        'Samples: 100',
+        'Event count: 1000',
+        '',
+        'Children  Self    Command  Pid  Tid  Shared Object        Symbol',
+        '100.00%   0.00%   app      1    1    /system/lib/libc.so  __libc_init',
+        '       |',
+        '       -- __libc_init',
+        '          |',
+        '          |--60.00%-- main',
+        '          |    |',
+        '          |    |--50.00%-- foo',
+        '          |    |',
+        '          |     --50.00%-- bar',
+        '          |',
+        '           --40.00%-- run',
+        '                      start',
+        '50.00%    50.00%  app      1    1    /system/bin/app      foo',
+    ]
+
+    class FakeTreeview(object):
+        """ Keep rows inserted by ReportWindow, without creating a window. """
+
+        def __init__(self):
+            self.rows = {'': []}  # map from row id to child row ids.
+            self.values = {}
+            self.focused = None
+
+        def insert(self, parent, _index, _iid, values, **_kwargs):
+            row_id = 'row%d' % len(self.values)
+            self.rows[parent].append(row_id)
+            self.rows[row_id] = []
+            self.values[row_id] = values[0]
+            return row_id
+
+        def get_children(self, row_id):
+            return self.rows[row_id]
+
+        def delete(self, *row_ids):
+            for rows in self.rows.values():
+                rows[:] = [x for x in rows if x not in row_ids]
+
+        def focus(self):
+            return self.focused
+
+        def get_child_values(self, row_id):
+            return [self.values[x].strip() for x in self.rows[row_id]]
+
+    def test_parse_event_reports(self):
+        from report import parse_event_reports
+        # Lines are read from an iterator, like a file object.
+        event_reports = parse_event_reports(line + '\n' for line in self.REPORT_LINES)
+        self.assertEqual(len(event_reports), 1)
+        event_report = event_reports[0]
+        self.assertEqual(event_report.context, self.REPORT_LINES[:5])
+        self.assertEqual(event_report.title_line, self.REPORT_LINES[6])
+        self.assertEqual(len(event_report.report_items), 2)
+        call_tree = event_report.report_items[0].call_tree
+        self.assertEqual(call_tree.call_stack, ['__libc_init'])
+        self.assertEqual([(x.percentage, x.call_stack) for x in call_tree.children],
+                         [(60.0, ['main']), (40.0, ['run', 'start'])])
+        self.assertEqual([x.call_stack for x in call_tree.children[0].children],
+                         [['foo'], ['bar']])
+        self.assertIsNone(event_report.report_items[1].call_tree)
+
+    def test_expand_call_tree_lazily(self):
+        from report import parse_event_reports, ReportWindow
+        report_items = parse_event_reports(self.REPORT_LINES)[0].report_items
+        tree = self.FakeTreeview()
+        window = ReportWindow.__new__(ReportWindow)
+        window.pending_nodes = {}
+        window.display_report_items(tree, report_items, 0)
+        item_row, _ = tree.get_children('')
+        # Rows of the call tree are inserted when the item is expanded.
+        self.assertEqual(tree.get_child_values(item_row), [''])
+        tree.focused = item_row
+        window.on_open(tree)
+        libc_init_row = tree.get_children(item_row)[0]
+        self.assertEqual(tree.get_child_values(libc_init_row), ['+ 60.00% main', '40.00% run'])
+        main_row, run_row = tree.get_children(libc_init_row)
+        self.assertEqual(tree.get_child_values(run_row), ['start'])
+        self.assertEqual(tree.get_child_values(main_row), [''])
+        tree.focused = main_row
+        window.on_open(tree)
+        self.assertEqual(tree.get_child_values(main_row), ['50.00% foo', '50.00% bar'])
+        self.assertEqual(window.pending_nodes, {})
+        # Expanding a row again doesn't insert rows again.
+        window.on_open(tree)
+        self.assertEqual(tree.get_child_values(main_row), ['50.00% foo', '50.00% bar'])
+
 
 class TestBinaryCacheBuilder(TestBase):
     def test_copy_binaries_from_symfs_dirs(self):
@@ -20,7 +20,10 @@
 
 from __future__ import print_function
 import argparse
+import json
 import logging
+import mmap
+import multiprocessing
 import os
 import os.path
 import re
@@ -29,6 +32,10 @@ import subprocess
 import sys
 import time
 
+# With online pruning (lossy counting) in report_html.py and inferno, event counts of kept
+# call graph nodes are underestimated by at most ONLINE_PRUNING_ERROR_RATIO * the pruning limit.
+ONLINE_PRUNING_ERROR_RATIO = 0.5
+
 def get_script_dir():
     return os.path.dirname(os.path.realpath(__file__))
 
@@ -84,6 +91,19 @@ def bytes_to_str(bytes_value):
         return bytes_value
     return bytes_value.decode('utf-8')
 
+def encode_varint(value):
+    """ Encode an integer as a protobuf varint. Negative values are encoded as 64-bit
+        two's complement, like int32 and int64 fields in protobuf.
+    """
+    if value < 0:
+        value += 1 << 64
+    data = bytearray()
+    while value > 0x7f:
+        data.append((value & 0x7f) | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
 def get_target_binary_path(arch, binary_name):
     if arch == 'aarch64':
         arch = 'arm64'
@@ -328,6 +348,51 @@ class AdbHelper(object):
         return android_version
 
 
+def get_default_jobs():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+_pool_worker_obj = None
+
+def _init_pool_worker(obj):
+    global _pool_worker_obj
+    _pool_worker_obj = obj
+
+def _run_pool_task(task):
+    method_name, args = task
+    return getattr(_pool_worker_obj, method_name)(*args)
+
+def map_in_process_pool(obj, method_name, args_list, jobs):
+    """ Call obj.method_name(*args) for each args in args_list, and yield results in order.
+        When jobs > 1, calls are distributed to a pool of worker processes. obj is pickled
+        once for each worker instead of once for each task.
+    """
+    jobs = min(jobs, len(args_list))
+    if jobs <= 1:
+        method = getattr(obj, method_name)
+        for args in args_list:
+            yield method(*args)
+        return
+    pool = multiprocessing.Pool(jobs, _init_pool_worker, (obj,))
+    try:
+        for result in pool.imap(_run_pool_task, [(method_name, args) for args in args_list]):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def check_sampling_args(args):
+    """ Exit if --sample_rate or --max_samples options of a report script are invalid. """
+    if args.sample_rate < 1:
+        log_exit('--sample_rate should be >= 1.')
+    if args.max_samples is not None and args.max_samples < 1:
+        log_exit('--max_samples should be >= 1.')
+
+
 def flatten_arg_list(arg_list):
     res = []
     if arg_list:
@@ -435,6 +500,22 @@ class Addr2Nearestline(object):
         self.with_function_name = with_function_name
         # Saving file names for each addr takes a lot of memory. So we store file ids in Addr,
         # and provide data structures connecting file id and file name here.
+        self._reset_id_maps()
+
+    def __getstate__(self):
+        # Only send tool paths and options to worker processes, not collected addrs.
+        state = self.__dict__.copy()
+        for name in ['dso_map', 'file_name_to_id', 'file_id_to_name', 'func_name_to_id',
+                     'func_id_to_name']:
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset_id_maps()
+        self.dso_map = {}
+
+    def _reset_id_maps(self):
         self.file_name_to_id = {}
         self.file_id_to_name = []
         self.func_name_to_id = {}
@@ -447,9 +528,49 @@ class Addr2Nearestline(object):
         if addr not in dso.addrs:
             dso.addrs[addr] = self.Addr(func_addr)
 
-    def convert_addrs_to_lines(self):
-        for dso_path in self.dso_map:
-            self._convert_addrs_in_one_dso(dso_path, self.dso_map[dso_path])
+    def convert_addrs_to_lines(self, jobs=1):
+        """ Convert addrs in each dso. Dsos are independent, so when jobs > 1, they are
+            converted in worker processes, each returning a compact addr to line table.
+        """
+        if jobs <= 1 or len(self.dso_map) <= 1:
+            for dso_path in self.dso_map:
+                self._convert_addrs_in_one_dso(dso_path, self.dso_map[dso_path])
+            return
+        dso_paths = list(self.dso_map)
+        tasks = []
+        for dso_path in dso_paths:
+            addrs = self.dso_map[dso_path].addrs
+            tasks.append((dso_path, {addr: addrs[addr].func_addr for addr in addrs}))
+        results = map_in_process_pool(self, '_convert_addrs_in_worker', tasks, jobs)
+        for dso_path, result in zip(dso_paths, results):
+            self._merge_worker_result(self.dso_map[dso_path], result)
+
+    def _convert_addrs_in_worker(self, dso_path, addr_to_func_addr):
+        """ Run in a worker process. Return (file_names, func_names, addr_to_lines), where
+            addr_to_lines uses ids of file_names and func_names.
+        """
+        self._reset_id_maps()
+        dso = self.Dso()
+        for addr, func_addr in addr_to_func_addr.items():
+            dso.addrs[addr] = self.Addr(func_addr)
+        self._convert_addrs_in_one_dso(dso_path, dso)
+        addr_to_lines = {}
+        for addr, addr_obj in dso.addrs.items():
+            if addr_obj.source_lines:
+                addr_to_lines[addr] = addr_obj.source_lines
+        return (self.file_id_to_name, self.func_id_to_name, addr_to_lines)
+
+    def _merge_worker_result(self, dso, result):
+        file_names, func_names, addr_to_lines = result
+        file_ids = [self._get_file_id(file_name) for file_name in file_names]
+        func_ids = [self._get_func_id(func_name) for func_name in func_names]
+        for addr, lines in addr_to_lines.items():
+            if self.with_function_name:
+                lines = [(file_ids[file_id], line, func_ids[func_id])
+                         for (file_id, line, func_id) in lines]
+            else:
+                lines = [(file_ids[file_id], line) for (file_id, line) in lines]
+            dso.addrs[addr].source_lines = lines
 
     def _convert_addrs_in_one_dso(self, dso_path, dso):
         real_path = find_real_dso_path(dso_path, self.binary_cache_path)
@@ -603,52 +724,196 @@ class SourceFileSearcher(object):
            as below:
            2.1 Find all real paths with the same file name as the abstract path.
            2.2 Select the real path having the longest common suffix with the abstract path.
+               Parent directories of real paths are put in a trie of reversed path
+               components, so it is found by walking down the trie.
+        Collected paths can be persisted in an index file. When loading the index, only
+        directories with changed mtimes are listed again.
     """
 
     SOURCE_FILE_EXTS = {'.h', '.hh', '.H', '.hxx', '.hpp', '.h++',
                         '.c', '.cc', '.C', '.cxx', '.cpp', '.c++',
                         '.java', '.kt'}
 
+    INDEX_VERSION = 3
+
     @classmethod
     def is_source_filename(cls, filename):
         ext = os.path.splitext(filename)[1]
         return ext in cls.SOURCE_FILE_EXTS
 
-    def __init__(self, source_dirs):
-        # Map from filename to a list of reversed directory path containing filename.
-        self.filename_to_rparents = {}
-        self._collect_paths(source_dirs)
-
-    def _collect_paths(self, source_dirs):
-        for source_dir in source_dirs:
-            for parent, _, file_names in os.walk(source_dir):
-                rparent = None
-                for file_name in file_names:
-                    if self.is_source_filename(file_name):
-                        rparents = self.filename_to_rparents.get(file_name)
-                        if rparents is None:
-                            rparents = self.filename_to_rparents[file_name] = []
-                        if rparent is None:
-                            rparent = parent[::-1]
-                        rparents.append(rparent)
+    def __init__(self, source_dirs, index_file=None):
+        # Map from each directory under source_dirs to (mtime, source file names, subdir names).
+        self.dirs = {}
+        # Map from filename to a list of directory paths containing filename.
+        self.filename_to_parents = {}
+        # Map from filename to a trie built from reversed components of its parent paths. Each
+        # trie node is [children dict, the first parent path in the subtree]. Tries are built
+        # lazily, as only a few filenames are searched.
+        self.filename_to_trie = {}
+        old_dirs = self._load_index(source_dirs, index_file) if index_file else {}
+        if self._collect_paths(source_dirs, old_dirs) and index_file:
+            self._save_index(source_dirs, index_file)
+
+    def _load_index(self, source_dirs, index_file):
+        """ Return dirs saved in index_file. A missing, outdated or broken index is treated as
+            no index, and paths are collected again.
+        """
+        try:
+            with open(index_file, 'r') as f:
+                index = json.load(f)
+            if (index['version'] != self.INDEX_VERSION or
+                    index['source_dirs'] != [os.path.abspath(x) for x in source_dirs]):
+                return {}
+            return {dir_path: (float(mtime), list(file_names), list(subdirs))
+                    for dir_path, (mtime, file_names, subdirs) in index['dirs'].items()}
+        except Exception:  # pylint: disable=broad-except
+            return {}
+
+    def _save_index(self, source_dirs, index_file):
+        index = {'version': self.INDEX_VERSION,
+                 'source_dirs': [os.path.abspath(x) for x in source_dirs],
+                 'dirs': self.dirs}
+        try:
+            with open(index_file, 'w') as f:
+                json.dump(index, f)
+        except (IOError, OSError) as e:
+            log_warning("can't write source file index %s: %s" % (index_file, e))
+
+    def _collect_paths(self, source_dirs, old_dirs):
+        """ Visit directories in the same order as os.walk(). Directories with the same mtime
+            as in old_dirs aren't listed again. Return True if old_dirs is outdated.
+        """
+        modified = False
+        stack = list(reversed(source_dirs))
+        while stack:
+            dir_path = stack.pop()
+            try:
+                mtime = os.stat(dir_path).st_mtime
+            except OSError:
+                continue
+            entry = old_dirs.get(dir_path)
+            if entry is None or entry[0] != mtime:
+                entry = self._list_dir(dir_path, mtime)
+                modified = True
+            self.dirs[dir_path] = entry
+            for file_name in entry[1]:
+                parents = self.filename_to_parents.get(file_name)
+                if parents is None:
+                    parents = self.filename_to_parents[file_name] = []
+                parents.append(dir_path)
+            for subdir in reversed(entry[2]):
+                stack.append(os.path.join(dir_path, subdir))
+        # Removed directories also make old_dirs outdated.
+        return modified or len(self.dirs) != len(old_dirs)
+
+    def _list_dir(self, dir_path, mtime):
+        file_names = []
+        subdirs = []
+        try:
+            names = os.listdir(dir_path)
+        except OSError:
+            names = []
+        for name in names:
+            path = os.path.join(dir_path, name)
+            if os.path.isdir(path):
+                # Like os.walk(), don't follow symbolic links to directories.
+                if not os.path.islink(path):
+                    subdirs.append(name)
+            elif self.is_source_filename(name):
+                file_names.append(name)
+        return (mtime, file_names, subdirs)
+
+    def _get_trie(self, file_name):
+        trie = self.filename_to_trie.get(file_name)
+        if trie is None:
+            parents = self.filename_to_parents.get(file_name)
+            if not parents:
+                return None
+            trie = self.filename_to_trie[file_name] = [{}, parents[0]]
+            for parent in parents:
+                node = trie
+                for component in reversed(parent.split(os.sep)):
+                    child = node[0].get(component)
+                    if child is None:
+                        child = node[0][component] = [{}, parent]
+                    node = child
+        return trie
 
     def get_real_path(self, abstract_path):
         abstract_path = abstract_path.replace('/', os.sep)
         abstract_parent, file_name = os.path.split(abstract_path)
-        abstract_rparent = abstract_parent[::-1]
-        real_rparents = self.filename_to_rparents.get(file_name)
-        if real_rparents is None:
-            return None
-        best_matched_rparent = None
-        best_common_length = -1
-        for real_rparent in real_rparents:
-            length = len(os.path.commonprefix((real_rparent, abstract_rparent)))
-            if length > best_common_length:
-                best_common_length = length
-                best_matched_rparent = real_rparent
-        if best_matched_rparent is None:
+        node = self._get_trie(file_name)
+        if node is None:
             return None
-        return os.path.join(best_matched_rparent[::-1], file_name)
+        for component in reversed(abstract_parent.split(os.sep)):
+            child = node[0].get(component)
+            if child is None:
+                break
+            node = child
+        return os.path.join(node[1], file_name)
+
+
+class LineOffsetIndex(object):
+    """ Read selected lines of a text file without reading the whole file.
+        The file is mapped with mmap, and start offsets of lines are collected lazily, only up
+        to the largest line requested so far. So requesting lines near the start of a huge file
+        doesn't touch the rest of it.
+    """
+    def __init__(self, path, file_stat):
+        self.path = path
+        self.mtime = file_stat.st_mtime
+        self.size = file_stat.st_size
+        self.line_starts = [0]  # line_starts[i] is the offset of line i + 1.
+        self.scanned_all = False
+
+    def get_lines(self, line_numbers):
+        """ Return a map from line number to the content of that line, for all lines in
+            line_numbers existing in the file.
+        """
+        result = {}
+        line_numbers = sorted(x for x in line_numbers if x > 0)
+        if not line_numbers or self.size == 0:
+            return result
+        with open(self.path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                self._scan_to_line(data, line_numbers[-1])
+                for line in line_numbers:
+                    if line > len(self.line_starts) or self.line_starts[line - 1] >= self.size:
+                        break
+                    end = self.line_starts[line] if line < len(self.line_starts) else self.size
+                    result[line] = self._decode(data[self.line_starts[line - 1]:end])
+            finally:
+                data.close()
+        return result
+
+    def _scan_to_line(self, data, line):
+        line_starts = self.line_starts
+        while not self.scanned_all and len(line_starts) <= line:
+            pos = data.find(b'\n', line_starts[-1])
+            if pos == -1:
+                self.scanned_all = True
+            else:
+                line_starts.append(pos + 1)
+
+    @staticmethod
+    def _decode(line_data):
+        if line_data.endswith(b'\r\n'):
+            line_data = line_data[:-2] + b'\n'
+        if not is_python3():
+            return line_data
+        return line_data.decode('utf-8', 'replace')
+
+
+_line_offset_index_cache = {}  # map from path to LineOffsetIndex.
+
+def get_line_offset_index(path):
+    """ Return a LineOffsetIndex for path, reusing the cached one if the file isn't modified. """
+    file_stat = os.stat(path)
+    index = _line_offset_index_cache.get(path)
+    if index is None or index.mtime != file_stat.st_mtime or index.size != file_stat.st_size:
+        index = _line_offset_index_cache[path] = LineOffsetIndex(path, file_stat)
+    return index
 
 
 class Objdump(object):
@@ -705,6 +970,16 @@ class Objdump(object):
             result.append((line, addr))
         return result
 
+    def disassemble_functions(self, dso_path, func_ranges):
+        """ Disassemble a list of (start_addr, addr_len) in dso_path. Return a list of
+            disassemble results in the same order, or None if dso_path can't be disassembled.
+        """
+        dso_info = self.get_dso_info(dso_path)
+        if not dso_info:
+            return None
+        return [self.disassemble_code(dso_info, start_addr, addr_len)
+                for (start_addr, addr_len) in func_ranges]
+
 
 class ReadElf(object):
     """ A wrapper of readelf. """